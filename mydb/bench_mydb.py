@@ -0,0 +1,254 @@
+# Benchmarks for MyDB.
+#
+# stress: several writer processes append uniquely tagged strings to one
+# file while a compactor keeps rewriting it and a reader keeps hitting the
+# index. At the end every string written must be present exactly once.
+#
+# formats: file size, write throughput and read throughput of the original
+# pickle layout against the log format and the compressed block formats.
+#
+# files: append and load throughput with p50/p95/p99 per-call latency for
+# files of each --strings size. --baseline compares against the JSON lines of
+# an earlier run and exits 1 when an operation got slower by more than
+# --tolerance.
+#
+#   python bench_mydb.py stress --writers 8 --per-writer 2000
+#   python bench_mydb.py formats --strings 200000
+#   python bench_mydb.py files --strings 1000 10000 100000 > before.jsonl
+#   python bench_mydb.py files --strings 1000 10000 100000 --baseline before.jsonl
+
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import sys
+import tempfile
+import time
+from mydb import MyDB, MyDBReader, CODECS
+
+def writer(fname, wid, n, bulk):
+    db = MyDB(fname)
+    strings = ("w%d-%d" % (wid, i) for i in range(n))
+    if bulk:
+        db.saveStrings_bulk(strings, maxCount=bulk)
+    else:
+        for s in strings:
+            db.saveString(s)
+
+def compactor(fname, stop):
+    db = MyDB(fname)
+    while not stop.is_set():
+        db.compact()
+        time.sleep(0.01)
+
+def reader(fname, stop):
+    db = MyDB(fname)
+    while not stop.is_set():
+        n = db.count()
+        if n:
+            db.getString(n - 1)
+
+def stress(writers, perWriter, bulk=0, compact=True):
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, "stress.db")
+        MyDB(fname)
+        stop = multiprocessing.Event()
+        helpers = [multiprocessing.Process(target=reader, args=(fname, stop))]
+        if compact:
+            helpers.append(multiprocessing.Process(target=compactor, args=(fname, stop)))
+        procs = [multiprocessing.Process(target=writer, args=(fname, w, perWriter, bulk))
+                 for w in range(writers)]
+        for p in helpers:
+            p.start()
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for p in helpers:
+            p.join()
+
+        got = MyDB(fname).loadStrings()
+        expected = {"w%d-%d" % (w, i) for w in range(writers) for i in range(perWriter)}
+        return {
+            "writers": writers,
+            "per_writer": perWriter,
+            "bulk": bulk,
+            "compact": compact,
+            "seconds": round(elapsed, 3),
+            "appends_per_sec": round(len(expected) / elapsed, 1),
+            "stored": len(got),
+            "lost": len(expected - set(got)),
+            "duplicated": len(got) - len(set(got)),
+        }
+
+def corpus(n, seed=0):
+    rng = random.Random(seed)
+    words = ["squirrel", "acorn", "oak", "nut", "tail", "branch", "leaf", "cache", "winter", "tree"]
+    return [" ".join(rng.choice(words) for _ in range(rng.randint(3, 20))) for _ in range(n)]
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def formats(n):
+    strings = corpus(n)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, "pickle.db")
+
+        def pickleWrite():
+            with open(fname, 'wb') as f:
+                pickle.dump(strings, f)
+
+        def pickleRead():
+            with open(fname, 'rb') as f:
+                pickle.load(f)
+
+        write = timed(pickleWrite)
+        read = timed(pickleRead)
+        results.append(formatResult("pickle", n, os.path.getsize(fname), write, read))
+
+        for name in ["log"] + sorted(CODECS):
+            fname = os.path.join(tmp, name + ".db")
+            db = MyDB(fname, compression=None if name == "log" else name)
+            write = timed(lambda: db.saveStrings(strings))
+            read = timed(db.loadStrings)
+            results.append(formatResult(name, n, os.path.getsize(fname), write, read))
+    return results
+
+def formatResult(name, n, size, write, read):
+    return {
+        "format": name,
+        "strings": n,
+        "bytes": size,
+        "write_strings_per_sec": round(n / write, 1),
+        "read_strings_per_sec": round(n / read, 1),
+    }
+
+LATENCY_PERCENTILES = (50, 95, 99)
+
+def percentile(ordered, p):
+    # nearest rank
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+def callLatencies(fn, args):
+    # seconds taken by fn(arg) for each arg
+    latencies = []
+    for arg in args:
+        start = time.perf_counter()
+        fn(arg)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def fileResult(operation, n, size, calls, seconds, latencies=None):
+    result = {
+        "benchmark": "files",
+        "operation": operation,
+        "strings": n,
+        "bytes": size,
+        "calls": calls,
+        "seconds": round(seconds, 4),
+        "calls_per_sec": round(calls / seconds, 1),
+    }
+    if latencies:
+        ordered = sorted(latencies)
+        for p in LATENCY_PERCENTILES:
+            result["p%d_ms" % p] = round(percentile(ordered, p) * 1000, 4)
+    return result
+
+def files(sizes, reads=1000, repeat=3, seed=0):
+    # append: saveString per string (one write each); append_bulk: the same
+    # strings through saveStrings_bulk; load / load_mmap: the whole file
+    # through loadStrings and MyDBReader, best of repeat; get: getString at
+    # reads random positions
+    results = []
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            strings = corpus(n, seed)
+            fname = os.path.join(tmp, "append%d.db" % n)
+            db = MyDB(fname)
+            latencies = callLatencies(db.saveString, strings)
+            size = os.path.getsize(fname)
+            results.append(fileResult("append", n, size, n, sum(latencies), latencies))
+
+            bulk = MyDB(os.path.join(tmp, "bulk%d.db" % n))
+            results.append(fileResult("append_bulk", n, size, n, timed(lambda: bulk.saveStrings_bulk(strings))))
+
+            load = min(timed(db.loadStrings) for _ in range(repeat))
+            results.append(fileResult("load", n, size, n, load))
+            with MyDBReader(fname) as view:
+                loadMmap = min(timed(view.loadStrings) for _ in range(repeat))
+            results.append(fileResult("load_mmap", n, size, n, loadMmap))
+
+            positions = [rng.randrange(n) for _ in range(reads)]
+            latencies = callLatencies(db.getString, positions)
+            results.append(fileResult("get", n, size, reads, sum(latencies), latencies))
+    return results
+
+# results from another run are matched on these fields
+FILE_KEYS = ("benchmark", "operation", "strings")
+# compared metric and whether a bigger value is better
+FILE_METRICS = {"calls_per_sec": True}
+
+def compareRuns(results, baselinePath, keys, metrics, tolerance):
+    # adds "baseline" and "regressions" to each result that has a match in
+    # the baseline file; returns the number of regressions found
+    with open(baselinePath) as f:
+        baseline = [json.loads(line) for line in f if line.strip()]
+    previous = {tuple(entry.get(key) for key in keys): entry for entry in baseline}
+    regressions = 0
+    for result in results:
+        before = previous.get(tuple(result.get(key) for key in keys))
+        if before is None:
+            continue
+        result["baseline"] = {metric: before[metric] for metric in metrics}
+        worse = []
+        for metric, higherIsBetter in metrics.items():
+            change = (result[metric] - before[metric]) / before[metric] if before[metric] else 0.0
+            if (-change if higherIsBetter else change) > tolerance:
+                worse.append(metric)
+        result["regressions"] = worse
+        regressions += len(worse)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    stressArgs = commands.add_parser("stress")
+    stressArgs.add_argument("--writers", type=int, default=4)
+    stressArgs.add_argument("--per-writer", type=int, default=1000)
+    stressArgs.add_argument("--bulk", type=int, default=0, help="group-commit batch size (0 = saveString)")
+    stressArgs.add_argument("--no-compact", action="store_true")
+    formatArgs = commands.add_parser("formats")
+    formatArgs.add_argument("--strings", type=int, default=100000)
+    fileArgs = commands.add_parser("files")
+    fileArgs.add_argument("--strings", type=int, nargs="+", default=[1000, 10000, 100000], help="file sizes in strings")
+    fileArgs.add_argument("--reads", type=int, default=1000, help="random getString calls per file")
+    fileArgs.add_argument("--repeat", type=int, default=3)
+    fileArgs.add_argument("--baseline", help="JSON lines from an earlier files run to compare against")
+    fileArgs.add_argument("--tolerance", type=float, default=0.1, help="allowed relative change before it counts as a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "formats":
+        for result in formats(args.strings):
+            print(json.dumps(result))
+        return 0
+    if args.command == "files":
+        results = files(args.strings, args.reads, args.repeat)
+        regressions = compareRuns(results, args.baseline, FILE_KEYS, FILE_METRICS, args.tolerance) if args.baseline else 0
+        for result in results:
+            print(json.dumps(result))
+        return 1 if regressions else 0
+    result = stress(args.writers, args.per_writer, args.bulk, not args.no_compact)
+    print(json.dumps(result))
+    return 1 if result["lost"] or result["duplicated"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,23 +1,736 @@
+import io
+import mmap
 import os.path
 import pickle
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# On-disk layout: a fixed header followed by length-prefixed utf-8 records.
+# The generation is bumped on every full rewrite (saveStrings / compact).
+MAGIC = b"MYDB"
+VERSION = 1
+HEADER = struct.Struct(">4sBQ")
+RECORD = struct.Struct(">I")
+
+# The optional block format (BLOCK_VERSION) groups the same records into
+# blocks of about BLOCK_BYTES, each compressed on its own and guarded by a
+# CRC32 of its payload: codec, record count, payload length, crc.
+BLOCK_VERSION = 2
+BLOCK = struct.Struct(">BIII")
+BLOCK_BYTES = 64 << 10
+CODECS = {"zlib": 1}
+# asks a MyDB for the uncompressed log format explicitly
+NO_COMPRESSION = "none"
+COMPRESS = {1: zlib.compress}
+DECOMPRESS = {1: zlib.decompress}
+DECOMPRESS_ERRORS = (zlib.error, ValueError, EOFError)
+if lzma is not None:
+    CODECS["lzma"] = 2
+    COMPRESS[2] = lzma.compress
+    DECOMPRESS[2] = lzma.decompress
+    DECOMPRESS_ERRORS += (lzma.LZMAError,)
+
+# The offset index lives beside the data file: a header carrying the data
+# file's generation, then one fixed-width offset per record.
+IDX_MAGIC = b"MYDX"
+IDX_HEADER = struct.Struct(">4sQ")
+OFFSET = struct.Struct(">Q")
+BLOCK_ENTRY = struct.Struct(">QI")
+
+# Default flush thresholds for batched writes: whichever of the buffered
+# record count, buffered bytes or milliseconds since the first buffered
+# record is reached first triggers a single write and fsync. The time limit
+# is kept by a timer, so it holds even if no further record arrives.
+BATCH_COUNT = 1000
+BATCH_BYTES = 1 << 20
+BATCH_MS = 50
+
+# Byte budget of the process-wide read cache shared by MyDB instances that
+# are created with cache=True.
+CACHE_BYTES = 64 << 20
+
+def encodeRecord(s):
+    data = s.encode("utf-8")
+    return RECORD.pack(len(data)) + data
+
+def readRecords(f):
+    while True:
+        prefix = f.read(RECORD.size)
+        if len(prefix) < RECORD.size:
+            return
+        (length,) = RECORD.unpack(prefix)
+        data = f.read(length)
+        if len(data) < length:
+            # torn trailing record from an interrupted append
+            return
+        yield data.decode("utf-8")
+
+def splitRecords(raw):
+    return list(readRecords(io.BytesIO(raw)))
+
+def encodeBlock(codec, records):
+    payload = COMPRESS[codec](b"".join(records))
+    return BLOCK.pack(codec, len(records), len(payload), zlib.crc32(payload)) + payload
+
+def encodeBlocks(records, codec, blockBytes=BLOCK_BYTES):
+    group, size = [], 0
+    for record in records:
+        group.append(record)
+        size += len(record)
+        if size >= blockBytes:
+            yield encodeBlock(codec, group)
+            group, size = [], 0
+    if group:
+        yield encodeBlock(codec, group)
+
+def readBlocks(f, offset, size):
+    # yields (offset, count, raw records) for every complete block; raw is
+    # None for a block whose checksum or compressed stream is damaged
+    while offset + BLOCK.size <= size:
+        f.seek(offset)
+        codec, count, length, crc = BLOCK.unpack(f.read(BLOCK.size))
+        end = offset + BLOCK.size + length
+        if end > size:
+            # torn trailing block from an interrupted append
+            return
+        payload = f.read(length)
+        raw = None
+        if zlib.crc32(payload) == crc and codec in DECOMPRESS:
+            try:
+                raw = DECOMPRESS[codec](payload)
+            except DECOMPRESS_ERRORS:
+                raw = None
+        yield offset, count, raw
+        offset = end
+
+def readVersion(f, fname):
+    magic, version, generation = HEADER.unpack(f.read(HEADER.size))
+    if version not in (VERSION, BLOCK_VERSION):
+        raise ValueError("%s has unsupported MyDB format version %d" % (fname, version))
+    return version, generation
+
+def indexEntry(version):
+    return OFFSET if version == VERSION else BLOCK_ENTRY
+
+def indexEntries(f, version, offset, size):
+    if version == VERSION:
+        for o in scanOffsets(f, offset, size):
+            yield OFFSET.pack(o)
+        return
+    for o, count, raw in readBlocks(f, offset, size):
+        if raw is not None:
+            for slot in range(count):
+                yield BLOCK_ENTRY.pack(o, slot)
+
+def entryEnd(f, version, offset):
+    f.seek(offset)
+    if version == VERSION:
+        (length,) = RECORD.unpack(f.read(RECORD.size))
+        return offset + RECORD.size + length
+    codec, count, length, crc = BLOCK.unpack(f.read(BLOCK.size))
+    return offset + BLOCK.size + length
+
+def completeEnd(f, version, offset, size):
+    # end of the last complete record (or block) at or after offset
+    frame = RECORD if version == VERSION else BLOCK
+    while offset + frame.size <= size:
+        end = entryEnd(f, version, offset)
+        if end > size:
+            break
+        offset = end
+    return offset
+
+def memorySize(arr):
+    # what a decoded string list holds on to: the list and every str in it
+    return sys.getsizeof(arr) + sum(map(sys.getsizeof, arr))
+
+def scanOffsets(f, offset, size):
+    while offset + RECORD.size <= size:
+        f.seek(offset)
+        (length,) = RECORD.unpack(f.read(RECORD.size))
+        end = offset + RECORD.size + length
+        if end > size:
+            return
+        yield offset
+        offset = end
+
+# Byte-bounded LRU of decoded string lists keyed by file path. An entry is
+# only served while the file's (mtime_ns, size, inode) still match the stat
+# taken when it was loaded; entries are charged at their size in memory,
+# which for short strings is several times their size on disk.
+class ReadCache:
+
+    def __init__(self, maxBytes=CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, key):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != key:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, path, key, arr, size):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.bytes -= old[2]
+            if size > self.maxBytes:
+                return
+            self._entries[path] = (key, arr, size)
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+            }
+
+READ_CACHE = ReadCache()
 
 class MyDB:
 
-    def __init__(self, filename):
+    # With locking on, appends hold a shared lock (O_APPEND writes don't
+    # interleave) while full rewrites and index updates hold an exclusive
+    # one; readers never lock. The lock lives in a sidecar file because
+    # rewrites atomically replace the data file's inode.
+    #
+    # compression ("zlib" or "lzma") selects the block format for new files
+    # and rewrites, and "none" the log format. Without it, new files are
+    # logs and rewrites keep the format (and codec) the file is already in;
+    # appends always do.
+    # An append to a block file is a block of its own, which for a single
+    # string takes more room than the log format would. Once the blocks
+    # this instance appended make up half the file (and at least
+    # BLOCK_BYTES), it is rewritten into full blocks.
+    def __init__(self, filename, locking=True, cache=False, compression=None):
+        if compression not in (None, NO_COMPRESSION) and compression not in CODECS:
+            raise ValueError("unsupported compression: %r" % compression)
         self.fname = filename
+        self.iname = filename + ".idx"
+        self.lname = filename + ".lock"
+        self.locking = locking and fcntl is not None
+        self.cache = READ_CACHE if cache is True else (cache or None)
+        # None keeps the file's format on rewrites, 0 is the log format
+        self.codec = None if compression is None else CODECS.get(compression, 0)
+        self._migrated = False
+        # the open batch() of each thread, by thread ident
+        self._batches = {}
+        self._batchLock = threading.RLock()
+        self._block = None
+        self._tail = None
+        self._loose = None
         if not os.path.isfile(self.fname):
-            self.saveStrings([])
+            with self._lock():
+                if not os.path.isfile(self.fname):
+                    self._rewrite([])
+
+    @staticmethod
+    def open_readonly(filename):
+        return MyDBReader(filename)
 
     def loadStrings(self):
+        if self.cache is None:
+            return list(self.iterStrings())
+        self._migrate()
+        path = os.path.abspath(self.fname)
+        st = os.stat(self.fname)
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        arr = self.cache.get(path, key)
+        if arr is None:
+            arr = list(self.iterStrings())
+            self.cache.put(path, key, arr, memorySize(arr))
+        # callers are free to mutate what they get back
+        return list(arr)
+
+    @staticmethod
+    def cacheStats():
+        return READ_CACHE.stats()
+
+    def iterStrings(self):
+        self._migrate()
         with open(self.fname, 'rb') as f:
-            arr = pickle.load(f)
-        return arr
+            version, generation = readVersion(f, self.fname)
+            if version == VERSION:
+                yield from readRecords(f)
+                return
+            size = f.seek(0, os.SEEK_END)
+            for offset, count, raw in readBlocks(f, HEADER.size, size):
+                if raw is not None:
+                    yield from splitRecords(raw)
+
+    def getString(self, i):
+        while True:
+            n = self._syncIndex()
+            j = i + n if i < 0 else i
+            if not 0 <= j < n:
+                raise IndexError("MyDB index out of range")
+            with open(self.fname, 'rb') as f, open(self.iname, 'rb') as idx:
+                version, generation = readVersion(f, self.fname)
+                if idx.read(IDX_HEADER.size) != IDX_HEADER.pack(IDX_MAGIC, generation):
+                    # rewritten by another process in between; resync
+                    continue
+                entry = indexEntry(version)
+                idx.seek(IDX_HEADER.size + j * entry.size)
+                if version == VERSION:
+                    (offset,) = entry.unpack(idx.read(entry.size))
+                    f.seek(offset)
+                    return next(readRecords(f))
+                offset, slot = entry.unpack(idx.read(entry.size))
+                return self._readBlock(f, generation, offset)[slot]
+
+    def count(self):
+        return self._syncIndex()
 
     def saveStrings(self, arr):
-        with open(self.fname, 'wb') as f:
-            pickle.dump(arr, f)
+        with self._batchLock, self._lock():
+            self._rewrite(arr)
+            self._dropBuffered()
 
     def saveString(self, s):
-        arr = self.loadStrings()
-        arr.append(s)
-        self.saveStrings(arr)
+        with self._batchLock:
+            batch = self._batches.get(threading.get_ident())
+            if batch is not None:
+                self._buffer(batch, encodeRecord(s))
+                return
+        self._append([encodeRecord(s)])
+
+    def saveStrings_bulk(self, iterable, maxCount=BATCH_COUNT, maxBytes=BATCH_BYTES, maxMs=BATCH_MS):
+        with self.batch(maxCount, maxBytes, maxMs):
+            for s in iterable:
+                self.saveString(s)
+
+    @contextmanager
+    def batch(self, maxCount=BATCH_COUNT, maxBytes=BATCH_BYTES, maxMs=BATCH_MS):
+        # saveString calls inside the block are buffered and group-committed;
+        # they become visible to readers once flushed. Each thread has a
+        # batch of its own; a nested batch joins the thread's open one.
+        ident = threading.get_ident()
+        with self._batchLock:
+            if ident in self._batches:
+                batch = None
+            else:
+                batch = self._batches[ident] = _Batch((maxCount, maxBytes, maxMs))
+        if batch is None:
+            yield self
+            return
+        try:
+            yield self
+        finally:
+            with self._batchLock:
+                try:
+                    self._flushBatch(batch)
+                finally:
+                    self._clearBatch(batch)
+                    del self._batches[ident]
+
+    def flush(self):
+        # writes out the calling thread's batch
+        with self._batchLock:
+            batch = self._batches.get(threading.get_ident())
+            if batch is not None:
+                self._flushBatch(batch)
+
+    def compact(self):
+        # rewrites the file without any torn trailing record; a legacy file
+        # is migrated first, as that takes the exclusive lock itself
+        self._migrate()
+        with self._batchLock, self._lock():
+            self._rewrite(self.loadStrings())
+            self._dropBuffered()
+
+    # HELPERS
+
+    @contextmanager
+    def _lock(self, shared=False):
+        if not self.locking:
+            yield
+            return
+        with open(self.lname, 'ab') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _append(self, records, durable=False):
+        self._migrate()
+        if self._tail is None:
+            # a fresh instance checks the tail from the end of the index,
+            # brought up to date once here so the next one starts from there
+            self._syncIndex()
+        shared = True
+        while True:
+            with self._lock(shared=shared), open(self.fname, 'a+b') as f:
+                # the file may have been rewritten into another format
+                f.seek(0)
+                version, generation = readVersion(f, self.fname)
+                size = f.seek(0, os.SEEK_END)
+                end = self._completeEnd(f, version, generation, size)
+                if end != size and shared and self.locking:
+                    # maybe another appender's write in flight; look again
+                    # once every appender is out
+                    shared = False
+                    continue
+                if end != size:
+                    # a torn record would swallow whatever came after it
+                    f.truncate(end)
+                written = self._write(f, version, records, durable)
+            break
+        if version == VERSION or sum(map(len, records)) >= BLOCK_BYTES:
+            return
+        loose = written + (self._loose[1] if self._loose and self._loose[0] == generation else 0)
+        self._loose = (generation, loose)
+        if loose >= BLOCK_BYTES and 2 * loose >= end + written:
+            self._mergeBlocks(generation)
+
+    def _write(self, f, version, records, durable):
+        if version == VERSION:
+            data = b"".join(records)
+        else:
+            data = b"".join(encodeBlocks(records, self.codec or CODECS["zlib"]))
+        f.write(data)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+        return len(data)
+
+    def _mergeBlocks(self, generation):
+        # rewrites a block file whose appends left it in many small blocks
+        with self._batchLock, self._lock():
+            if self._readGeneration() == generation:
+                self._rewrite(list(self.iterStrings()), self._fileCodec() or CODECS["zlib"])
+
+    def _completeEnd(self, f, version, generation, size):
+        # scans on from where the last append found the file complete, or
+        # else from the last record in the index
+        if self._tail is not None and self._tail[0] == generation and self._tail[1] <= size:
+            offset = self._tail[1]
+        else:
+            offset = self._indexedEnd(f, version, generation, size)
+        end = completeEnd(f, version, offset, size)
+        self._tail = (generation, end)
+        return end
+
+    def _indexedEnd(self, f, version, generation, size):
+        # end of the last record the index holds for this generation
+        entry = indexEntry(version)
+        try:
+            with open(self.iname, 'rb') as idx:
+                if idx.read(IDX_HEADER.size) != IDX_HEADER.pack(IDX_MAGIC, generation):
+                    return HEADER.size
+                count = (idx.seek(0, os.SEEK_END) - IDX_HEADER.size) // entry.size
+                if count <= 0:
+                    return HEADER.size
+                idx.seek(IDX_HEADER.size + (count - 1) * entry.size)
+                last = entry.unpack(idx.read(entry.size))[0]
+        except FileNotFoundError:
+            return HEADER.size
+        end = entryEnd(f, version, last)
+        return end if end <= size else HEADER.size
+
+    def _readBlock(self, f, generation, offset):
+        # the last decoded block is kept so neighbouring reads reuse it
+        if self._block is None or self._block[:2] != (generation, offset):
+            _, _, raw = next(readBlocks(f, offset, f.seek(0, os.SEEK_END)))
+            if raw is None:
+                raise ValueError("corrupt MyDB block at offset %d" % offset)
+            self._block = (generation, offset, splitRecords(raw))
+        return self._block[2]
+
+    def _rewrite(self, arr, codec=None):
+        # writes to temporary files and swaps them in, so readers only ever
+        # see a complete old or a complete new file
+        if codec is None:
+            codec = self._fileCodec() if self.codec is None else self.codec
+        generation = self._readGeneration() + 1
+        version = BLOCK_VERSION if codec else VERSION
+        entries = []
+        with open(self.fname + ".tmp", 'wb') as f:
+            f.write(HEADER.pack(MAGIC, version, generation))
+            offset = HEADER.size
+            records = (encodeRecord(s) for s in arr)
+            if version == VERSION:
+                for record in records:
+                    f.write(record)
+                    entries.append(OFFSET.pack(offset))
+                    offset += len(record)
+            else:
+                for block in encodeBlocks(records, codec):
+                    f.write(block)
+                    count = BLOCK.unpack_from(block)[1]
+                    entries.extend(BLOCK_ENTRY.pack(offset, slot) for slot in range(count))
+                    offset += len(block)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.iname + ".tmp", 'wb') as idx:
+            idx.write(IDX_HEADER.pack(IDX_MAGIC, generation))
+            idx.write(b"".join(entries))
+        os.replace(self.fname + ".tmp", self.fname)
+        os.replace(self.iname + ".tmp", self.iname)
+        self._migrated = True
+
+    def _flushBatch(self, batch):
+        with self._batchLock:
+            if not batch.records:
+                return
+            self._append(batch.records, durable=True)
+            self._clearBatch(batch)
+
+    def _clearBatch(self, batch):
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        batch.records = []
+        batch.bytes = 0
+        batch.since = None
+
+    def _dropBuffered(self):
+        # buffered appends are superseded by a rewrite
+        for batch in self._batches.values():
+            self._clearBatch(batch)
+
+    def _buffer(self, batch, record):
+        if batch.since is None:
+            batch.since = time.monotonic()
+            # flushes a batch that goes idle before reaching its limits
+            batch.timer = threading.Timer(batch.limits[2] / 1000, self._flushBatch, args=(batch,))
+            batch.timer.daemon = True
+            batch.timer.start()
+        batch.records.append(record)
+        batch.bytes += len(record)
+        maxCount, maxBytes, maxMs = batch.limits
+        if (len(batch.records) >= maxCount or batch.bytes >= maxBytes
+                or (time.monotonic() - batch.since) * 1000 >= maxMs):
+            self._flushBatch(batch)
+
+    def _fileCodec(self):
+        # the codec of the file's blocks; 0 for a log (or no file yet)
+        try:
+            with open(self.fname, 'rb') as f:
+                magic, version, generation = HEADER.unpack(f.read(HEADER.size))
+                head = f.read(BLOCK.size)
+        except (OSError, struct.error):
+            return 0
+        if magic != MAGIC or version != BLOCK_VERSION:
+            return 0
+        return BLOCK.unpack(head)[0] if len(head) == BLOCK.size else CODECS["zlib"]
+
+    def _readGeneration(self):
+        if not os.path.isfile(self.fname):
+            return 0
+        try:
+            with open(self.fname, 'rb') as f:
+                magic, version, generation = HEADER.unpack(f.read(HEADER.size))
+        except (OSError, struct.error):
+            return 0
+        if magic != MAGIC:
+            return 0
+        return generation
+
+    def _syncIndex(self):
+        self._migrate()
+        count = self._readIndex(update=False)
+        if count is None:
+            with self._lock():
+                count = self._readIndex(update=True)
+        return count
+
+    def _readIndex(self, update):
+        # returns the number of indexed records if the index is current;
+        # otherwise returns None, or with update brings it up to date with
+        # records appended since it was last written (rebuilding it if it
+        # belongs to another generation)
+        with open(self.fname, 'rb') as f:
+            version, generation = readVersion(f, self.fname)
+            entry = indexEntry(version)
+            size = f.seek(0, os.SEEK_END)
+            if os.path.isfile(self.iname):
+                mode = 'r+b' if update else 'rb'
+            elif update:
+                mode = 'w+b'
+            else:
+                return None
+            with open(self.iname, mode) as idx:
+                header = IDX_HEADER.pack(IDX_MAGIC, generation)
+                count = (idx.seek(0, os.SEEK_END) - IDX_HEADER.size) // entry.size
+                idx.seek(0)
+                current = count >= 0 and idx.read(IDX_HEADER.size) == header
+                if not current:
+                    count, start = 0, HEADER.size
+                elif count == 0:
+                    start = HEADER.size
+                else:
+                    idx.seek(IDX_HEADER.size + (count - 1) * entry.size)
+                    last = entry.unpack(idx.read(entry.size))[0]
+                    start = entryEnd(f, version, last)
+                if not update:
+                    return count if current and start == size else None
+                idx.seek(0)
+                idx.write(header)
+                idx.seek(IDX_HEADER.size + count * entry.size)
+                for packed in indexEntries(f, version, start, size):
+                    idx.write(packed)
+                    count += 1
+                idx.truncate()
+        return count
+
+    def _migrate(self):
+        # one-time conversion of files written by the old pickle format
+        if self._migrated:
+            return
+        if not self._isLegacy():
+            self._migrated = True
+            return
+        with self._lock():
+            if self._isLegacy():
+                with open(self.fname, 'rb') as f:
+                    arr = pickle.load(f)
+                self._rewrite(arr)
+        self._migrated = True
+
+    def _isLegacy(self):
+        with open(self.fname, 'rb') as f:
+            return f.read(len(MAGIC)) != MAGIC
+
+class _Batch:
+
+    # the appends a thread has buffered in MyDB.batch(), flushed once one
+    # of limits (count, bytes, ms) is reached
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.records = []
+        self.bytes = 0
+        self.since = None
+        self.timer = None
+
+# Read-only view of a MyDB file backed by a shared memory map. Records are
+# handed out as memoryview slices and only decoded when a string is asked
+# for; the map is replaced when the file grows, is rewritten (new
+# generation) or is swapped for another inode.
+class MyDBReader:
+
+    def __init__(self, filename):
+        self.fname = filename
+        self._map = None
+        self._key = None
+        self._generation = None
+        self._offsets = array("Q")
+        self._end = HEADER.size
+        self.refresh()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, i):
+        return self.getString(i)
+
+    def __iter__(self):
+        return self.iterStrings()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def refresh(self):
+        st = os.stat(self.fname)
+        key = (st.st_ino, st.st_size)
+        if key == self._key and HEADER.unpack_from(self._map)[2] == self._generation:
+            return False
+        with open(self.fname, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, generation = HEADER.unpack_from(m)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not an uncompressed MyDB log file" % self.fname)
+        if self._key is None or key[0] != self._key[0] or generation != self._generation:
+            self._offsets = array("Q")
+            self._end = HEADER.size
+        # views handed out earlier keep the old map alive until released
+        self._map, self._key, self._generation = m, key, generation
+        self._scan()
+        return True
+
+    def count(self):
+        self.refresh()
+        return len(self._offsets)
+
+    def getView(self, i):
+        if not -len(self._offsets) <= i < len(self._offsets):
+            self.refresh()
+        offset = self._offsets[i]
+        (length,) = RECORD.unpack_from(self._map, offset)
+        start = offset + RECORD.size
+        return memoryview(self._map)[start:start + length]
+
+    def getString(self, i):
+        return str(self.getView(i), "utf-8")
+
+    def iterViews(self):
+        self.refresh()
+        for i in range(len(self._offsets)):
+            yield self.getView(i)
+
+    def iterStrings(self):
+        for view in self.iterViews():
+            yield str(view, "utf-8")
+
+    def loadStrings(self):
+        return list(self.iterStrings())
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+
+    def _scan(self):
+        m, offset, size = self._map, self._end, len(self._map)
+        while offset + RECORD.size <= size:
+            (length,) = RECORD.unpack_from(m, offset)
+            end = offset + RECORD.size + length
+            if end > size:
+                break
+            self._offsets.append(offset)
+            offset = end
+        self._end = offset
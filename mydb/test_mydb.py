@@ -1,16 +1,115 @@
+import fcntl
+import io
 import os
+import pickle
+import sys
+import threading
+import time
 import pytest
-from mydb import MyDB
-from unittest.mock import call
+from types import SimpleNamespace
+import mydb
+from mydb import MyDB, MyDBReader, ReadCache, HEADER, MAGIC, VERSION, BLOCK, BLOCK_VERSION, CODECS, encodeBlock, encodeBlocks, IDX_HEADER, IDX_MAGIC, OFFSET, encodeRecord
+from unittest.mock import ANY, call
+
+REAL_STAT = os.stat
 
 todo = pytest.mark.skip(reason='todo: pending spec')
 
+# an in-memory stand-in for the files MyDB reads and writes, so that the
+# on-disk format can be exercised without touching the real filesystem
+class FakeFile(io.BytesIO):
+    def __init__(self, owner, name, data, mode):
+        super().__init__(data)
+        self._owner = owner
+        self._name = name
+        self._mode = mode
+
+    def close(self):
+        if not self.closed and self._mode != 'rb':
+            self._owner.files[self._name] = self.getvalue()
+            self._owner.clock += 1
+            self._owner.mtimes[self._name] = self._owner.clock
+        super().close()
+
+    def write(self, data):
+        if self._mode.startswith('a'):
+            # O_APPEND: every write lands at the end of the file
+            self.seek(0, io.SEEK_END)
+        return super().write(data)
+
+    def fileno(self):
+        return self
+
+class FakeMap(bytes):
+    def close(self):
+        return
+
+class FakeFiles():
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+        self.inodes = {}
+        self.mtimes = {}
+        self.clock = 0
+
+    def open(self, name, mode='r'):
+        if mode in ('rb', 'r+b') and name not in self.files:
+            raise FileNotFoundError(name)
+        self.inodes.setdefault(name, len(self.inodes) + 1)
+        data = b"" if mode in ('wb', 'w+b') else self.files.get(name, b"")
+        f = FakeFile(self, name, data, mode)
+        if mode.startswith('a'):
+            f.seek(0, io.SEEK_END)
+        return f
+
+    def isfile(self, name):
+        return name in self.files
+
+    def stat(self, name, **kwargs):
+        if name not in self.files:
+            # anything else (pytest's own bookkeeping) sees the real filesystem
+            return REAL_STAT(name, **kwargs)
+        self.inodes.setdefault(name, len(self.inodes) + 1)
+        return SimpleNamespace(
+            st_ino=self.inodes[name],
+            st_size=len(self.files[name]),
+            st_mtime_ns=self.mtimes.get(name, 0),
+        )
+
+    def replace(self, src, dst):
+        self.files[dst] = self.files.pop(src)
+        self.inodes[dst] = self.inodes.pop(src)
+        self.mtimes[dst] = self.mtimes.pop(src, 0)
+
+    def mmap(self, fileno, length, access=None):
+        return FakeMap(fileno.getvalue())
+
+def data_file(generation, *strings):
+    return HEADER.pack(MAGIC, VERSION, generation) + b"".join(encodeRecord(s) for s in strings)
+
+def block_file(generation, *blocks):
+    return HEADER.pack(MAGIC, BLOCK_VERSION, generation) + b"".join(
+        encodeBlock(CODECS["zlib"], [encodeRecord(s) for s in strings]) for strings in blocks)
+
+@pytest.fixture
+def fake_files(mocker):
+    files = FakeFiles()
+    files.mock_open = mocker.patch("builtins.open", side_effect=files.open)
+    mocker.patch("os.path.isfile", side_effect=files.isfile)
+    mocker.patch("os.stat", side_effect=files.stat)
+    mocker.patch("mmap.mmap", side_effect=files.mmap)
+    mocker.patch("os.replace", side_effect=files.replace)
+    files.fsync = mocker.patch("os.fsync")
+    files.flock = mocker.patch("fcntl.flock")
+    return files
+
 def describe_MyDB():
 
     @pytest.fixture(autouse=True, scope="session")
     def verify_filesystem_is_not_touched():
         yield
         assert not os.path.isfile("mydatabase.db")
+        assert not os.path.isfile("mydatabase.db.idx")
+        assert not os.path.isfile("mydatabase.db.lock")
 
     def describe_init():
         def it_assigns_fname_attribute(mocker):
@@ -18,19 +117,16 @@ def describe_MyDB():
             db = MyDB("mydatabase.db")
             assert db.fname == "mydatabase.db"
 
-        def it_creates_empty_database_if_it_does_not_exist(mocker):
-            # set up stubs & mocks first
-            mock_isfile = mocker.patch("os.path.isfile", return_value=False)
-            mock_open = mocker.patch("builtins.open", mocker.mock_open())
-            mock_dump = mocker.patch("pickle.dump")
-
+        def it_creates_empty_database_if_it_does_not_exist(fake_files):
             # execute on the test subject
-            db = MyDB("mydatabase.db")
+            MyDB("mydatabase.db")
 
             # assert what happened
-            mock_isfile.assert_called_once_with("mydatabase.db")
-            mock_open.assert_called_once_with("mydatabase.db", "wb")
-            mock_dump.assert_called_once_with([], mock_open.return_value)
+            assert fake_files.files["mydatabase.db"] == HEADER.pack(MAGIC, VERSION, 1)
+
+        def it_creates_an_empty_index_beside_the_database(fake_files):
+            MyDB("mydatabase.db")
+            assert fake_files.files["mydatabase.db.idx"] == IDX_HEADER.pack(IDX_MAGIC, 1)
 
         def it_does_not_create_database_if_it_already_exists(mocker):
             mock_isfile = mocker.patch("os.path.isfile", return_value=True)
@@ -43,33 +139,156 @@ def describe_MyDB():
             mock_isfile.assert_called_once_with("mydatabase.db")
             mock_open.assert_not_called()
             mock_dump.assert_not_called()
-    
+
     def describe_loadStrings():
-        def it_loads_an_array_from_a_file_and_returns_it(mocker):
+        def it_loads_an_array_from_a_file_and_returns_it(fake_files):
             # set up stubs & mocks first
-            mocker.patch("os.path.isfile", return_value=True)
-            mock_open = mocker.patch("builtins.open", mocker.mock_open())
-            mock_load = mocker.patch("pickle.load", return_value=["one", "two"])
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")
             db = MyDB("mydatabase.db")
 
             # execute on the test subject
             result = db.loadStrings()
 
-            print('result', result)
-
             # assert what happened
-            mock_open.assert_called_once_with("mydatabase.db", "rb")
-            mock_load.assert_called_once_with(mock_open.return_value)
             assert result == ["one", "two"]
 
-            
+        def it_ignores_a_torn_trailing_record(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")[:-1]
+            db = MyDB("mydatabase.db")
+
+            assert db.loadStrings() == ["one"]
+
+        def it_migrates_a_legacy_pickle_file_once(fake_files, mocker):
+            fake_files.files["mydatabase.db"] = b"legacy pickle"
+            mock_load = mocker.patch("pickle.load", return_value=["one", "two"])
+            db = MyDB("mydatabase.db")
+
+            db.loadStrings()
+            db.loadStrings()
+
+            mock_load.assert_called_once()
+            assert fake_files.files["mydatabase.db"] == data_file(1, "one", "two")
+
+        def it_serves_repeat_loads_from_the_cache(fake_files, mocker):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            db = MyDB("mydatabase.db", cache=ReadCache())
+            db.loadStrings()
+            spy_iter = mocker.spy(db, "iterStrings")
+
+            result = db.loadStrings()
+
+            assert result == ["one"]
+            spy_iter.assert_not_called()
+
+        def it_rereads_after_the_file_changes(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            db = MyDB("mydatabase.db", cache=ReadCache())
+            db.loadStrings()
+
+            db.saveString("two")
+
+            assert db.loadStrings() == ["one", "two"]
+
+        def it_hands_out_a_copy_of_the_cached_list(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            db = MyDB("mydatabase.db", cache=ReadCache())
+
+            db.loadStrings().append("mutated")
+
+            assert db.loadStrings() == ["one"]
+
+        def it_charges_the_cache_for_the_decoded_strings(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["squirrel"] * 100)
+            cache = ReadCache()
+            db = MyDB("mydatabase.db", cache=cache)
+
+            db.loadStrings()
+
+            assert cache.bytes > 100 * sys.getsizeof("squirrel")
+
+        def it_counts_hits_and_misses(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            cache = ReadCache()
+            db = MyDB("mydatabase.db", cache=cache)
+
+            db.loadStrings()
+            db.loadStrings()
+
+            assert (cache.hits, cache.misses) == (1, 1)
+
+    def describe_iterStrings():
+        def it_yields_each_stored_string(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")
+            db = MyDB("mydatabase.db")
+
+            assert list(db.iterStrings()) == ["one", "two"]
+
+        def it_does_not_touch_the_index(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            db = MyDB("mydatabase.db")
+
+            list(db.iterStrings())
+
+            assert "mydatabase.db.idx" not in fake_files.files
+
+    def describe_getString():
+        def it_returns_the_string_at_the_given_position(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two", "three")
+            db = MyDB("mydatabase.db")
+
+            assert db.getString(1) == "two"
+
+        def it_supports_negative_positions(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two", "three")
+            db = MyDB("mydatabase.db")
+
+            assert db.getString(-1) == "three"
+
+        def it_raises_index_error_past_the_end(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            db = MyDB("mydatabase.db")
+
+            with pytest.raises(IndexError):
+                db.getString(1)
+
+        def it_sees_strings_appended_after_the_index_was_built(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            db = MyDB("mydatabase.db")
+            db.getString(0)
+
+            db.saveString("two")
+
+            assert db.getString(1) == "two"
+
+    def describe_count():
+        def it_returns_the_number_of_stored_strings(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")
+            db = MyDB("mydatabase.db")
+
+            assert db.count() == 2
+
+        def it_writes_one_offset_per_record_to_the_index(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")
+            db = MyDB("mydatabase.db")
+
+            db.count()
+
+            assert fake_files.files["mydatabase.db.idx"] == (
+                IDX_HEADER.pack(IDX_MAGIC, 1)
+                + OFFSET.pack(HEADER.size)
+                + OFFSET.pack(HEADER.size + len(encodeRecord("one")))
+            )
+
+        def it_rebuilds_an_index_from_another_generation(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(2, "one", "two")
+            fake_files.files["mydatabase.db.idx"] = IDX_HEADER.pack(IDX_MAGIC, 1) + OFFSET.pack(0)
+            db = MyDB("mydatabase.db")
+
+            assert db.count() == 2
 
     def describe_saveStrings():
-        def it_saves_the_given_array_to_a_file(mocker):
+        def it_saves_the_given_array_to_a_file(fake_files):
             # set up stubs & mocks first
-            mocker.patch("os.path.isfile", return_value=True)
-            mock_open = mocker.patch("builtins.open", mocker.mock_open())
-            mock_dump = mocker.patch("pickle.dump")
             db = MyDB("mydatabase.db")
 
             # execute on the test subject
@@ -77,20 +296,427 @@ def describe_MyDB():
             db.saveStrings(test_data)
 
             # assert what happened
-            mock_open.assert_called_once_with("mydatabase.db", "wb")
-            mock_dump.assert_called_once_with(test_data, mock_open.return_value)
-    
+            assert fake_files.files["mydatabase.db"] == data_file(2, "hello", "world")
+
+        def it_bumps_the_generation_of_an_existing_file(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(4, "one")
+            db = MyDB("mydatabase.db")
+
+            db.saveStrings([])
+
+            assert fake_files.files["mydatabase.db"] == data_file(5)
+
+        def it_replaces_the_file_atomically_under_an_exclusive_lock(fake_files, mocker):
+            db = MyDB("mydatabase.db")
+            mock_replace = mocker.patch("os.replace", side_effect=fake_files.replace)
+
+            db.saveStrings(["hello"])
+
+            fake_files.flock.assert_has_calls([call(ANY, fcntl.LOCK_EX), call(ANY, fcntl.LOCK_UN)])
+            mock_replace.assert_any_call("mydatabase.db.tmp", "mydatabase.db")
+            assert "mydatabase.db.tmp" not in fake_files.files
+
+        def it_writes_a_matching_index(fake_files):
+            db = MyDB("mydatabase.db")
+
+            db.saveStrings(["hello"])
+
+            assert fake_files.files["mydatabase.db.idx"] == IDX_HEADER.pack(IDX_MAGIC, 2) + OFFSET.pack(HEADER.size)
+
     def describe_saveString():
-        def it_appends_string_element_to_existing_database(mocker):
+        def it_appends_only_the_new_record(fake_files, mocker):
             # set up stubs & mocks first
-            mocker.patch("os.path.isfile", return_value=True) # so __init__ is a no-op
+            fake_files.files["mydatabase.db"] = data_file(1, "existing string")
             db = MyDB("mydatabase.db")
-            mock_load = mocker.patch.object(db, "loadStrings", return_value=["existing string"])
+            mock_load = mocker.patch.object(db, "loadStrings")
             mock_save = mocker.patch.object(db, "saveStrings")
 
             # execute on the test subject
             db.saveString("new string")
 
             # assert what happened
-            mock_load.assert_called_once_with()
-            mock_save.assert_called_once_with(["existing string", "new string"])
+            assert fake_files.files["mydatabase.db"] == data_file(1, "existing string", "new string")
+            mock_load.assert_not_called()
+            mock_save.assert_not_called()
+
+        def it_holds_a_shared_lock_while_appending(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+
+            db.saveString("new string")
+
+            fake_files.flock.assert_has_calls([call(ANY, fcntl.LOCK_SH), call(ANY, fcntl.LOCK_UN)])
+
+        def it_drops_a_torn_trailing_record_before_appending(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")[:-1]
+            db = MyDB("mydatabase.db")
+
+            db.saveString("three")
+            db.saveString("four")
+
+            assert fake_files.files["mydatabase.db"] == data_file(1, "one", "three", "four")
+
+        def it_checks_the_tail_from_the_end_of_the_index(fake_files, mocker):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")
+            MyDB("mydatabase.db").count()
+            complete_end = mocker.spy(mydb, "completeEnd")
+
+            MyDB("mydatabase.db").saveString("three")
+
+            assert complete_end.call_args.args[2] == len(data_file(1, "one", "two"))
+            assert fake_files.files["mydatabase.db"] == data_file(1, "one", "two", "three")
+
+        def it_takes_the_exclusive_lock_to_drop_a_torn_record(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")[:-1]
+            db = MyDB("mydatabase.db")
+
+            db.saveString("three")
+
+            fake_files.flock.assert_has_calls([call(ANY, fcntl.LOCK_SH), call(ANY, fcntl.LOCK_UN), call(ANY, fcntl.LOCK_EX)])
+
+        def it_does_not_lock_when_locking_is_off(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db", locking=False)
+
+            db.saveString("new string")
+
+            fake_files.flock.assert_not_called()
+            assert "mydatabase.db.lock" not in fake_files.files
+
+    def describe_saveStrings_bulk():
+        def it_appends_every_string_with_a_single_write(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            db = MyDB("mydatabase.db")
+
+            db.saveStrings_bulk(["two", "three"])
+
+            assert fake_files.mock_open.call_args_list.count(call("mydatabase.db", "a+b")) == 1
+            assert fake_files.files["mydatabase.db"] == data_file(1, "one", "two", "three")
+
+        def it_fsyncs_once_per_flush(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+
+            db.saveStrings_bulk(["one", "two", "three"])
+
+            fake_files.fsync.assert_called_once()
+
+        def it_flushes_when_the_count_threshold_is_reached(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+
+            db.saveStrings_bulk(["one", "two", "three"], maxCount=2)
+
+            assert fake_files.fsync.call_count == 2
+
+        def it_flushes_when_the_byte_threshold_is_reached(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+
+            db.saveStrings_bulk(["one", "two"], maxBytes=1)
+
+            assert fake_files.fsync.call_count == 2
+
+        def it_flushes_when_the_time_threshold_is_reached(fake_files, mocker):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+            mocker.patch("time.monotonic", side_effect=[0.0, 0.001, 0.002, 0.020])
+
+            db.saveStrings_bulk(["one", "two"], maxMs=10)
+
+            assert fake_files.fsync.call_count == 1
+            assert db.loadStrings() == ["one", "two"]
+
+    def describe_batch():
+        def it_buffers_appends_until_the_block_exits(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+
+            with db.batch():
+                db.saveString("one")
+                assert fake_files.files["mydatabase.db"] == data_file(1)
+
+            assert fake_files.files["mydatabase.db"] == data_file(1, "one")
+
+        def it_flushes_a_batch_left_idle_past_the_time_threshold(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+
+            with db.batch(maxMs=1):
+                db.saveString("one")
+                deadline = time.monotonic() + 1
+                while not fake_files.fsync.called and time.monotonic() < deadline:
+                    time.sleep(0.001)
+                assert fake_files.files["mydatabase.db"] == data_file(1, "one")
+
+            fake_files.fsync.assert_called_once()
+
+        def it_joins_an_enclosing_batch(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+
+            with db.batch():
+                with db.batch():
+                    db.saveString("one")
+                db.saveString("two")
+
+            fake_files.fsync.assert_called_once()
+
+        def it_keeps_the_batches_of_other_threads_apart(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+
+            with db.batch():
+                db.saveString("one")
+                other = threading.Thread(target=db.saveStrings_bulk, args=(["two"],))
+                other.start()
+                other.join()
+                assert fake_files.files["mydatabase.db"] == data_file(1, "two")
+
+            assert fake_files.files["mydatabase.db"] == data_file(1, "two", "one")
+
+        def it_drops_buffered_appends_superseded_by_saveStrings(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1)
+            db = MyDB("mydatabase.db")
+
+            with db.batch():
+                db.saveString("one")
+                db.saveStrings(["two"])
+
+            assert db.loadStrings() == ["two"]
+
+    def describe_compact():
+        def it_drops_a_torn_trailing_record(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")[:-1]
+            db = MyDB("mydatabase.db")
+
+            db.compact()
+
+            assert fake_files.files["mydatabase.db"] == data_file(2, "one")
+
+        def it_migrates_a_legacy_file_under_a_real_lock(tmp_path):
+            path = str(tmp_path / "legacy.db")
+            with open(path, 'wb') as f:
+                pickle.dump(["one", "two"], f)
+            db = MyDB(path)
+
+            compacting = threading.Thread(target=db.compact, daemon=True)
+            compacting.start()
+            compacting.join(5)
+
+            assert not compacting.is_alive()
+            assert db.loadStrings() == ["one", "two"]
+
+    def describe_block_format():
+        def it_rejects_an_unknown_compression():
+            with pytest.raises(ValueError):
+                MyDB("mydatabase.db", compression="snappy")
+
+        def it_writes_compressed_blocks_when_compression_is_set(fake_files):
+            db = MyDB("mydatabase.db", compression="zlib")
+
+            db.saveStrings(["one", "two"])
+
+            assert fake_files.files["mydatabase.db"] == block_file(2, ["one", "two"])
+
+        def it_loads_strings_from_every_block(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["one", "two"], ["three"])
+            db = MyDB("mydatabase.db")
+
+            assert db.loadStrings() == ["one", "two", "three"]
+
+        def it_reads_a_single_string_from_its_block(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["one", "two"], ["three"])
+            db = MyDB("mydatabase.db")
+
+            assert (db.count(), db.getString(1), db.getString(2)) == (3, "two", "three")
+
+        def it_skips_a_block_whose_checksum_does_not_match(fake_files):
+            data = bytearray(block_file(1, ["one"], ["two"]))
+            data[HEADER.size + BLOCK.size] ^= 0xff
+            fake_files.files["mydatabase.db"] = bytes(data)
+            db = MyDB("mydatabase.db")
+
+            assert db.loadStrings() == ["two"]
+
+        def it_ignores_a_torn_trailing_block(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["one"], ["two"])[:-1]
+            db = MyDB("mydatabase.db")
+
+            assert (db.loadStrings(), db.count()) == (["one"], 1)
+
+        def it_appends_to_a_block_file_as_a_new_block(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["one"])
+            db = MyDB("mydatabase.db")
+
+            db.saveString("two")
+
+            assert fake_files.files["mydatabase.db"] == block_file(1, ["one"], ["two"])
+
+        def it_drops_a_torn_trailing_block_before_appending(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["one"], ["two"])[:-1]
+            db = MyDB("mydatabase.db")
+
+            db.saveString("three")
+
+            assert db.loadStrings() == ["one", "three"]
+
+        def it_merges_small_appended_blocks_once_they_fill_half_the_file(fake_files, mocker):
+            mocker.patch("mydb.BLOCK_BYTES", 200)
+            fake_files.files["mydatabase.db"] = block_file(1, ["one"])
+            db = MyDB("mydatabase.db")
+
+            for i in range(20):
+                db.saveString("string %d" % i)
+
+            assert db.loadStrings() == ["one"] + ["string %d" % i for i in range(20)]
+            assert len(fake_files.files["mydatabase.db"]) < len(block_file(1, ["one"], *[["string %d" % i] for i in range(20)]))
+
+        def it_keeps_the_block_format_when_merging(fake_files, mocker):
+            mocker.patch("mydb.BLOCK_BYTES", 10)
+            fake_files.files["mydatabase.db"] = block_file(1, ["one"])
+            db = MyDB("mydatabase.db")
+
+            db.saveString("two")
+            db.saveString("three")
+
+            assert fake_files.files["mydatabase.db"] == block_file(2, ["one", "two", "three"])
+
+        def it_keeps_the_block_format_on_compact(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["one"], ["two"])
+            db = MyDB("mydatabase.db")
+
+            db.compact()
+
+            assert fake_files.files["mydatabase.db"] == block_file(2, ["one", "two"])
+
+        def it_keeps_the_block_format_on_saveStrings(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["one"])
+            db = MyDB("mydatabase.db")
+
+            db.saveStrings(["two"])
+
+            assert fake_files.files["mydatabase.db"] == block_file(2, ["two"])
+
+        def it_converts_to_the_log_format_when_asked(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["one"], ["two"])
+            db = MyDB("mydatabase.db", compression="none")
+
+            db.compact()
+
+            assert fake_files.files["mydatabase.db"] == data_file(2, "one", "two")
+
+    def describe_open_readonly():
+        def it_returns_a_reader_for_the_file(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+
+            reader = MyDB.open_readonly("mydatabase.db")
+
+            assert isinstance(reader, MyDBReader)
+            assert reader.fname == "mydatabase.db"
+
+        def it_rejects_files_that_are_not_in_the_log_format(fake_files):
+            fake_files.files["mydatabase.db"] = b"legacy pickle data"
+
+            with pytest.raises(ValueError):
+                MyDB.open_readonly("mydatabase.db")
+
+        def it_rejects_block_format_files(fake_files):
+            fake_files.files["mydatabase.db"] = block_file(1, ["one"])
+
+            with pytest.raises(ValueError):
+                MyDB.open_readonly("mydatabase.db")
+
+def describe_MyDBReader():
+
+    def describe_getView():
+        def it_returns_a_memoryview_of_the_record_bytes(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")
+            reader = MyDBReader("mydatabase.db")
+
+            view = reader.getView(1)
+
+            assert isinstance(view, memoryview)
+            assert view == b"two"
+
+    def describe_getString():
+        def it_decodes_the_record_at_the_given_position(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "tw\u00f6")
+            reader = MyDBReader("mydatabase.db")
+
+            assert reader.getString(1) == "tw\u00f6"
+
+        def it_remaps_when_asked_for_a_record_appended_since_opening(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            reader = MyDBReader("mydatabase.db")
+
+            fake_files.files["mydatabase.db"] += encodeRecord("two")
+
+            assert reader.getString(1) == "two"
+
+        def it_raises_index_error_past_the_end(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            reader = MyDBReader("mydatabase.db")
+
+            with pytest.raises(IndexError):
+                reader.getString(1)
+
+    def describe_refresh():
+        def it_does_not_remap_an_unchanged_file(fake_files, mocker):
+            fake_files.files["mydatabase.db"] = data_file(1, "one")
+            reader = MyDBReader("mydatabase.db")
+            mock_mmap = mocker.patch("mmap.mmap")
+
+            assert reader.refresh() is False
+            mock_mmap.assert_not_called()
+
+        def it_reindexes_after_a_rewrite(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")
+            reader = MyDBReader("mydatabase.db")
+
+            fake_files.files["mydatabase.db"] = data_file(2, "three", "four")
+
+            assert reader.refresh() is True
+            assert reader.loadStrings() == ["three", "four"]
+
+    def describe_count():
+        def it_ignores_a_torn_trailing_record(fake_files):
+            fake_files.files["mydatabase.db"] = data_file(1, "one", "two")[:-1]
+            reader = MyDBReader("mydatabase.db")
+
+            assert reader.count() == 1
+
+def describe_encodeBlocks():
+
+    def it_starts_a_new_block_once_the_size_target_is_reached():
+        records = [encodeRecord(s) for s in ["one", "two", "three"]]
+
+        blocks = list(encodeBlocks(records, CODECS["zlib"], blockBytes=len(records[0]) + 1))
+
+        assert [BLOCK.unpack_from(b)[1] for b in blocks] == [2, 1]
+
+def describe_ReadCache():
+
+    def it_evicts_the_least_recently_used_entry_past_its_byte_budget():
+        cache = ReadCache(maxBytes=10)
+        cache.put("a", 1, ["a"], 4)
+        cache.put("b", 1, ["b"], 4)
+        cache.get("a", 1)
+
+        cache.put("c", 1, ["c"], 4)
+
+        assert cache.get("b", 1) is None
+        assert cache.get("a", 1) == ["a"]
+
+    def it_does_not_keep_entries_larger_than_its_budget():
+        cache = ReadCache(maxBytes=10)
+
+        cache.put("a", 1, ["a"], 11)
+
+        assert cache.stats()["entries"] == 0
+
+    def it_misses_when_the_stat_key_changed():
+        cache = ReadCache()
+        cache.put("a", (1, 2, 3), ["a"], 1)
+
+        assert cache.get("a", (2, 2, 3)) is None
@@ -0,0 +1,474 @@
+# Benchmarks for the squirrel server.
+#
+# keepalive: requests/sec for GET /squirrels when every request opens a new
+# connection (HTTP/1.0, the behaviour before keep-alive) against requests
+# reusing one persistent HTTP/1.1 connection per client.
+#
+# rows: time to fetch and encode a whole table of 10k/100k squirrels with the
+# original per-row dict_factory + json.dumps, with getSquirrels (column names
+# once per statement) + encodeJson, and with the JSON text SQLite builds for
+# the listing endpoints.
+#
+# load: a mixed GET/POST/PUT/DELETE workload against a server seeded with
+# --rows squirrels, at each --concurrency level (client threads, spread over
+# --processes client processes). Reports requests/sec and p50/p95/p99
+# latency; --baseline compares against the JSON lines of an earlier run and
+# exits 1 when throughput or p99 got worse by more than --tolerance.
+# --server-processes runs the server pre-forked over that many processes;
+# --group-commit N commits up to N concurrent writes in one fsynced
+# (synchronous=full) transaction; compare it with --pragma synchronous=full.
+#
+# compression: bytes on the wire and CPU per request for GET /squirrels sent
+# as is, gzip and deflate, with the response cache keeping the compressed
+# body and with it off, so that every request compresses while streaming.
+#
+#   python bench_squirrel.py keepalive --clients 4 --requests 2000 --mode threaded
+#   python bench_squirrel.py rows --rows 10000 100000
+#   python bench_squirrel.py compression --rows 1000 10000
+#   python bench_squirrel.py load --concurrency 1 4 16 --mix get=60,list=10,create=10,update=10,delete=10
+#   python bench_squirrel.py load --concurrency 4 16 --backend memory
+#   python bench_squirrel.py load --concurrency 16 --processes 4 --server-processes 4
+#   python bench_squirrel.py load --concurrency 16 --mix create=50,update=50 --pragma synchronous=full --group-commit 16
+#   python bench_squirrel.py load --concurrency 4 16 > before.jsonl
+#   python bench_squirrel.py load --concurrency 4 16 --baseline before.jsonl
+
+import argparse
+import asyncio
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from squirrel_db import ConnectionPool, SquirrelDB, configurePool, closePool, DB_PATH
+from squirrel_server import SquirrelServerHandler, SquirrelHTTPServer, ResponseCache, PooledHTTPServer, AsyncSquirrelServer, PreforkSupervisor, openBackend, listenSocket, serve, BACKENDS, MODES, WORKERS, QUEUE_SIZE, encodeJson, joinJson
+
+class QuietHandler(SquirrelServerHandler):
+
+    def log_message(self, format, *args):
+        return
+
+def startServer(mode, workers, backend=None, handlerClass=QuietHandler):
+    # serves on an ephemeral port in a background thread; returns the port
+    # and a function that stops the server
+    if mode == "async":
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        server = AsyncSquirrelServer(("127.0.0.1", port), handlerClass, workers, QUEUE_SIZE, backend)
+        loop = asyncio.new_event_loop()
+        stop = asyncio.Event()
+        thread = threading.Thread(target=loop.run_until_complete, args=(server.serve(stop),), daemon=True)
+        thread.start()
+        time.sleep(0.2)
+        def shutdown():
+            loop.call_soon_threadsafe(stop.set)
+            thread.join()
+        return port, shutdown
+    if mode == "threaded":
+        server = PooledHTTPServer(("127.0.0.1", 0), handlerClass, workers, QUEUE_SIZE, backend)
+    else:
+        server = SquirrelHTTPServer(("127.0.0.1", 0), handlerClass, backend)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    def shutdown():
+        server.shutdown()
+        server.server_close()
+    return server.server_address[1], shutdown
+
+def serveForked(mode, port, workers, groupCommit, sock):
+    store = openBackend("sqlite", groupCommit=groupCommit)
+    try:
+        serve(mode, ("127.0.0.1", port), store, workers, QUEUE_SIZE, sock, QuietHandler)
+    finally:
+        store.shutdown()
+
+def startPrefork(mode, workers, processes, groupCommit=0):
+    # a supervisor process forking processes servers over one socket on an
+    # ephemeral port; they use the pool configured in this process, which
+    # has no connections open yet
+    sock = listenSocket(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    worker = lambda sock: serveForked(mode, port, workers, groupCommit, sock)
+    supervisor = multiprocessing.get_context("fork").Process(target=PreforkSupervisor(sock, processes, worker).run)
+    supervisor.start()
+    def shutdown():
+        os.kill(supervisor.pid, signal.SIGTERM)
+        supervisor.join()
+        sock.close()
+    return port, shutdown
+
+def newConnectionClient(port, n):
+    for _ in range(n):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        conn.request("GET", "/squirrels", headers={"Connection": "close"})
+        conn.getresponse().read()
+        conn.close()
+
+def keepAliveClient(port, n):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    for _ in range(n):
+        conn.request("GET", "/squirrels")
+        conn.getresponse().read()
+    conn.close()
+
+def drive(client, port, clients, perClient):
+    threads = [threading.Thread(target=client, args=(port, perClient)) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def keepalive(mode, clients, perClient, workers=WORKERS):
+    with tempfile.TemporaryDirectory() as tmp:
+        dbPath = os.path.join(tmp, "bench.db")
+        shutil.copy(DB_PATH, dbPath)
+        configurePool(dbPath, max(workers, clients))
+        port, shutdown = startServer(mode, workers)
+        try:
+            results = []
+            for name, client in (("new_connection", newConnectionClient), ("keep_alive", keepAliveClient)):
+                elapsed = drive(client, port, clients, perClient)
+                results.append({
+                    "mode": mode,
+                    "connections": name,
+                    "clients": clients,
+                    "requests": clients * perClient,
+                    "seconds": round(elapsed, 3),
+                    "requests_per_sec": round(clients * perClient / elapsed, 1),
+                })
+            return results
+        finally:
+            shutdown()
+            closePool()
+
+def legacyDictFactory(cursor, row):
+    # dict_factory as it was: a description lookup for every field of every row
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+def rows(counts, repeat=3):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in counts:
+            pool = ConnectionPool(os.path.join(tmp, "rows%d.db" % n), size=1)
+            with SquirrelDB(pool) as db:
+                db.bulkCreateSquirrels(("squirrel%d" % i, ("small", "large")[i % 2]) for i in range(n))
+
+                def legacyFetch():
+                    cursor = db.connection.cursor()
+                    cursor.row_factory = legacyDictFactory
+                    cursor.execute("SELECT * FROM squirrels ORDER BY id")
+                    return cursor.fetchall()
+
+                paths = (
+                    ("legacy", legacyFetch, lambda value: bytes(json.dumps(value), "utf-8")),
+                    ("dicts", db.getSquirrels, encodeJson),
+                    ("sqlite_json", db.querySquirrelsJson, lambda value: b"[" + joinJson(value) + b"]"),
+                )
+                for name, fetch, encode in paths:
+                    fetchSeconds = encodeSeconds = float("inf")
+                    for _ in range(repeat):
+                        elapsed, value = timed(fetch)
+                        fetchSeconds = min(fetchSeconds, elapsed)
+                        elapsed, body = timed(lambda: encode(value))
+                        encodeSeconds = min(encodeSeconds, elapsed)
+                    results.append({
+                        "path": name,
+                        "rows": n,
+                        "fetch_seconds": round(fetchSeconds, 4),
+                        "encode_seconds": round(encodeSeconds, 4),
+                        "rows_per_sec": round(n / (fetchSeconds + encodeSeconds), 1),
+                        "bytes": len(body),
+                    })
+            pool.close()
+    return results
+
+def wireBytes(port, path, coding):
+    # every byte of one response: headers, chunk framing and body
+    headers = "Accept-Encoding: %s\r\n" % coding if coding else ""
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(("GET %s HTTP/1.1\r\nHost: bench\r\n%sConnection: close\r\n\r\n" % (path, headers)).encode())
+    total = 0
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        total += len(data)
+    sock.close()
+    return total
+
+def compression(counts, requests=200, workers=WORKERS):
+    # cpu_ms_per_request is the CPU time of this process, server and client
+    # together, so it is the difference between codings that counts
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in counts:
+            dbPath = os.path.join(tmp, "compression%d.db" % n)
+            seed(dbPath, n)
+            configurePool(dbPath, workers)
+            for cached in (True, False):
+                # with ttl=0 every entry has expired by the time it is read
+                handler = type("CompressionHandler", (QuietHandler,), {"cache": ResponseCache() if cached else ResponseCache(ttl=0)})
+                port, shutdown = startServer("threaded", workers, handlerClass=handler)
+                try:
+                    for coding in (None, "gzip", "deflate"):
+                        headers = {"Accept-Encoding": coding} if coding else {}
+                        wire = wireBytes(port, "/squirrels", coding)
+                        conn = http.client.HTTPConnection("127.0.0.1", port)
+                        cpu, start = time.process_time(), time.perf_counter()
+                        for _ in range(requests):
+                            conn.request("GET", "/squirrels", headers=headers)
+                            conn.getresponse().read()
+                        cpu, elapsed = time.process_time() - cpu, time.perf_counter() - start
+                        conn.close()
+                        results.append({
+                            "benchmark": "compression",
+                            "rows": n,
+                            "coding": coding or "identity",
+                            "cached": cached,
+                            "wire_bytes": wire,
+                            "requests": requests,
+                            "requests_per_sec": round(requests / elapsed, 1),
+                            "cpu_ms_per_request": round(cpu / requests * 1000, 3),
+                        })
+                finally:
+                    shutdown()
+            closePool()
+    return results
+
+# share of each operation in the load workload
+MIX = {"get": 50, "list": 20, "create": 10, "update": 10, "delete": 10}
+LATENCY_PERCENTILES = (50, 95, 99)
+
+def parseMix(text):
+    mix = {}
+    for part in text.split(","):
+        op, weight = part.split("=")
+        if op not in MIX:
+            raise argparse.ArgumentTypeError("unknown operation %r; expected one of %s" % (op, ", ".join(MIX)))
+        mix[op] = int(weight)
+    return mix
+
+def loadRequest(op, rng, rows):
+    # method, path and body for one operation on a random seeded squirrel;
+    # ids deleted earlier in the run answer 404, which is counted, not an error
+    squirrelId = rng.randint(1, rows)
+    body = json.dumps({"name": "squirrel%d" % rng.randrange(rows), "size": rng.choice(("small", "large"))})
+    if op == "list":
+        return "GET", "/squirrels?limit=20&after_id=%d" % squirrelId, None
+    if op == "get":
+        return "GET", "/squirrels/%d" % squirrelId, None
+    if op == "create":
+        return "POST", "/squirrels", body
+    if op == "update":
+        return "PUT", "/squirrels/%d" % squirrelId, body
+    return "DELETE", "/squirrels/%d" % squirrelId, None
+
+def loadClient(port, n, mix, rows, seed):
+    rng = random.Random(seed)
+    ops, weights = list(mix), list(mix.values())
+    latencies, statuses = [], Counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    for op in rng.choices(ops, weights, k=n):
+        method, path, body = loadRequest(op, rng, rows)
+        headers = {"Content-Type": "application/json"} if body else {}
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            status = str(response.status)
+            if response.will_close:
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            status = "error"
+            conn.close()
+        latencies.append(time.perf_counter() - start)
+        statuses[status] += 1
+    conn.close()
+    return latencies, statuses
+
+def loadClients(port, clients, perClient, mix, rows, seed):
+    # runs clients threads in this process and pools what they measured
+    results = [None] * clients
+    def client(i):
+        results[i] = loadClient(port, perClient, mix, rows, seed + i)
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies, statuses = [], Counter()
+    for clientLatencies, clientStatuses in results:
+        latencies.extend(clientLatencies)
+        statuses.update(clientStatuses)
+    return latencies, statuses
+
+def percentile(ordered, p):
+    # nearest rank
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+def latencySummary(latencies):
+    ordered = sorted(latencies)
+    summary = {"p%d_ms" % p: round(percentile(ordered, p) * 1000, 3) for p in LATENCY_PERCENTILES}
+    summary["max_ms"] = round(ordered[-1] * 1000, 3)
+    return summary
+
+def seed(dbPath, rows):
+    pool = ConnectionPool(dbPath, size=1)
+    with SquirrelDB(pool) as db:
+        db.bulkCreateSquirrels(("squirrel%d" % i, ("small", "large")[i % 2]) for i in range(rows))
+    pool.close()
+
+def load(mode, levels, perClient, mix, rows=1000, processes=1, workers=WORKERS, seedValue=0, backend="sqlite", serverProcesses=1, groupCommit=0, pragmas=None):
+    if serverProcesses > 1 and backend != "sqlite":
+        raise ValueError("the %s backend cannot be shared by several processes" % backend)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for concurrency in levels:
+            # every level starts from the same freshly seeded database
+            dbPath = os.path.join(tmp, "load%d.db" % concurrency)
+            seed(dbPath, rows)
+            configurePool(dbPath, max(workers, concurrency) + 1, pragmas=pragmas)
+            if serverProcesses > 1:
+                store = None
+                port, shutdown = startPrefork(mode, workers, serverProcesses, groupCommit)
+            else:
+                store = openBackend(backend, groupCommit=groupCommit)
+                port, shutdown = startServer(mode, workers, store)
+            try:
+                shares = [concurrency // processes + (i < concurrency % processes) for i in range(processes)]
+                jobs = [(port, clients, perClient, mix, rows, seedValue + 1000 * i) for i, clients in enumerate(shares) if clients]
+                if processes > 1:
+                    with multiprocessing.Pool(len(jobs)) as pool:
+                        start = time.perf_counter()
+                        measured = pool.starmap(loadClients, jobs)
+                        elapsed = time.perf_counter() - start
+                else:
+                    start = time.perf_counter()
+                    measured = [loadClients(*jobs[0])]
+                    elapsed = time.perf_counter() - start
+            finally:
+                shutdown()
+                if store is not None:
+                    store.shutdown()
+                closePool()
+            latencies, statuses = [], Counter()
+            for jobLatencies, jobStatuses in measured:
+                latencies.extend(jobLatencies)
+                statuses.update(jobStatuses)
+            result = {
+                "benchmark": "load",
+                "mode": mode,
+                "backend": backend,
+                "concurrency": concurrency,
+                "processes": processes,
+                "server_processes": serverProcesses,
+                "group_commit": groupCommit,
+                "pragmas": ",".join("%s=%s" % item for item in sorted((pragmas or {}).items())),
+                "mix": ",".join("%s=%d" % item for item in sorted(mix.items())),
+                "rows": rows,
+                "requests": len(latencies),
+                "seconds": round(elapsed, 3),
+                "requests_per_sec": round(len(latencies) / elapsed, 1),
+            }
+            result.update(latencySummary(latencies))
+            result["statuses"] = dict(sorted(statuses.items()))
+            result["errors"] = sum(n for status, n in statuses.items() if status == "error" or status >= "500")
+            results.append(result)
+    return results
+
+# results from another run are matched on these fields
+LOAD_KEYS = ("benchmark", "mode", "backend", "concurrency", "processes", "server_processes", "group_commit", "pragmas", "mix", "rows")
+# compared metric and whether a bigger value is better
+LOAD_METRICS = {"requests_per_sec": True, "p99_ms": False}
+
+def compareRuns(results, baselinePath, keys, metrics, tolerance):
+    # adds "baseline" and "regressions" to each result that has a match in
+    # the baseline file; returns the number of regressions found
+    with open(baselinePath) as f:
+        baseline = [json.loads(line) for line in f if line.strip()]
+    previous = {tuple(entry.get(key) for key in keys): entry for entry in baseline}
+    regressions = 0
+    for result in results:
+        before = previous.get(tuple(result.get(key) for key in keys))
+        if before is None:
+            continue
+        result["baseline"] = {metric: before[metric] for metric in metrics}
+        worse = []
+        for metric, higherIsBetter in metrics.items():
+            change = (result[metric] - before[metric]) / before[metric] if before[metric] else 0.0
+            if (-change if higherIsBetter else change) > tolerance:
+                worse.append(metric)
+        result["regressions"] = worse
+        regressions += len(worse)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    keepaliveArgs = commands.add_parser("keepalive")
+    keepaliveArgs.add_argument("--mode", choices=MODES, default="threaded")
+    keepaliveArgs.add_argument("--clients", type=int, default=4)
+    keepaliveArgs.add_argument("--requests", type=int, default=1000, help="requests per client")
+    keepaliveArgs.add_argument("--workers", type=int, default=WORKERS)
+    rowsArgs = commands.add_parser("rows")
+    rowsArgs.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    rowsArgs.add_argument("--repeat", type=int, default=3)
+    loadArgs = commands.add_parser("load")
+    loadArgs.add_argument("--mode", choices=MODES, default="threaded")
+    loadArgs.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    loadArgs.add_argument("--processes", type=int, default=1, help="client processes the concurrency is spread over")
+    loadArgs.add_argument("--requests", type=int, default=500, help="requests per client")
+    loadArgs.add_argument("--mix", type=parseMix, default=MIX, help="e.g. get=50,list=20,create=10,update=10,delete=10")
+    loadArgs.add_argument("--rows", type=int, default=1000, help="squirrels seeded before each level")
+    loadArgs.add_argument("--workers", type=int, default=WORKERS)
+    loadArgs.add_argument("--backend", choices=BACKENDS, default="sqlite")
+    loadArgs.add_argument("--server-processes", type=int, default=1, help="pre-forked server processes (sqlite backend only)")
+    loadArgs.add_argument("--group-commit", type=int, default=0, help="writes committed together at most (sqlite backend; 0 = one each)")
+    loadArgs.add_argument("--pragma", action="append", default=[], metavar="NAME=VALUE", help="SQLite pragma for the server's connections")
+    loadArgs.add_argument("--seed", type=int, default=0)
+    loadArgs.add_argument("--baseline", help="JSON lines from an earlier load run to compare against")
+    loadArgs.add_argument("--tolerance", type=float, default=0.1, help="allowed relative change before it counts as a regression")
+    compressionArgs = commands.add_parser("compression")
+    compressionArgs.add_argument("--rows", type=int, nargs="+", default=[1000, 10000])
+    compressionArgs.add_argument("--requests", type=int, default=200, help="requests per coding")
+    compressionArgs.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args(argv)
+
+    regressions = 0
+    if args.command == "rows":
+        results = rows(args.rows, args.repeat)
+    elif args.command == "compression":
+        results = compression(args.rows, args.requests, args.workers)
+    elif args.command == "load":
+        results = load(args.mode, args.concurrency, args.requests, args.mix, args.rows, args.processes, args.workers, args.seed, args.backend, args.server_processes, args.group_commit,
+                       dict(pragma.split("=", 1) for pragma in args.pragma))
+        if args.baseline:
+            regressions = compareRuns(results, args.baseline, LOAD_KEYS, LOAD_METRICS, args.tolerance)
+    else:
+        results = keepalive(args.mode, args.clients, args.requests, args.workers)
+    for result in results:
+        print(json.dumps(result))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
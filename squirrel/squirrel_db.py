@@ -1,41 +1,673 @@
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from squirrel_metrics import METRICS
+
+DB_PATH = "squirrel_db.db"
+POOL_SIZE = 8
+POOL_TIMEOUT = 5.0
+# connections idle for longer than this are pinged before being handed out
+HEALTH_CHECK_AFTER = 30.0
+# rows fetched from the cursor at a time when streaming
+FETCH_BATCH = 500
+# rows per executemany in the bulk methods; also bounds the IN (...) list
+BULK_BATCH = 500
+# applied to every pooled connection; journal_mode is stored in the file
+PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -16384,
+    "mmap_size": 64 * 1024 * 1024,
+    "busy_timeout": 5000,
+}
+# ids are AUTOINCREMENT so a deleted id is never handed out again, and an
+# (id, version) pair always names the same state of the same squirrel
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS squirrels (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, size TEXT, version INTEGER NOT NULL DEFAULT 1)",
+    "CREATE INDEX IF NOT EXISTS squirrels_name ON squirrels (name)",
+    "CREATE INDEX IF NOT EXISTS squirrels_size ON squirrels (size)",
+)
+# tables created before ids were AUTOINCREMENT are copied into one
+REBUILD = (
+    "CREATE TABLE squirrels_rebuild (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, size TEXT, version INTEGER NOT NULL DEFAULT 1)",
+    "INSERT INTO squirrels_rebuild (id, name, size, version) SELECT id, name, size, version FROM squirrels",
+    "DROP TABLE squirrels",
+    "ALTER TABLE squirrels_rebuild RENAME TO squirrels",
+)
+AUTOINCREMENT_CHECK = "SELECT 1 FROM sqlite_master WHERE name = 'squirrels' AND sql LIKE '%AUTOINCREMENT%'"
+# the only column and ORDER BY names that ever reach SQL text
+FIELDS = ("id", "name", "size")
+# FIELDS and the row version, bumped by every update
+COLUMNS = FIELDS + ("version",)
+SORTS = {
+    "id": "id",
+    "-id": "id DESC",
+    "name": "name, id",
+    "-name": "name DESC, id DESC",
+    "size": "size, id",
+    "-size": "size DESC, id DESC",
+}
+# a name prefix p matches names in [p, p + NAME_PREFIX_END)
+NAME_PREFIX_END = "\U0010ffff"
+# a write still locked out after busy_timeout is retried this many times,
+# backing off exponentially, before DatabaseBusy is raised
+WRITE_RETRIES = 3
+RETRY_BACKOFF = 0.05
+# a GroupCommitWriter commits at most this many writes together, waiting
+# at most this many seconds after the first for the rest to arrive
+GROUP_COMMIT_BATCH = 32
+GROUP_COMMIT_WAIT = 0.002
+
+METRICS.describe("squirrel_db_seconds", "histogram", "Time spent in SquirrelDB methods.")
+METRICS.describe("squirrel_db_write_retries_total", "counter", "Writes retried because the database was locked.")
+METRICS.describe("squirrel_pool_wait_seconds", "histogram", "Time spent waiting for a pooled connection.")
+METRICS.describe("squirrel_group_commits_total", "counter", "Transactions committed by the group commit writer.")
+METRICS.describe("squirrel_group_commit_writes_total", "counter", "Writes committed by the group commit writer.")
+timed = METRICS.timed("squirrel_db_seconds", "method")
+
+# (description, column names) of the last statement dict_factory saw
+_columns = (None, ())
 
 def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+    # column names are worked out once per statement rather than per row
+    global _columns
+    description, names = _columns
+    if cursor.description is not description:
+        description = cursor.description
+        names = tuple(col[0] for col in description)
+        _columns = (description, names)
+    return dict(zip(names, row))
+
+def materialize(description, rows):
+    # plain tuples from a cursor without a row factory, as dicts
+    names = tuple(col[0] for col in description)
+    return [dict(zip(names, row)) for row in rows]
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def isLocked(error):
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+def retryLocked(connection, work):
+    # runs work(), which commits on connection, again while the database
+    # is locked, backing off in between; raises DatabaseBusy when it stays
+    # locked
+    for attempt in range(WRITE_RETRIES + 1):
+        try:
+            return work()
+        except sqlite3.OperationalError as e:
+            if not isLocked(e):
+                raise
+            if connection.in_transaction:
+                connection.rollback()
+            if attempt == WRITE_RETRIES:
+                raise DatabaseBusy("database is locked after %d retries" % WRITE_RETRIES) from e
+            METRICS.inc("squirrel_db_write_retries_total")
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+def queryFields(fields=None, sort="id", limit=None, afterId=None):
+    # validates a listing's fields and sort; returns the fields to select,
+    # None meaning all of them
+    if fields and any(field not in FIELDS for field in fields):
+        raise ValueError("fields must be among %s" % ", ".join(FIELDS))
+    if sort not in SORTS:
+        raise ValueError("sort must be one of %s" % ", ".join(SORTS))
+    if afterId is not None and sort != "id":
+        raise ValueError("after_id only works with sort=id")
+    paged = limit is not None or afterId is not None
+    if paged and fields and "id" not in fields:
+        # keyset pages are continued from the last id
+        fields = ("id",) + tuple(fields)
+    return fields
+
+def squirrelQuery(size=None, namePrefix=None, fields=None, sort="id", limit=None, afterId=None, asJson=False):
+    # returns (sql, data) for a filtered, projected squirrel listing; the
+    # filters are plain comparisons on indexed columns and every value is
+    # a parameter. asJson selects (id, JSON text of the row) built by SQLite.
+    fields = queryFields(fields, sort, limit, afterId)
+    where, data = [], []
+    if size is not None:
+        where.append("size = ?")
+        data.append(size)
+    if namePrefix:
+        # a range rather than LIKE so the name index can be used
+        where.append("name >= ? AND name < ?")
+        data += [namePrefix, namePrefix + NAME_PREFIX_END]
+    if afterId is not None:
+        where.append("id > ?")
+        data.append(afterId)
+    if asJson:
+        pairs = ", ".join("'%s', %s" % (field, field) for field in fields or FIELDS)
+        sql = "SELECT id, json_object(%s) FROM squirrels" % pairs
+    else:
+        sql = "SELECT %s FROM squirrels" % ", ".join(fields or FIELDS)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY " + SORTS[sort]
+    if limit is not None:
+        sql += " LIMIT ?"
+        data.append(limit)
+    return sql, data
+
+def setupSchema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+    try:
+        # tables created before rows had versions
+        conn.execute("ALTER TABLE squirrels ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    except sqlite3.OperationalError as e:
+        if "duplicate column" not in str(e):
+            raise
+    conn.commit()
+    if conn.execute(AUTOINCREMENT_CHECK).fetchone() is None:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have rebuilt it while this one waited
+            if conn.execute(AUTOINCREMENT_CHECK).fetchone() is None:
+                for statement in REBUILD + SCHEMA[1:]:
+                    conn.execute(statement)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+def rowMatch(squirrelId, versions=None):
+    # WHERE clause and data for one row; with versions, only while the row
+    # is at one of them (an empty list matches nothing)
+    if versions is None:
+        return " WHERE id = ?", [squirrelId]
+    marks = ", ".join("?" * len(versions))
+    return " WHERE id = ? AND version IN (%s)" % marks, [squirrelId] + list(versions)
+
+class PoolTimeout(Exception):
+    pass
+
+class DatabaseBusy(sqlite3.OperationalError):
+    pass
+
+class ConnectionPool:
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=None):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(PRAGMAS, **(pragmas or {}))
+        self._ready = False
+        self._setupLock = threading.Lock()
+        self._idle = []
+        self._count = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("connection pool is closed")
+                conn, since = self._takeIdle()
+                if conn is not None or self._count < self.size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout("no database connection available after %.1fs" % self.timeout)
+                self._cond.wait(remaining)
+            if conn is None:
+                self._count += 1
+        if conn is not None and time.monotonic() - since > HEALTH_CHECK_AFTER and not self._healthy(conn):
+            conn.close()
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._count -= 1
+                    self._cond.notify()
+                raise
+        self._local.conn = conn
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._cond:
+            if self._closed:
+                conn.close()
+                self._count -= 1
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for conn, since in self._idle:
+                conn.close()
+            self._count -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"size": self.size, "open": self._count, "idle": len(self._idle)}
+
+    # HELPERS
+
+    def _takeIdle(self):
+        # a thread gets back the connection it used last when it is idle
+        mine = getattr(self._local, "conn", None)
+        for i, (conn, since) in enumerate(self._idle):
+            if conn is mine:
+                return self._idle.pop(i)
+        if self._idle:
+            return self._idle.pop()
+        return (None, None)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            # writes take the lock at BEGIN, so busy_timeout can wait for it
+            # instead of failing when a read transaction tries to upgrade
+            conn.isolation_level = "IMMEDIATE"
+            for name, value in self.pragmas.items():
+                conn.execute("PRAGMA %s = %s" % (name, value))
+            with self._setupLock:
+                if not self._ready:
+                    setupSchema(conn)
+                    self._ready = True
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _healthy(self, conn):
+        try:
+            conn.execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+_pool = None
+_poolLock = threading.Lock()
+
+def getPool():
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+def configurePool(path=DB_PATH, size=POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=None):
+    global _pool
+    with _poolLock:
+        old, _pool = _pool, ConnectionPool(path, size, timeout, pragmas)
+    if old is not None:
+        old.close()
+    return _pool
+
+def closePool():
+    global _pool
+    with _poolLock:
+        old, _pool = _pool, None
+    if old is not None:
+        old.close()
+
+class GroupCommitWriter:
+
+    # One thread that runs the single-statement writes of every request on
+    # a connection of its own. Writes queued together are committed in one
+    # transaction of up to maxBatch of them, so concurrent writers share
+    # a commit and its fsync instead of queueing for the write lock one by
+    # one. After taking the first write the thread waits up to maxWait
+    # seconds for more. execute() returns once the transaction holding its
+    # write has committed; its connection runs with synchronous=full, so
+    # that write then survives a power loss too.
+    #
+    # Each write runs under a savepoint: one that fails is rolled back and
+    # raises in its caller only, the rest of the batch still commits.
+
+    def __init__(self, pool=None, maxBatch=GROUP_COMMIT_BATCH, maxWait=GROUP_COMMIT_WAIT):
+        self.pool = pool or getPool()
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+        self._writes = queue.SimpleQueue()
+        self._closed = False
+        self._closeLock = threading.Lock()
+        self._connection = None
+        self._synchronous = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def execute(self, sql, data):
+        # the rows of a RETURNING clause, as _write returns them
+        future = Future()
+        with self._closeLock:
+            if self._closed:
+                raise RuntimeError("group commit writer is closed")
+            self._writes.put((sql, data, future))
+        return future.result()
+
+    def close(self):
+        # writes already queued are committed first
+        with self._closeLock:
+            if self._closed:
+                return
+            self._closed = True
+            self._writes.put(None)
+        self._thread.join()
+
+    # HELPERS
+
+    def _run(self):
+        try:
+            while True:
+                batch, closing = self._collect()
+                if batch:
+                    self._commit(batch)
+                if closing:
+                    return
+        finally:
+            if self._connection is not None:
+                # back to the pool with the pool's own setting
+                self._connection.execute("PRAGMA synchronous=%d" % self._synchronous)
+                self.pool.release(self._connection)
+
+    def _collect(self):
+        # (writes, whether close() was called)
+        first = self._writes.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.maxWait
+        while len(batch) < self.maxBatch:
+            try:
+                item = self._writes.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _commit(self, batch):
+        try:
+            if self._connection is None:
+                connection = self.pool.acquire()
+                self._synchronous = connection.execute("PRAGMA synchronous").fetchone()[0]
+                connection.execute("PRAGMA synchronous=FULL")
+                connection.row_factory = dict_factory
+                self._connection = connection
+            connection = self._connection
+            results = retryLocked(connection, lambda: self._apply(connection, batch))
+        except Exception as e:
+            # an open transaction would hold the write lock and fail every
+            # later BEGIN
+            if self._connection is not None and self._connection.in_transaction:
+                self._connection.rollback()
+            for sql, data, future in batch:
+                future.set_exception(e)
+            return
+        METRICS.inc("squirrel_group_commits_total")
+        METRICS.inc("squirrel_group_commit_writes_total", value=len(batch))
+        for (sql, data, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _apply(self, connection, batch):
+        # the rows, or the error, of each write
+        results = []
+        cursor = connection.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for sql, data, future in batch:
+                cursor.execute("SAVEPOINT write")
+                try:
+                    cursor.execute(sql, data)
+                    results.append(cursor.fetchall())
+                except sqlite3.OperationalError as e:
+                    if isLocked(e):
+                        raise
+                    cursor.execute("ROLLBACK TO write")
+                    results.append(e)
+                except Exception as e:
+                    # anything from a constraint to a value sqlite cannot bind
+                    cursor.execute("ROLLBACK TO write")
+                    results.append(e)
+                cursor.execute("RELEASE write")
+            connection.commit()
+        finally:
+            cursor.close()
+        return results
 
 class SquirrelDB:
 
-    def __init__(self):
-        self.connection = sqlite3.connect("squirrel_db.db")
+    # stays None on instances that never drew a connection
+    connection = None
+
+    def __init__(self, pool=None, writer=None):
+        # with a GroupCommitWriter, single-statement writes go through it
+        self.pool = pool or getPool()
+        self.writer = writer
+        with METRICS.timer("squirrel_pool_wait_seconds"):
+            self.connection = self.pool.acquire()
         self.connection.row_factory = dict_factory
         self.cursor = self.connection.cursor()
 
-    def getSquirrels(self):
-        self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
-        return self.cursor.fetchall()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.cursor.close()
+            self.pool.release(self.connection)
+            self.connection = None
+
+    @timed
+    def getSquirrels(self, limit=None, afterId=None):
+        # keyset pagination: seeks on the primary key instead of OFFSET
+        return self.querySquirrels(limit=limit, afterId=afterId)
+
+    @timed
+    def querySquirrels(self, **filters):
+        # filters as for squirrelQuery
+        cursor = self._select(*squirrelQuery(**filters))
+        return materialize(cursor.description, cursor.fetchall())
+
+    @timed
+    def querySquirrelsJson(self, **filters):
+        # (id, JSON text) tuples; SQLite encodes the rows, so no dict is built
+        return self._select(*squirrelQuery(asJson=True, **filters)).fetchall()
+
+    @timed
+    def streamSquirrelsJson(self, batchSize=FETCH_BATCH, **filters):
+        # as streamSquirrels, with rows as for querySquirrelsJson
+        cursor = self._select(*squirrelQuery(asJson=True, **filters))
+        while True:
+            rows = cursor.fetchmany(batchSize)
+            if not rows:
+                return
+            yield rows
 
+    @timed
+    def streamSquirrels(self, batchSize=FETCH_BATCH, **filters):
+        # yields lists of rows; the connection stays busy until exhausted
+        cursor = self._select(*squirrelQuery(**filters))
+        while True:
+            rows = cursor.fetchmany(batchSize)
+            if not rows:
+                return
+            yield materialize(cursor.description, rows)
+
+    @timed
+    def streamSquirrelRows(self, batchSize=FETCH_BATCH):
+        # yields lists of (id, name, size, version) tuples: all a copy of
+        # the table needs
+        cursor = self._select("SELECT %s FROM squirrels ORDER BY id" % ", ".join(COLUMNS), [])
+        while True:
+            rows = cursor.fetchmany(batchSize)
+            if not rows:
+                return
+            yield rows
+
+    @timed
+    def lastSquirrelId(self):
+        # the largest id ever handed out, deleted squirrels included
+        self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'squirrels'")
+        row = self.cursor.fetchone()
+        return row["seq"] if row else 0
+
+    @timed
     def getSquirrel(self, squirrelId):
+        # the row with its version
         data = [squirrelId]
-        self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", data)
+        self.cursor.execute("SELECT id, name, size, version FROM squirrels WHERE id = ?", data)
         return self.cursor.fetchone()
 
+    @timed
+    def squirrelVersion(self, squirrelId):
+        # None when there is no such squirrel
+        self.cursor.execute("SELECT version FROM squirrels WHERE id = ?", [squirrelId])
+        row = self.cursor.fetchone()
+        return row["version"] if row else None
+
+    @timed
     def createSquirrel(self, name, size):
         data = [name, size]
-        self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
-        self.connection.commit()
+        self._write("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
         return None
 
-    def updateSquirrel(self, squirrelId, name, size):
-        data = [name, size, squirrelId]
-        self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
-        self.connection.commit()
-        return None
+    # updateSquirrel and deleteSquirrel match the row and change it in one
+    # statement. Given versions, they only touch a row still at one of
+    # them; squirrelVersion tells a missing row from a changed one.
 
-    def deleteSquirrel(self, squirrelId):
-        data = [squirrelId]
-        self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
+    @timed
+    def updateSquirrel(self, squirrelId, name, size, versions=None):
+        # returns the updated row with its new version, or None
+        where, data = rowMatch(squirrelId, versions)
+        rows = self._write("UPDATE squirrels SET name = ?, size = ?, version = version + 1" + where
+                           + " RETURNING id, name, size, version", [name, size] + data)
+        return rows[0] if rows else None
+
+    @timed
+    def deleteSquirrel(self, squirrelId, versions=None):
+        # returns whether a row was deleted
+        where, data = rowMatch(squirrelId, versions)
+        return bool(self._write("DELETE FROM squirrels" + where + " RETURNING id", data))
+
+    # BULK
+    #
+    # Each runs executemany per batch inside one transaction, committed at
+    # the end unless commit=False leaves that to the caller.
+
+    @timed
+    def bulkCreateSquirrels(self, squirrels, batchSize=BULK_BATCH, commit=True):
+        # squirrels: iterable of (name, size); returns how many were inserted
+        count = 0
+        for batch in batches(squirrels, batchSize):
+            self.cursor.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)", batch)
+            count += len(batch)
+        if commit:
+            self.connection.commit()
+        return count
+
+    @timed
+    def bulkUpdateSquirrels(self, squirrels, batchSize=BULK_BATCH, commit=True):
+        # squirrels: iterable of (id, name, size); returns whether each id existed
+        found = []
+        for batch in batches(squirrels, batchSize):
+            existing = self.existingIds([squirrelId for squirrelId, name, size in batch])
+            found.extend(squirrelId in existing for squirrelId, name, size in batch)
+            data = [(name, size, squirrelId) for squirrelId, name, size in batch if squirrelId in existing]
+            self.cursor.executemany("UPDATE squirrels SET name = ?, size = ?, version = version + 1 WHERE id = ?", data)
+        if commit:
+            self.connection.commit()
+        return found
+
+    @timed
+    def bulkDeleteSquirrels(self, squirrelIds, batchSize=BULK_BATCH, commit=True):
+        # returns whether each id existed; a repeated id only counts once
+        found = []
+        for batch in batches(squirrelIds, batchSize):
+            existing = self.existingIds(batch)
+            for squirrelId in batch:
+                found.append(squirrelId in existing)
+                existing.discard(squirrelId)
+            self.cursor.executemany("DELETE FROM squirrels WHERE id = ?", [[squirrelId] for squirrelId in set(batch)])
+        if commit:
+            self.connection.commit()
+        return found
+
+    def existingIds(self, squirrelIds):
+        data = list(squirrelIds)
+        if not data:
+            return set()
+        marks = ", ".join("?" * len(data))
+        self.cursor.execute("SELECT id FROM squirrels WHERE id IN (%s)" % marks, data)
+        return {row["id"] for row in self.cursor.fetchall()}
+
+    @timed
+    def commit(self):
         self.connection.commit()
-        return None
+
+    # HELPERS
+
+    def _select(self, sql, data):
+        # listings fetch bare tuples and build dicts a batch at a time
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(sql, data)
+        return cursor
+
+    def _write(self, sql, data):
+        # one statement in its own transaction, retried while locked;
+        # returns the rows of a RETURNING clause
+        if self.writer is not None:
+            return self.writer.execute(sql, data)
+
+        def work():
+            self.cursor.execute(sql, data)
+            rows = self.cursor.fetchall()
+            self.connection.commit()
+            return rows
+        return retryLocked(self.connection, work)
+
+class SQLiteBackend:
+
+    # A backend is what the server stores squirrels in: open() gives each
+    # request something used as a context manager with SquirrelDB's
+    # methods, and shutdown() is called once when the server stops. This
+    # one hands out a SquirrelDB on a pooled connection per request, whose
+    # writes go through writer when there is one.
+
+    # SQLite takes one writer at a time, so bulk requests are read in full
+    # before they start their transaction
+    bufferBulk = True
+
+    def __init__(self, pool=None, writer=None):
+        self.pool = pool
+        self.writer = writer
+
+    def open(self):
+        return SquirrelDB(self.pool, self.writer)
+
+    def shutdown(self):
+        if self.writer is not None:
+            self.writer.close()
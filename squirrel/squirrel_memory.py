@@ -0,0 +1,366 @@
+import bisect
+import json
+import os
+import threading
+from squirrel_metrics import METRICS
+from squirrel_db import queryFields, FIELDS, COLUMNS, FETCH_BATCH, BULK_BATCH, NAME_PREFIX_END, batches
+
+# seconds between snapshots of a MemoryBackend that has a snapshot path
+SNAPSHOT_INTERVAL = 30.0
+
+timed = METRICS.timed("squirrel_db_seconds", "method")
+
+def rowId(value):
+    # ids arrive as path strings; SQLite compares them to the INTEGER
+    # PRIMARY KEY as numbers and simply finds nothing for anything else
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def textValue(value):
+    # what a TEXT column hands back for value
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return str(value)
+    return value
+
+def rowJson(row, fields):
+    values = dict(zip(FIELDS, row))
+    return json.dumps({field: values[field] for field in fields}, ensure_ascii=False, separators=(",", ":"))
+
+def sortKey(column):
+    # NULLs first, ties broken on id, as in SORTS
+    return lambda row: (row[column] is not None, row[column] or "", row[0])
+
+SORT_KEYS = {
+    "name": (sortKey(1), False),
+    "-name": (sortKey(1), True),
+    "size": (sortKey(2), False),
+    "-size": (sortKey(2), True),
+}
+
+class MemoryBackend:
+
+    # Squirrels held in a dict keyed by id, with a sorted list of ids for
+    # ordered and keyset reads; open() hands out the backend itself, so a
+    # request costs no construction. It answers SquirrelDB's methods with
+    # the same results: ids count up from the largest ever handed out and
+    # are never reused, like AUTOINCREMENT, and listings are the JSON text
+    # json_object would build.
+    #
+    # Rows are immutable (id, name, size, version) tuples. Readers copy the rows
+    # they need under the lock and do the rest outside it. A write takes
+    # the lock until it commits; the bulk methods with commit=False keep it
+    # until commit(), or until the request ends and close() undoes them,
+    # so other requests never see half of a bulk request.
+    #
+    # With snapshotPath the rows are loaded from that file if it exists and
+    # written back to it every snapshotInterval seconds while they change,
+    # and once more on shutdown().
+
+    # readers wait on the write lock, so bulk requests are read in full
+    # before they start their transaction
+    bufferBulk = True
+
+    def __init__(self, snapshotPath=None, snapshotInterval=SNAPSHOT_INTERVAL):
+        self._rows = {}
+        self._ids = []
+        self._lock = threading.RLock()
+        self._undo = None
+        self._owner = None
+        self._lastId = 0
+        self.version = 0
+        self.snapshotPath = snapshotPath
+        self.restored = False
+        self._saved = 0
+        self._stop = threading.Event()
+        self._snapshotter = None
+        if snapshotPath is not None:
+            self.restored = self.restore()
+            self._saved = self.version
+            self._snapshotter = threading.Thread(target=self._snapshotEvery, args=(snapshotInterval,), daemon=True)
+            self._snapshotter.start()
+
+    def open(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # the end of a request: anything left uncommitted is undone
+        if self._owner == threading.get_ident():
+            self._rollback()
+
+    def load(self, rows, lastId=0):
+        # adds rows given as (id, name, size[, version]) tuples or squirrel
+        # dicts; rows without a version are at version 1. New ids start
+        # past both the rows and lastId.
+        with self._lock:
+            self._lastId = max(self._lastId, lastId)
+            for row in rows:
+                if isinstance(row, dict):
+                    row = tuple(row.get(column, 1) for column in COLUMNS)
+                self._put((tuple(row) + (1,))[:len(COLUMNS)])
+                self._lastId = max(self._lastId, row[0])
+            self.version += 1
+
+    # READS
+
+    @timed
+    def getSquirrels(self, limit=None, afterId=None):
+        return self.querySquirrels(limit=limit, afterId=afterId)
+
+    @timed
+    def querySquirrels(self, **filters):
+        fields, rows = self._select(**filters)
+        return [dict(zip(fields, row)) for row in self._project(fields, rows)]
+
+    @timed
+    def querySquirrelsJson(self, **filters):
+        fields, rows = self._select(**filters)
+        return [(row[0], rowJson(row, fields)) for row in rows]
+
+    @timed
+    def streamSquirrelsJson(self, batchSize=FETCH_BATCH, **filters):
+        fields, rows = self._select(**filters)
+        for batch in batches(rows, batchSize):
+            yield [(row[0], rowJson(row, fields)) for row in batch]
+
+    @timed
+    def streamSquirrels(self, batchSize=FETCH_BATCH, **filters):
+        fields, rows = self._select(**filters)
+        for batch in batches(self._project(fields, rows), batchSize):
+            yield [dict(zip(fields, row)) for row in batch]
+
+    @timed
+    def getSquirrel(self, squirrelId):
+        with self._lock:
+            row = self._rows.get(rowId(squirrelId))
+        return dict(zip(COLUMNS, row)) if row else None
+
+    @timed
+    def squirrelVersion(self, squirrelId):
+        with self._lock:
+            row = self._rows.get(rowId(squirrelId))
+        return row[3] if row else None
+
+    def existingIds(self, squirrelIds):
+        with self._lock:
+            return {squirrelId for squirrelId in map(rowId, squirrelIds) if squirrelId in self._rows}
+
+    # WRITES
+
+    @timed
+    def createSquirrel(self, name, size):
+        with self._write():
+            self._insert(name, size)
+            self.commit()
+
+    @timed
+    def updateSquirrel(self, squirrelId, name, size, versions=None):
+        with self._write():
+            row = self._update(rowId(squirrelId), name, size, versions)
+            self.commit()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    @timed
+    def deleteSquirrel(self, squirrelId, versions=None):
+        with self._write():
+            deleted = self._delete(rowId(squirrelId), versions)
+            self.commit()
+        return deleted
+
+    @timed
+    def bulkCreateSquirrels(self, squirrels, batchSize=BULK_BATCH, commit=True):
+        count = 0
+        with self._write():
+            for name, size in squirrels:
+                self._insert(name, size)
+                count += 1
+            if commit:
+                self.commit()
+        return count
+
+    @timed
+    def bulkUpdateSquirrels(self, squirrels, batchSize=BULK_BATCH, commit=True):
+        found = []
+        with self._write():
+            for squirrelId, name, size in squirrels:
+                found.append(self._update(rowId(squirrelId), name, size) is not None)
+            if commit:
+                self.commit()
+        return found
+
+    @timed
+    def bulkDeleteSquirrels(self, squirrelIds, batchSize=BULK_BATCH, commit=True):
+        found = []
+        with self._write():
+            for squirrelId in squirrelIds:
+                found.append(self._delete(rowId(squirrelId)))
+            if commit:
+                self.commit()
+        return found
+
+    @timed
+    def commit(self):
+        if self._owner != threading.get_ident():
+            return
+        self._undo = None
+        self._owner = None
+        self.version += 1
+        self._lock.release()
+
+    # SNAPSHOTS
+
+    def snapshot(self):
+        # writes the rows to snapshotPath through a temporary file, so the
+        # file on disk is always a complete snapshot
+        with self._lock:
+            rows = [self._rows[squirrelId] for squirrelId in self._ids]
+            lastId = self._lastId
+            version = self.version
+        tmp = self.snapshotPath + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"squirrels": rows, "lastId": lastId}, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshotPath)
+        self._saved = version
+
+    def restore(self):
+        # loads snapshotPath; False when there is no snapshot yet
+        try:
+            with open(self.snapshotPath, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            self._rows, self._ids, self._lastId = {}, [], snapshot.get("lastId", 0)
+            self.load(snapshot["squirrels"])
+        return True
+
+    def shutdown(self):
+        self._stop.set()
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+            if self.version != self._saved:
+                self.snapshot()
+
+    # HELPERS
+
+    def _select(self, size=None, namePrefix=None, fields=None, sort="id", limit=None, afterId=None):
+        # (fields, rows) for a listing filtered and ordered as squirrelQuery
+        # would; rows are whole tuples, projected by the caller
+        fields = tuple(queryFields(fields, sort, limit, afterId) or FIELDS)
+        upper = namePrefix + NAME_PREFIX_END if namePrefix else None
+        # a negative LIMIT is no limit to SQLite
+        if limit is not None and limit < 0:
+            limit = None
+        rows = []
+        with self._lock:
+            start = 0 if afterId is None else bisect.bisect_right(self._ids, afterId)
+            for squirrelId in self._ids[start:]:
+                row = self._rows[squirrelId]
+                if size is not None and row[2] != size:
+                    continue
+                if upper is not None and not (row[1] is not None and namePrefix <= row[1] < upper):
+                    continue
+                if sort == "id" and limit is not None and len(rows) >= limit:
+                    break
+                rows.append(row)
+        if sort == "-id":
+            rows.reverse()
+        elif sort != "id":
+            key, reverse = SORT_KEYS[sort]
+            rows.sort(key=key, reverse=reverse)
+        if limit is not None:
+            rows = rows[:limit]
+        return fields, rows
+
+    def _project(self, fields, rows):
+        if fields == FIELDS:
+            return rows
+        positions = [FIELDS.index(field) for field in fields]
+        return [tuple(row[i] for i in positions) for row in rows]
+
+    def _write(self):
+        # takes the lock for a transaction unless this thread already holds
+        # one; the lock is kept until commit() or close()
+        if self._owner != threading.get_ident():
+            self._lock.acquire()
+            self._owner = threading.get_ident()
+            self._undo = []
+            # ids taken by a transaction that is undone are free again
+            self._undoLastId = self._lastId
+        return _Transaction(self)
+
+    def _rollback(self):
+        for squirrelId, row in reversed(self._undo):
+            if row is None:
+                self._remove(squirrelId)
+            else:
+                self._put(row)
+        self._lastId = self._undoLastId
+        self._undo = None
+        self._owner = None
+        self._lock.release()
+
+    def _insert(self, name, size):
+        squirrelId = self._lastId = self._lastId + 1
+        self._undo.append((squirrelId, None))
+        self._put((squirrelId, textValue(name), textValue(size), 1))
+
+    def _update(self, squirrelId, name, size, versions=None):
+        # returns the new row, or None when no row matched
+        row = self._rows.get(squirrelId)
+        if row is None or (versions is not None and row[3] not in versions):
+            return None
+        self._undo.append((squirrelId, row))
+        updated = self._rows[squirrelId] = (squirrelId, textValue(name), textValue(size), row[3] + 1)
+        return updated
+
+    def _delete(self, squirrelId, versions=None):
+        row = self._rows.get(squirrelId)
+        if row is None or (versions is not None and row[3] not in versions):
+            return False
+        self._undo.append((squirrelId, row))
+        self._remove(squirrelId)
+        return True
+
+    def _put(self, row):
+        if row[0] not in self._rows:
+            if not self._ids or row[0] > self._ids[-1]:
+                self._ids.append(row[0])
+            else:
+                bisect.insort(self._ids, row[0])
+        self._rows[row[0]] = row
+
+    def _remove(self, squirrelId):
+        del self._rows[squirrelId]
+        del self._ids[bisect.bisect_left(self._ids, squirrelId)]
+
+    def _snapshotEvery(self, interval):
+        while not self._stop.wait(interval):
+            if self.version != self._saved:
+                self.snapshot()
+
+class _Transaction:
+
+    # what MemoryBackend._write returns: on an error inside the block the
+    # transaction is undone, as a failed SQLite statement rolls back
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        return self.backend
+
+    def __exit__(self, excType, *exc):
+        if excType is not None and self.backend._owner == threading.get_ident():
+            self.backend._rollback()
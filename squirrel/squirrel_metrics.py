@@ -0,0 +1,166 @@
+import bisect
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# upper bounds in seconds of the latency histogram buckets; anything slower
+# lands in +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_DONE = object()
+
+class Metrics:
+
+    # Counters, gauges and histograms rendered in the Prometheus text
+    # exposition format. Every thread records into a shard of its own, so
+    # recording takes no lock; a scrape adds the shards up. Shards outlive
+    # their threads so totals never go backwards, which is fine for servers
+    # that keep a fixed set of workers. Values that already exist elsewhere
+    # (pool and cache sizes) are read by collectors at scrape time instead.
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._descriptions = {}
+        self._collectors = {}
+        self._shards = []
+        self._shardsLock = threading.Lock()
+        self._local = threading.local()
+
+    def describe(self, name, kind, text):
+        self._descriptions[name] = (kind, text)
+
+    def collector(self, name, collect):
+        # collect() returns {labels: value}, labels being a tuple of pairs
+        self._collectors[name] = collect
+
+    def inc(self, name, labels=(), value=1):
+        # also takes negative values for gauges kept as a running sum
+        values = self._shard()[0]
+        key = (name, labels)
+        values[key] = values.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        histograms = self._shard()[1]
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            # one count per bucket, one for +Inf, then the sum
+            counts = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        counts[-1] += seconds
+
+    @contextmanager
+    def timer(self, name, labels=()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - start)
+
+    def timed(self, name, labelName):
+        # decorator observing each call under {labelName="<function name>"};
+        # for generators only the time spent producing items is counted,
+        # not the time the caller holds on to them
+        def decorate(function):
+            labels = ((labelName, function.__name__),)
+            if inspect.isgeneratorfunction(function):
+                @wraps(function)
+                def generator(*args, **kwargs):
+                    items = function(*args, **kwargs)
+                    elapsed = 0.0
+                    try:
+                        while True:
+                            start = time.perf_counter()
+                            item = next(items, _DONE)
+                            elapsed += time.perf_counter() - start
+                            if item is _DONE:
+                                return
+                            yield item
+                    finally:
+                        items.close()
+                        self.observe(name, labels, elapsed)
+                return generator
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, labels, time.perf_counter() - start)
+            return wrapper
+        return decorate
+
+    def clear(self):
+        with self._shardsLock:
+            for values, histograms in self._shards:
+                values.clear()
+                histograms.clear()
+
+    def render(self):
+        values, histograms = {}, {}
+        with self._shardsLock:
+            shards = list(self._shards)
+        for shardValues, shardHistograms in shards:
+            # copies are taken because the owning thread keeps recording
+            for key, value in shardValues.copy().items():
+                values[key] = values.get(key, 0) + value
+            for key, counts in shardHistograms.copy().items():
+                total = histograms.setdefault(key, [0] * len(counts))
+                for i, count in enumerate(list(counts)):
+                    total[i] += count
+        for name, collect in self._collectors.items():
+            for labels, value in collect().items():
+                values[(name, labels)] = value
+
+        samples = {}
+        for (name, labels), value in values.items():
+            samples.setdefault(name, []).append(formatSample(name, labels, value))
+        for (name, labels), counts in histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(formatSample(name + "_bucket", labels + (("le", formatValue(bound)),), cumulative))
+            lines.append(formatSample(name + "_sum", labels, counts[-1]))
+            lines.append(formatSample(name + "_count", labels, cumulative))
+        out = []
+        for name in sorted(samples):
+            if name in self._descriptions:
+                kind, text = self._descriptions[name]
+                out.append("# HELP %s %s" % (name, text))
+                out.append("# TYPE %s %s" % (name, kind))
+            out.extend(samples[name])
+        return "\n".join(out) + "\n" if out else ""
+
+    # HELPERS
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            with self._shardsLock:
+                self._shards.append(shard)
+            return shard
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def formatSample(name, labels, value):
+    if not labels:
+        return "%s %s" % (name, formatValue(value))
+    pairs = ",".join('%s="%s"' % (key, escapeLabel(str(label))) for key, label in labels)
+    return "%s{%s} %s" % (name, pairs, formatValue(value))
+
+def escapeLabel(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+METRICS = Metrics()
@@ -0,0 +1,134 @@
+import cProfile
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+
+# limits and defaults of a profiling session
+PROFILE_SECONDS = 30.0
+MAX_PROFILE_SECONDS = 600.0
+PROFILE_SAMPLE = 0.01
+# allocation sites listed in an allocation report
+TOP_ALLOCATIONS = 25
+
+class ProfileRunning(Exception):
+    pass
+
+class Profiler:
+
+    # On-demand profiling for a running server. start() opens a session of
+    # some seconds during which a sample of requests run under cProfile and,
+    # with allocations, tracemalloc traces the whole process. When the
+    # session ends (or stop() is called) the merged request profiles are
+    # written to directory as a .pstats file and the allocation growth over
+    # the session as a text report.
+    #
+    # Requests only look at active while no session runs, so profiling
+    # costs nothing until it is switched on. directory stays None until
+    # the server is given one, and then nothing can be started.
+
+    def __init__(self, directory=None, token=None):
+        self.directory = directory
+        # required as "Authorization: Bearer <token>" when set
+        self.token = token
+        self.active = False
+        self.sample = 0.0
+        self._lock = threading.Lock()
+        self._stats = None
+        self._profiled = 0
+        self._baseline = None
+        self._tracing = False
+        self._timer = None
+        self._files = {}
+
+    def start(self, seconds=PROFILE_SECONDS, sample=PROFILE_SAMPLE, allocations=True):
+        # returns a description of the session, with the files it will write
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise ValueError("seconds must be more than 0 and at most %d" % MAX_PROFILE_SECONDS)
+        if not 0 < sample <= 1:
+            raise ValueError("sample must be more than 0 and at most 1")
+        with self._lock:
+            if self.active:
+                raise ProfileRunning("a profile is already running")
+            name = "%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+            self._files = {"profile": os.path.join(self.directory, "profile-%s.pstats" % name)}
+            self._stats = pstats.Stats()
+            self._profiled = 0
+            self._tracing = False
+            self._baseline = None
+            if allocations:
+                self._files["allocations"] = os.path.join(self.directory, "allocations-%s.txt" % name)
+                # tracing someone else started is left running at the end
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._tracing = True
+                self._baseline = tracemalloc.take_snapshot()
+            self.sample = sample
+            self._timer = threading.Timer(seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+            self.active = True
+        return {"seconds": seconds, "sample": sample, "until": round(time.time() + seconds, 3), "files": dict(self._files)}
+
+    def stop(self):
+        # ends the session and writes its reports; returns their paths, or
+        # None when no session was running
+        with self._lock:
+            if not self.active:
+                return None
+            self.active = False
+            self._timer.cancel()
+            stats, profiled, baseline, files = self._stats, self._profiled, self._baseline, self._files
+            self._stats = self._baseline = None
+            snapshot = tracemalloc.take_snapshot() if baseline is not None else None
+            if self._tracing:
+                tracemalloc.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        if profiled:
+            stats.dump_stats(files["profile"])
+        else:
+            # nothing was sampled; an empty file would not load in pstats
+            files = {kind: path for kind, path in files.items() if kind != "profile"}
+        if snapshot is not None:
+            writeAllocations(files["allocations"], baseline, snapshot)
+        return files
+
+    def begin(self):
+        # called as a request starts while a session is active; returns the
+        # profile to hand to end(), or None when the request is not sampled
+        if random.random() >= self.sample:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler already runs on this thread
+            return None
+        return profile
+
+    def end(self, profile):
+        profile.disable()
+        with self._lock:
+            if self._stats is not None:
+                self._stats.add(profile)
+                self._profiled += 1
+
+# the profiler's own bookkeeping, left out of allocation reports
+OWN_ALLOCATIONS = [tracemalloc.Filter(False, module.__file__) for module in (cProfile, pstats, tracemalloc)] + [
+    tracemalloc.Filter(False, __file__)]
+
+def writeAllocations(path, baseline, snapshot, top=TOP_ALLOCATIONS):
+    baseline, snapshot = baseline.filter_traces(OWN_ALLOCATIONS), snapshot.filter_traces(OWN_ALLOCATIONS)
+    growth = snapshot.compare_to(baseline, "lineno")
+    current = snapshot.statistics("lineno")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("# growth since the profile started, top %d by size\n" % top)
+        for stat in growth[:top]:
+            f.write("%s\n" % stat)
+        f.write("\n# held at the end, top %d by size (%.1f KiB traced)\n" % (top, sum(stat.size for stat in current) / 1024))
+        for stat in current[:top]:
+            f.write("%s\n" % stat)
+
+PROFILER = Profiler()
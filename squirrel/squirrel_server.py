@@ -1,10 +1,551 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import io
 import json
+import logging
+import os
+import queue
+import random
+import secrets
+import select
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
-from squirrel_db import SquirrelDB
+from urllib.parse import parse_qs, urlencode
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from squirrel_metrics import METRICS, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from squirrel_db import SquirrelDB, SQLiteBackend, GroupCommitWriter, PoolTimeout, configurePool, closePool, getPool, isLocked, squirrelQuery, DB_PATH, POOL_SIZE, POOL_TIMEOUT, BULK_BATCH, GROUP_COMMIT_WAIT
+from squirrel_memory import MemoryBackend, SNAPSHOT_INTERVAL
+from squirrel_profile import PROFILER, PROFILE_SECONDS, PROFILE_SAMPLE, ProfileRunning
+
+# keep-alive connections are closed after this many idle seconds or
+# this many requests, whichever comes first
+IDLE_TIMEOUT = 15
+# ... or after this many, in the threaded server, while other connections
+# wait for a worker
+BUSY_IDLE_TIMEOUT = 1
+MAX_REQUESTS_PER_CONNECTION = 1000
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# GET responses are served from memory for up to CACHE_TTL seconds; the
+# cache is emptied of anything a write through this process touches
+CACHE_TTL = 5.0
+CACHE_BYTES = 16 * 1024 * 1024
+CACHE_ENTRY_BYTES = 1024 * 1024
+# bodies of at least COMPRESS_MIN_BYTES go out gzip or deflate encoded to
+# clients that accept it, in order of preference among equal q-values
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+CODINGS = ("gzip", "deflate")
+# share of requests written to the access log; 5xx responses always are
+LOG_SAMPLE = 1.0
+# where squirrels are kept: the SQLite file, or memory seeded from it
+BACKENDS = ("sqlite", "memory")
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+# an NDJSON body read ahead of its transaction is kept in memory up to
+# this many bytes and spills to a temporary file beyond them
+BULK_SPOOL_BYTES = 1024 * 1024
+MODES = ("single", "threaded", "async")
+WORKERS = 8
+QUEUE_SIZE = 64
+# seconds the async server waits for open connections on shutdown
+SHUTDOWN_GRACE = 5.0
+# a worker process that dies sooner than this after starting is restarted
+# only after this many seconds, so a worker that cannot start does not spin
+RESTART_DELAY = 1.0
+SERVICE_UNAVAILABLE = (
+    b"HTTP/1.0 503 Service Unavailable\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Length: 23\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"503 Service Unavailable"
+)
+
+# LOGGING
+
+accessLog = logging.getLogger("squirrel.access")
+
+class JsonLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = getattr(record, "access", None)
+        if entry is None:
+            entry = {"level": record.levelname.lower(), "message": record.getMessage()}
+        return json.dumps(dict({"ts": round(record.created, 3)}, **entry), separators=(",", ":"))
+
+def startLogging(stream=None, sample=LOG_SAMPLE):
+    # request threads only put records on a queue; a listener thread
+    # formats them and does the writing
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonLinesFormatter())
+    accessLog.handlers = [QueueHandler(records)]
+    accessLog.setLevel(logging.INFO)
+    accessLog.propagate = False
+    SquirrelServerHandler.logSample = sample
+    listener = QueueListener(records, output)
+    listener.start()
+    return listener
+
+# CACHE
+
+class ResponseCache:
+
+    # Encoded response bodies keyed by (group, ...) tuples, expiring after
+    # ttl seconds and evicted least recently used beyond maxBytes. Every
+    # invalidation bumps the generation; put() drops a response computed
+    # under an older generation so a read racing a write cannot store
+    # what the write just replaced. An entry also keeps the body in each
+    # content coding it has been sent in, so it is compressed once per
+    # change rather than once per request.
+
+    def __init__(self, ttl=CACHE_TTL, maxBytes=CACHE_BYTES, maxEntryBytes=CACHE_ENTRY_BYTES):
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.maxEntryBytes = maxEntryBytes
+        self.size = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # returns (body, etag, headers) or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] <= time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[:3]
+
+    def put(self, key, body, headers=None, generation=None, etag=None):
+        # returns the ETag for body (etagFor unless given) whether or not it
+        # was stored
+        etag = etag or etagFor(body)
+        if len(body) > self.maxEntryBytes:
+            return etag
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return etag
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (body, etag, headers or {}, time.monotonic() + self.ttl, {})
+            self.size += len(body)
+            self._evict()
+        return etag
+
+    def getEncoded(self, key, coding, etag):
+        # the body of the entry for etag in coding, or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != etag:
+                return None
+            return entry[4].get(coding)
+
+    def putEncoded(self, key, coding, etag, body):
+        # kept only while the entry for etag is
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != etag or coding in entry[4]:
+                return
+            entry[4][coding] = body
+            self.size += len(body)
+            self._evict()
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            if key in self._entries:
+                self._drop(key)
+
+    def invalidateGroup(self, group):
+        with self._lock:
+            self.generation += 1
+            for key in [key for key in self._entries if key[0] == group]:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size = 0
+
+    def disable(self):
+        # nothing is kept or served from here on
+        with self._lock:
+            self.ttl = self.maxBytes = self.maxEntryBytes = 0
+        self.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self.size}
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry[0]) + sum(len(body) for body in entry[4].values())
+
+    def _evict(self):
+        while self.size > self.maxBytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+RESPONSE_CACHE = ResponseCache()
+
+# METRICS
+
+METRICS.describe("squirrel_requests_total", "counter", "Requests answered, by handler, method and status.")
+METRICS.describe("squirrel_request_seconds", "histogram", "Time from parsing a request to the end of its response, by handler.")
+METRICS.describe("squirrel_response_bytes_total", "counter", "Response bytes written, by handler.")
+METRICS.describe("squirrel_connections_open", "gauge", "Client connections being served.")
+METRICS.describe("squirrel_connections_rejected_total", "counter", "Connections answered 503 because the server was full.")
+METRICS.describe("squirrel_pool_connections", "gauge", "Database connections in the pool, by state.")
+METRICS.describe("squirrel_pool_size", "gauge", "Most database connections the pool opens.")
+METRICS.describe("squirrel_cache_entries", "gauge", "Responses held in the response cache.")
+METRICS.describe("squirrel_cache_bytes", "gauge", "Bytes held in the response cache.")
+METRICS.describe("squirrel_cache_lookups_total", "counter", "Response cache lookups, by result.")
+
+def poolMetrics():
+    stats = getPool().stats()
+    return {
+        (("state", "idle"),): stats["idle"],
+        (("state", "in_use"),): stats["open"] - stats["idle"],
+    }
+
+def cacheMetrics(name):
+    # read from whatever cache the handler is using at scrape time
+    def collect():
+        stats = SquirrelServerHandler.cache.stats()
+        if name == "lookups":
+            return {(("result", "hit"),): stats["hits"], (("result", "miss"),): stats["misses"]}
+        return {(): stats[name]}
+    return collect
+
+METRICS.collector("squirrel_pool_connections", poolMetrics)
+METRICS.collector("squirrel_pool_size", lambda: {(): getPool().stats()["size"]})
+METRICS.collector("squirrel_cache_entries", cacheMetrics("entries"))
+METRICS.collector("squirrel_cache_bytes", cacheMetrics("bytes"))
+METRICS.collector("squirrel_cache_lookups_total", cacheMetrics("lookups"))
+
+def routed(handler):
+    # labels the request's metrics with the handle* method that served it;
+    # the innermost one wins when a handler hands off to another
+    @wraps(handler)
+    def wrapper(self, *args, **kwargs):
+        self.route = handler.__name__
+        return handler(self, *args, **kwargs)
+    return wrapper
+
+def etagFor(body):
+    return '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+
+def acceptedCoding(header):
+    # the coding of CODINGS the Accept-Encoding header prefers, or None to
+    # send the body as it is
+    if not header:
+        return None
+    weights = {}
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+    # identity only wins when the client ranks it above the others
+    coding, best = None, weights.get("identity", 0.0)
+    for name in CODINGS:
+        weight = weights.get(name, weights.get("*", 0.0))
+        if weight > best:
+            coding, best = name, weight
+    return coding
+
+def compressor(coding):
+    # gzip and zlib-wrapped deflate, which is what HTTP calls deflate
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31 if coding == "gzip" else 15)
+
+def compressBody(body, coding):
+    encoder = compressor(coding)
+    return encoder.compress(body) + encoder.flush()
+
+def codedEtag(etag, coding):
+    # a body in another coding is another representation, so another ETag
+    return '%s-%s"' % (etag[:-1], coding) if coding else etag
+
+def encodeSquirrel(squirrel):
+    # (body, ETag) for a row with its version. The version leads the ETag
+    # so If-Match can be checked by the write itself; ids are never reused,
+    # so the id and version alone name one state of one squirrel.
+    squirrel = dict(squirrel)
+    version = squirrel.pop("version")
+    body = encodeJson(squirrel)
+    return body, '"%d-%s"' % (version, etagFor(body).strip('"'))
+
+def matchVersions(header):
+    # row versions an If-Match header accepts; None for "*", any version.
+    # Weak tags never match and tags from elsewhere name no version.
+    if header.strip() == "*":
+        return None
+    versions = []
+    for tag in header.split(","):
+        version = tag.strip().removeprefix('"').split("-")[0]
+        if version.isdigit():
+            versions.append(int(version))
+    return versions
+
+def encodeJson(value):
+    # compact JSON straight to bytes; orjson when it is installed, which
+    # refuses a few things (e.g. lone surrogates) that json accepts
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+def joinJson(rows):
+    # (id, JSON text) rows as the bytes of a JSON array's elements
+    return ",".join([text for squirrelId, text in rows]).encode("utf-8")
+
+def squirrelKey(squirrelId):
+    # ids are cached under their integer value so /squirrels/01 and
+    # /squirrels/1 share an entry; anything else is not cached
+    if squirrelId.isascii() and squirrelId.isdigit():
+        return ("squirrel", int(squirrelId))
+    return None
+
+def parseFilters(query):
+    # ?size=, ?name_prefix=, ?fields=a,b and ?sort= as SquirrelDB query
+    # arguments; raises ValueError for fields or sorts it does not know
+    filters = {}
+    if "size" in query:
+        filters["size"] = query["size"]
+    if query.get("name_prefix"):
+        filters["namePrefix"] = query["name_prefix"]
+    if query.get("fields"):
+        filters["fields"] = tuple(query["fields"].split(","))
+    if query.get("sort"):
+        filters["sort"] = query["sort"]
+    squirrelQuery(**filters)
+    return filters
+
+def parseBulkItem(item):
+    # one element of a bulk request, already decoded or a raw NDJSON line;
+    # returns (op, params) or raises ValueError
+    if isinstance(item, (bytes, str)):
+        item = json.loads(item)
+    if not isinstance(item, dict):
+        raise ValueError("item must be a JSON object")
+    op = item.get("op", "create")
+    if op not in ("create", "update", "delete"):
+        raise ValueError("unknown op: %r" % op)
+    fields = {"create": ("name", "size"), "update": ("id", "name", "size"), "delete": ("id",)}[op]
+    missing = [field for field in fields if field not in item]
+    if missing:
+        raise ValueError("%s needs %s" % (op, ", ".join(missing)))
+    params = []
+    for field in fields:
+        value = item[field]
+        if field == "id":
+            if isinstance(value, bool) or not str(value).isdigit():
+                raise ValueError("id must be a positive integer")
+            value = int(value)
+        elif not isinstance(value, str):
+            raise ValueError("%s must be a string" % field)
+        params.append(value)
+    return op, params[0] if op == "delete" else tuple(params)
+
+def spoolLines(items, maxBytes=BULK_SPOOL_BYTES):
+    # reads a stream of NDJSON lines to the end, into memory and then a
+    # temporary file, and hands back an iterator over the copy; decoded
+    # items are already in memory and come back as they are
+    if isinstance(items, list):
+        return items
+    spool = tempfile.SpooledTemporaryFile(maxBytes)
+    for line in items:
+        spool.write(line if line.endswith(b"\n") else line + b"\n")
+    spool.seek(0)
+    return replayLines(spool)
+
+def replayLines(spool):
+    with spool:
+        yield from spool
 
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
+    protocol_version = "HTTP/1.1"
+    # headers and body go out as separate writes; without TCP_NODELAY the
+    # second one waits on the client's delayed ACK on a reused connection
+    disable_nagle_algorithm = True
+    timeout = IDLE_TIMEOUT
+    maxRequests = MAX_REQUESTS_PER_CONNECTION
+    requestsHandled = 0
+    keepAlive = False
+    cache = RESPONSE_CACHE
+    bulkBatchSize = BULK_BATCH
+    logSample = LOG_SAMPLE
+    metrics = METRICS
+    profiler = PROFILER
+    compressMinBytes = COMPRESS_MIN_BYTES
+    # the compressor of a streamed response, set by startStream
+    encoder = None
+    # set per request; phase timings are only taken for sampled requests
+    requestStart = None
+    timings = None
+    route = None
+    profile = None
+
+    # CONNECTION
+
+    def parse_request(self):
+        self.requestStart = time.perf_counter()
+        self.timings = {} if random.random() < self.logSample else None
+        if self.profiler.active:
+            self.profile = self.profiler.begin()
+        with self.phase("parse"):
+            ok = super().parse_request()
+        self.requestsHandled += 1
+        if self.requestsHandled >= self.maxRequests:
+            self.close_connection = True
+        return ok
+
+    def awaitRequest(self):
+        # an idle keep-alive connection holds one of a fixed set of workers;
+        # it is given up once other connections queue for one
+        busy = getattr(self.server, "busy", None)
+        if busy is None or not self.requestsHandled:
+            return True
+        deadline = time.monotonic() + self.timeout
+        self.connection.settimeout(0)
+        try:
+            # a pipelined request may already sit in the read buffer
+            if self.rfile.peek(1):
+                return True
+            while True:
+                wait = min(BUSY_IDLE_TIMEOUT, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
+                if select.select([self.connection], [], [], wait)[0]:
+                    return True
+                if busy():
+                    return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        if not self.awaitRequest():
+            self.close_connection = True
+            return
+        self.bodyRead = False
+        self.responseStarted = False
+        self.requestStart = None
+        self.route = None
+        self.statusCode = 0
+        self.bytesSent = 0
+        try:
+            super().handle_one_request()
+        except (sqlite3.OperationalError, PoolTimeout) as e:
+            # a locked database or an exhausted pool is worth retrying;
+            # nothing can be said once the response has begun
+            if self.responseStarted or not (isinstance(e, PoolTimeout) or isLocked(e)):
+                raise
+            self.close_connection = True
+            self.respond(503, bytes("503 Service Unavailable: database busy", "utf-8"), "text/plain", {"Retry-After": "1"})
+        finally:
+            if self.profile is not None:
+                self.profiler.end(self.profile)
+                self.profile = None
+        if not self.raw_requestline:
+            return
+        if not self.close_connection and not self.bodyRead:
+            # an unread body would otherwise be parsed as the next request
+            self.discardRequestData()
+        # remembered for servers that run one request per handler
+        self.keepAlive = not self.close_connection
+        if self.requestStart is not None:
+            self.logAccess()
+            self.recordMetrics()
+
+    def send_response(self, code, message=None):
+        self.responseStarted = True
+        self.statusCode = code
+        super().send_response(code, message)
+
+    # LOGGING
+
+    def log_request(self, code="-", size="-"):
+        # replaced by logAccess
+        return
+
+    def log_message(self, format, *args):
+        accessLog.warning("%s - %s", self.address_string(), format % args)
+
+    def logAccess(self):
+        if self.timings is None and self.statusCode < 500:
+            return
+        if not accessLog.isEnabledFor(logging.INFO):
+            return
+        entry = {
+            "client": self.client_address[0],
+            "method": self.command,
+            "path": self.path,
+            "status": self.statusCode,
+            "bytes": self.bytesSent,
+            "ms": round((time.perf_counter() - self.requestStart) * 1000, 3),
+        }
+        if self.timings:
+            entry["phases"] = {name: round(seconds * 1000, 3) for name, seconds in self.timings.items()}
+        accessLog.info("%s %s %s", self.command, self.path, self.statusCode, extra={"access": entry})
+
+    def recordMetrics(self):
+        route = self.route or "none"
+        self.metrics.inc("squirrel_requests_total", (("route", route), ("method", self.command or "-"), ("status", str(self.statusCode))))
+        self.metrics.inc("squirrel_response_bytes_total", (("route", route),), self.bytesSent)
+        self.metrics.observe("squirrel_request_seconds", (("route", route),), time.perf_counter() - self.requestStart)
+
+    @contextmanager
+    def phase(self, name):
+        # adds the time spent in the block to this request's timing for name
+        if self.timings is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
     # HTTP METHODS
 
     def do_GET(self):
@@ -14,13 +555,19 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
                 self.handleSquirrelsRetrieve(resourceId)
             else:
                 self.handleSquirrelsIndex()
+        elif resourceName == "metrics" and not resourceId:
+            self.handleMetrics()
         else:
             self.handle404()
 
     def do_POST(self):
         resourceName, resourceId = self.parsePath()
-        if resourceName == "squirrels":
-            if resourceId:
+        if resourceName == "_debug" and resourceId == "profile":
+            self.handleProfileStart()
+        elif resourceName == "squirrels":
+            if resourceId == "_bulk":
+                self.handleSquirrelsBulk()
+            elif resourceId:
                 self.handle404()
             else:
                 self.handleSquirrelsCreate()
@@ -39,7 +586,9 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     def do_DELETE(self):
         resourceName, resourceId = self.parsePath()
-        if resourceName == "squirrels":
+        if resourceName == "_debug" and resourceId == "profile":
+            self.handleProfileStop()
+        elif resourceName == "squirrels":
             if resourceId:
                 self.handleSquirrelsDelete(resourceId)
             else:
@@ -49,20 +598,181 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     # HELPERS
 
+    def openDB(self):
+        # the server's backend; handlers run without one (e.g. under test)
+        # get a SquirrelDB
+        backend = getattr(self.server, "backend", None)
+        return backend.open() if backend is not None else SquirrelDB()
+
     def getRequestData(self):
         length = int(self.headers["Content-Length"])
-        body = self.rfile.read(length).decode("utf-8")
-        print('\n\n\n Body in request data', body)
-        #  Body in request data {"name":"Fluffy","size":"large"}
-        # data = parse_qs(body)
-        data = json.loads(body)
-        print('\n\n\n data in request data', data)
-        print(data['name'], data['size'])
+        body = self.rfile.read(length)
+        # read, even if it turns out not to decode
+        self.bodyRead = True
+        with self.phase("parse"):
+            data = json.loads(body.decode("utf-8"))
+        return data
+
+    def readBulkItems(self):
+        # a JSON array is decoded up front; NDJSON is read a line at a time
+        # so the body never has to fit in memory
+        contentType = (self.headers.get("Content-Type") or "").partition(";")[0].strip().lower()
+        if contentType in NDJSON_TYPES:
+            return self.readLines()
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        self.bodyRead = True
+        items = json.loads(body)
+        if not isinstance(items, list):
+            raise ValueError("expected a JSON array")
+        return items
+
+    def readLines(self):
+        remaining = int(self.headers.get("Content-Length") or 0)
+        self.bodyRead = True
+        while remaining > 0:
+            line = self.rfile.readline(remaining)
+            if not line:
+                return
+            remaining -= len(line)
+            if line.strip():
+                yield line
+
+    def discardRequestData(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        self.bodyRead = True
+
+    def respond(self, status, body=b"", contentType=None, headers=None):
+        # every response is delimited so the connection can be reused;
+        # 204 and 304 responses carry no body and so no Content-Length either
+        if status == 200 and len(body) >= self.compressMinBytes and "Content-Encoding" not in (headers or {}):
+            headers = dict(headers or {}, Vary="Accept-Encoding")
+            coding = acceptedCoding(self.headers.get("Accept-Encoding"))
+            if coding is not None:
+                with self.phase("compress"):
+                    body = compressBody(body, coding)
+                headers["Content-Encoding"] = coding
+        with self.phase("write"):
+            self.send_response(status)
+            if contentType:
+                self.send_header("Content-Type", contentType)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if status not in (204, 304):
+                self.send_header("Content-Length", str(len(body)))
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+                self.bytesSent += len(body)
+
+    def respondTagged(self, body, etag, headers=None, key=None):
+        # with the cache key of body, its compressed form is taken from and
+        # kept in the cache
+        headers = dict(headers or {})
+        coding = None
+        if len(body) >= self.compressMinBytes:
+            headers["Vary"] = "Accept-Encoding"
+            coding = acceptedCoding(self.headers.get("Accept-Encoding"))
+        headers["ETag"] = codedEtag(etag, coding)
+        if self.etagMatches(headers["ETag"]):
+            self.respond(304, headers=headers)
+            return
+        if coding is not None:
+            body = self.compressed(body, etag, coding, key)
+            headers["Content-Encoding"] = coding
+        self.respond(200, body, "application/json", headers)
+
+    def compressed(self, body, etag, coding, key=None):
+        data = self.cache.getEncoded(key, coding, etag) if key else None
+        if data is None:
+            with self.phase("compress"):
+                data = compressBody(body, coding)
+            if key:
+                self.cache.putEncoded(key, coding, etag, data)
+        return data
+
+    def respondCached(self, key):
+        entry = self.cache.get(key) if key else None
+        if entry is None:
+            return False
+        self.respondTagged(*entry, key=key)
+        return True
+
+    def etagMatches(self, etag):
+        header = self.headers.get("If-None-Match")
+        if not header:
+            return False
+        if header.strip() == "*":
+            return True
+        return etag in [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+    def startStream(self, status, contentType):
+        # bodies of unknown length are chunked for HTTP/1.1 clients; HTTP/1.0
+        # clients read until the connection closes. Callers hold back bodies
+        # under compressMinBytes, so a stream is compressed whenever the
+        # client accepts it. Returns the coding used, or None.
+        self.chunked = self.request_version != "HTTP/1.0"
+        if not self.chunked:
+            self.close_connection = True
+        coding = acceptedCoding(self.headers.get("Accept-Encoding"))
+        self.encoder = compressor(coding) if coding else None
+        with self.phase("write"):
+            self.send_response(status)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Vary", "Accept-Encoding")
+            if coding:
+                self.send_header("Content-Encoding", coding)
+            if self.chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            self.end_headers()
+        return coding
+
+    def writeChunk(self, data):
+        # returns the bytes sent for data, which are fewer (or none yet)
+        # when compressing
+        if self.encoder is not None:
+            with self.phase("compress"):
+                data = self.encoder.compress(data)
+        self.writeRaw(data)
         return data
 
+    def endStream(self):
+        # returns the last of the compressed bytes
+        data = b""
+        if self.encoder is not None:
+            with self.phase("compress"):
+                data = self.encoder.flush()
+            self.writeRaw(data)
+        if self.chunked:
+            with self.phase("write"):
+                self.wfile.write(b"0\r\n\r\n")
+        return data
+
+    def writeRaw(self, data):
+        # an empty chunk would end the body
+        if not data:
+            return
+        with self.phase("write"):
+            if self.chunked:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+        self.bytesSent += len(data)
+
+    def parseQuery(self):
+        query = parse_qs(self.path.partition("?")[2])
+        return {name: values[-1] for name, values in query.items()}
+
     def parsePath(self):
-        if self.path.startswith("/"):
-            parts = self.path[1:].split("/")
+        path = self.path.partition("?")[0]
+        if path.startswith("/"):
+            parts = path[1:].split("/")
             resourceName = parts[0]
             resourceId = None
             if len(parts) > 1:
@@ -72,65 +782,667 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     # ACTIONS
 
+    # each handler borrows a pooled connection for the duration of the request
+
+    @routed
     def handleSquirrelsIndex(self):
-        db = SquirrelDB()
-        squirrelsList = db.getSquirrels()
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(bytes(json.dumps(squirrelsList), "utf-8"))
+        query = self.parseQuery()
+        try:
+            filters = parseFilters(query)
+        except ValueError as e:
+            self.handle400(str(e))
+            return
+        if "limit" in query or "after_id" in query:
+            self.handleSquirrelsPage(query, filters)
+            return
+        key = ("squirrels", tuple(sorted(filters.items())))
+        if self.respondCached(key):
+            return
+        generation = self.cache.generation
+        # rows are encoded a batch at a time so memory does not grow with the
+        # table; the body, and what was sent for it when compressed, are
+        # kept for the cache only while small enough. The stream starts once
+        # compressMinBytes are held, so a smaller list goes out as it is.
+        chunks, sent, size = [], [], 0
+        held, coding = [], None
+        with self.openDB() as db:
+            with self.phase("db"):
+                batches = db.streamSquirrelsJson(**filters)
+            prefix = b"["
+            while True:
+                with self.phase("db"):
+                    rows = next(batches, None)
+                if rows is None:
+                    break
+                with self.phase("serialize"):
+                    data = prefix + joinJson(rows)
+                prefix = b","
+                if held is None:
+                    sent.append(self.writeChunk(data))
+                else:
+                    held.append(data)
+                    if sum(map(len, held)) >= self.compressMinBytes:
+                        coding = self.startStream(200, "application/json")
+                        sent.append(self.writeChunk(b"".join(held)))
+                        held = None
+                if chunks is not None:
+                    chunks.append(data)
+                    size += len(data)
+                    if size > self.cache.maxEntryBytes:
+                        chunks = None
+            data = b"[]" if prefix == b"[" else b"]"
+            if held is None:
+                sent.append(self.writeChunk(data))
+                sent.append(self.endStream())
+        if held is not None:
+            # the whole list was under the threshold: sent, and tagged, in one
+            body = b"".join(held) + data
+            self.respondTagged(body, self.cache.put(key, body, generation=generation), key=key)
+            return
+        if chunks is not None:
+            body = b"".join(chunks) + data
+            etag = self.cache.put(key, body, generation=generation)
+            if coding and len(body) >= self.compressMinBytes:
+                self.cache.putEncoded(key, coding, etag, b"".join(sent))
+
+    @routed
+    def handleSquirrelsPage(self, query, filters):
+        try:
+            limit = min(int(query.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE)
+            afterId = int(query["after_id"]) if "after_id" in query else None
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            self.handle400("limit and after_id must be integers, limit at least 1")
+            return
+        if afterId is not None and filters.get("sort", "id") != "id":
+            self.handle400("after_id only works with sort=id")
+            return
+        key = ("squirrels", tuple(sorted(filters.items())), limit, afterId)
+        if self.respondCached(key):
+            return
+        generation = self.cache.generation
+        with self.phase("db"), self.openDB() as db:
+            rows = db.querySquirrelsJson(limit=limit, afterId=afterId, **filters)
+        headers = {}
+        if len(rows) == limit and filters.get("sort", "id") == "id":
+            # the next page keeps every other parameter of this one
+            following = dict(query, limit=limit, after_id=rows[-1][0])
+            headers["Link"] = '</squirrels?%s>; rel="next"' % urlencode(following, safe=",")
+        with self.phase("serialize"):
+            body = b"[" + joinJson(rows) + b"]"
+        self.respondTagged(body, self.cache.put(key, body, headers, generation), headers, key)
 
+    @routed
     def handleSquirrelsRetrieve(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        key = squirrelKey(squirrelId)
+        if self.respondCached(key):
+            return
+        generation = self.cache.generation
+        with self.phase("db"), self.openDB() as db:
+            squirrel = db.getSquirrel(squirrelId)
         if squirrel:
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json.dumps(squirrel), "utf-8"))
+            with self.phase("serialize"):
+                body, etag = encodeSquirrel(squirrel)
+            if key:
+                self.cache.put(key, body, generation=generation, etag=etag)
+            self.respondTagged(body, etag, key=key)
         else:
             self.handle404()
 
+    @routed
     def handleSquirrelsCreate(self):
-        db = SquirrelDB()
         body = self.getRequestData()
-        db.createSquirrel(body["name"], body["size"])
-        self.send_response(201)
-        self.end_headers()
+        with self.phase("db"), self.openDB() as db:
+            db.createSquirrel(body["name"], body["size"])
+        self.cache.invalidateGroup("squirrels")
+        self.respond(201)
+
+    @routed
+    def handleSquirrelsBulk(self):
+        try:
+            items = self.readBulkItems()
+            if getattr(getattr(self.server, "backend", None), "bufferBulk", False):
+                # the backend's write lock holds up other requests, so a
+                # slow upload is read in full before the transaction starts
+                items = spoolLines(items)
+        except ValueError as e:
+            self.handle400(str(e))
+            return
+        # consecutive items with the same op go to the database together;
+        # everything commits as one transaction
+        results = []
+        run, runOp = [], None
+        with self.phase("db"), self.openDB() as db:
+            for item in items:
+                index = len(results)
+                results.append(None)
+                try:
+                    op, params = parseBulkItem(item)
+                except ValueError as e:
+                    results[index] = {"status": 400, "error": str(e)}
+                    continue
+                if op != runOp or len(run) >= self.bulkBatchSize:
+                    self.flushBulk(db, runOp, run, results)
+                    run, runOp = [], op
+                run.append((index, params))
+            self.flushBulk(db, runOp, run, results)
+            db.commit()
+        self.cache.clear()
+        with self.phase("serialize"):
+            body = encodeJson(results)
+        self.respond(200, body, "application/json")
+
+    def flushBulk(self, db, op, run, results):
+        if not run:
+            return
+        params = [params for index, params in run]
+        if op == "create":
+            db.bulkCreateSquirrels(params, self.bulkBatchSize, commit=False)
+            found, status = [True] * len(run), 201
+        elif op == "update":
+            found, status = db.bulkUpdateSquirrels(params, self.bulkBatchSize, commit=False), 204
+        else:
+            found, status = db.bulkDeleteSquirrels(params, self.bulkBatchSize, commit=False), 204
+        for (index, _), ok in zip(run, found):
+            results[index] = {"status": status if ok else 404}
+
+    # Updates and deletes are one statement. With If-Match they only apply
+    # while the row is at a version the client has seen; otherwise 412, or
+    # 404 if the row is gone, which costs a second lookup only on failure.
 
+    @routed
     def handleSquirrelsUpdate(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        body = self.getRequestData()
+        versions = self.ifMatch()
+        with self.phase("db"), self.openDB() as db:
+            squirrel = db.updateSquirrel(squirrelId, body["name"], body["size"], versions)
+            exists = squirrel is not None or (versions is not None and db.squirrelVersion(squirrelId) is not None)
         if squirrel:
-            body = self.getRequestData()
-            db.updateSquirrel(squirrelId, body["name"], body["size"])
-            self.send_response(204)
-            self.end_headers()
+            self.invalidateSquirrel(squirrelId)
+            self.respond(204, headers={"ETag": encodeSquirrel(squirrel)[1]})
+        elif exists:
+            self.handle412()
         else:
             self.handle404()
 
+    @routed
     def handleSquirrelsDelete(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
-        if squirrel:
-            db.deleteSquirrel(squirrelId)
-            self.send_response(204)
-            self.end_headers()
+        versions = self.ifMatch()
+        with self.phase("db"), self.openDB() as db:
+            deleted = db.deleteSquirrel(squirrelId, versions)
+            exists = deleted or (versions is not None and db.squirrelVersion(squirrelId) is not None)
+        if deleted:
+            self.invalidateSquirrel(squirrelId)
+            self.respond(204)
+        elif exists:
+            self.handle412()
         else:
             self.handle404()
 
+    def debugAllowed(self):
+        # the _debug endpoints only exist once the profiler has a directory,
+        # and take its token when it has one
+        if self.profiler.directory is None:
+            self.handle404()
+            return False
+        token = self.profiler.token
+        if token and not hmac.compare_digest(self.headers.get("Authorization", "").encode(), ("Bearer " + token).encode()):
+            self.respond(403, bytes("403 Forbidden", "utf-8"), "text/plain")
+            return False
+        return True
+
+    def ifMatch(self):
+        # row versions the request is conditional on; None when it is not
+        header = self.headers.get("If-Match")
+        return matchVersions(header) if header else None
+
+    def invalidateSquirrel(self, squirrelId):
+        self.cache.invalidateGroup("squirrels")
+        key = squirrelKey(squirrelId)
+        if key:
+            self.cache.invalidate(key)
+
+    def handle400(self, message):
+        self.respond(400, bytes("400 Bad Request: " + message, "utf-8"), "text/plain")
+
+    def handle412(self):
+        self.respond(412, bytes("412 Precondition Failed", "utf-8"), "text/plain")
+
+    @routed
     def handle404(self):
-        self.send_response(404)
-        self.send_header("Content-Type", "text/plain")
-        self.end_headers()
-        self.wfile.write(bytes("404 Not Found", "utf-8"))
+        self.respond(404, bytes("404 Not Found", "utf-8"), "text/plain")
+
+    @routed
+    def handleProfileStart(self):
+        if not self.debugAllowed():
+            return
+        query = self.parseQuery()
+        try:
+            session = self.profiler.start(float(query.get("seconds", PROFILE_SECONDS)), float(query.get("sample", PROFILE_SAMPLE)),
+                                          query.get("allocations", "1") != "0")
+        except ValueError as e:
+            self.handle400(str(e))
+            return
+        except ProfileRunning as e:
+            self.respond(409, bytes("409 Conflict: " + str(e), "utf-8"), "text/plain")
+            return
+        self.respond(202, encodeJson(session), "application/json")
+
+    @routed
+    def handleProfileStop(self):
+        if not self.debugAllowed():
+            return
+        files = self.profiler.stop()
+        if files is None:
+            self.respond(409, bytes("409 Conflict: no profile is running", "utf-8"), "text/plain")
+            return
+        self.respond(200, encodeJson({"files": files}), "application/json")
+
+    @routed
+    def handleMetrics(self):
+        self.respond(200, bytes(self.metrics.render(), "utf-8"), METRICS_CONTENT_TYPE)
+
+# SERVERS
+
+class SquirrelHTTPServer(HTTPServer):
+
+    # Chooses the storage backend once; every handler opens it through
+    # self.server.backend. Given a sock it accepts on that listening
+    # socket (see listenSocket) instead of binding address itself.
+
+    def __init__(self, address, handlerClass, backend=None, sock=None):
+        super().__init__(address, handlerClass, bind_and_activate=sock is None)
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+        self.backend = backend or SQLiteBackend()
+
+class PooledHTTPServer(SquirrelHTTPServer):
+
+    # Accepted connections are handed to a fixed set of worker threads
+    # through a bounded queue; when the queue is full the connection gets
+    # an immediate 503 instead of waiting. A worker idling on a keep-alive
+    # connection lets it go after BUSY_IDLE_TIMEOUT once the queue is not
+    # empty.
+
+    def __init__(self, address, handlerClass, workers=WORKERS, queueSize=QUEUE_SIZE, backend=None, sock=None):
+        super().__init__(address, handlerClass, backend, sock)
+        self.requests = queue.Queue(queueSize)
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def busy(self):
+        return not self.requests.empty()
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except queue.Full:
+            METRICS.inc("squirrel_connections_rejected_total")
+            try:
+                request.sendall(SERVICE_UNAVAILABLE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
 
-def run():
-    print("squirrel_server running at 127.0.0.1:8080")
+    def server_close(self):
+        # workers finish everything already queued before they exit
+        super().server_close()
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            METRICS.inc("squirrel_connections_open")
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                METRICS.inc("squirrel_connections_open", value=-1)
+                self.shutdown_request(request)
+
+class BufferedConnection:
+
+    # Socket stand-in that runs a handler over a request already read off
+    # the wire and collects the response it writes.
+
+    def __init__(self, data):
+        self.data = data
+        self.output = io.BytesIO()
+
+    def makefile(self, mode, *args, **kwargs):
+        return io.BytesIO(self.data)
+
+    def sendall(self, data):
+        self.output.write(data)
+
+    def settimeout(self, timeout):
+        return
+
+    def setsockopt(self, *args):
+        return
+
+class AsyncSquirrelServer:
+
+    # Reads requests with asyncio and runs SquirrelServerHandler for each of
+    # them on a worker thread, so routing and handle* behave exactly as in
+    # the threaded servers. Requests beyond workers + queueSize in flight
+    # are answered with 503.
+
+    def __init__(self, address, handlerClass, workers=WORKERS, queueSize=QUEUE_SIZE, backend=None, sock=None):
+        self.server_address = address
+        self.RequestHandlerClass = handlerClass
+        self.backend = backend or SQLiteBackend()
+        self.sock = sock
+        self.maxInFlight = workers + queueSize
+        self.inFlight = 0
+        self.executor = ThreadPoolExecutor(workers)
+        self._connections = set()
+
+    async def serve(self, stop):
+        if self.sock is not None:
+            server = await asyncio.start_server(self._handleConnection, sock=self.sock)
+        else:
+            server = await asyncio.start_server(self._handleConnection, *self.server_address)
+        async with server:
+            await stop.wait()
+            server.close()
+            await server.wait_closed()
+        if self._connections:
+            done, pending = await asyncio.wait(self._connections, timeout=SHUTDOWN_GRACE)
+            for task in pending:
+                task.cancel()
+        self.executor.shutdown(wait=True)
+
+    def dispatch(self, request, peer):
+        conn = BufferedConnection(request)
+        handler = self.RequestHandlerClass(conn, peer, self)
+        return conn.output.getvalue(), not handler.keepAlive
+
+    async def _handleConnection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        peer = writer.get_extra_info("peername")
+        loop = asyncio.get_running_loop()
+        handled = 0
+        METRICS.inc("squirrel_connections_open")
+        try:
+            while handled < self.RequestHandlerClass.maxRequests:
+                try:
+                    request = await asyncio.wait_for(self._readRequest(reader), self.RequestHandlerClass.timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    break
+                handled += 1
+                if self.inFlight >= self.maxInFlight:
+                    METRICS.inc("squirrel_connections_rejected_total")
+                    writer.write(SERVICE_UNAVAILABLE)
+                    await writer.drain()
+                    break
+                self.inFlight += 1
+                try:
+                    response, close = await loop.run_in_executor(self.executor, self.dispatch, request, peer)
+                finally:
+                    self.inFlight -= 1
+                writer.write(response)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            METRICS.inc("squirrel_connections_open", value=-1)
+            self._connections.discard(task)
+            writer.close()
+
+    async def _readRequest(self, reader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        length = 0
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = int(value)
+        body = await reader.readexactly(length) if length else b""
+        return head + body
+
+class PreforkSupervisor:
+
+    # Forks processes workers that all accept on one listening socket, so
+    # requests spread over as many GILs. Each worker runs serveWorker(sock)
+    # and has its own connection pool, response cache and access log. A
+    # worker that exits on its own is forked again. SIGHUP forks a fresh
+    # set of workers and then stops the old ones, so nothing is refused
+    # while they change over; SIGTERM/SIGINT stop them all (a second one
+    # kills them). Workers stop as the threaded server does: no new
+    # connections, and what they already accepted is finished.
+    #
+    # The supervisor starts no threads, so forking is safe, and waits for
+    # signals with sigwaitinfo rather than in handlers.
+
+    signals = {signal.SIGCHLD, signal.SIGHUP, signal.SIGINT, signal.SIGTERM}
+
+    def __init__(self, sock, processes, serveWorker, restartDelay=RESTART_DELAY):
+        self.sock = sock
+        self.processes = processes
+        self.serveWorker = serveWorker
+        self.restartDelay = restartDelay
+        # pid -> (generation, start time); SIGHUP starts a new generation
+        self.workers = {}
+        self.generation = 0
+        self.stopping = False
+
+    def run(self):
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.signals)
+        try:
+            for _ in range(self.processes):
+                self.spawn()
+            while self.workers:
+                signum = signal.sigwaitinfo(self.signals).si_signo
+                if signum == signal.SIGCHLD:
+                    self.reap()
+                elif signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.signals)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self._work()
+        self.workers[pid] = (self.generation, time.monotonic())
+        return pid
+
+    def reap(self):
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            generation, started = self.workers.pop(pid, (None, 0))
+            if self.stopping or generation != self.generation:
+                continue
+            print("squirrel_server worker %d exited with status %d, restarting" % (pid, os.waitstatus_to_exitcode(status)), file=sys.stderr)
+            if time.monotonic() - started < self.restartDelay:
+                time.sleep(self.restartDelay)
+            self.spawn()
+
+    def reload(self):
+        if self.stopping:
+            return
+        old = list(self.workers)
+        self.generation += 1
+        for _ in range(self.processes):
+            self.spawn()
+        self._signal(old, signal.SIGTERM)
+
+    def stop(self):
+        self._signal(list(self.workers), signal.SIGKILL if self.stopping else signal.SIGTERM)
+        self.stopping = True
+
+    def _signal(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _work(self):
+        # in the forked worker; never returns
+        status = 1
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.signals)
+            self.serveWorker(self.sock)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+def listenSocket(address):
+    # the socket prefork workers share. It is non-blocking so that workers
+    # woken for a connection another one accepted go back to waiting
+    # instead of blocking in accept().
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+def runThreaded(server):
+    # SIGTERM stops accepting and lets queued requests finish; shutdown()
+    # has to be called from a thread other than the one serving
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+async def runAsync(server):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await server.serve(stop)
+
+def openBackend(name, snapshotPath=None, snapshotInterval=SNAPSHOT_INTERVAL, groupCommit=0, groupCommitWait=GROUP_COMMIT_WAIT):
+    if name == "sqlite":
+        # groupCommit > 1 commits up to that many concurrent writes together
+        writer = GroupCommitWriter(maxBatch=groupCommit, maxWait=groupCommitWait) if groupCommit > 1 else None
+        return SQLiteBackend(writer=writer)
+    if name != "memory":
+        raise ValueError("unknown backend: %r" % name)
+    # the memory backend starts from its snapshot, or else from the
+    # database the pool is configured for
+    backend = MemoryBackend(snapshotPath, snapshotInterval)
+    if not backend.restored:
+        # with versions, and the ids of deleted squirrels kept retired
+        with SquirrelDB() as db:
+            for rows in db.streamSquirrelRows():
+                backend.load(rows)
+            backend.load([], db.lastSquirrelId())
+    return backend
+
+def serve(mode, listen, store, workers=WORKERS, queueSize=QUEUE_SIZE, sock=None, handlerClass=SquirrelServerHandler):
+    if mode == "async":
+        asyncio.run(runAsync(AsyncSquirrelServer(listen, handlerClass, workers, queueSize, store, sock)))
+    elif mode == "threaded":
+        runThreaded(PooledHTTPServer(listen, handlerClass, workers, queueSize, store, sock))
+    else:
+        runThreaded(SquirrelHTTPServer(listen, handlerClass, store, sock))
+
+def run(mode="single", workers=WORKERS, queueSize=QUEUE_SIZE, dbPath=DB_PATH, poolSize=POOL_SIZE, poolTimeout=POOL_TIMEOUT, pragmas=None, logSample=LOG_SAMPLE,
+        backend="sqlite", snapshotPath=None, snapshotInterval=SNAPSHOT_INTERVAL, processes=1, groupCommit=0, groupCommitWait=GROUP_COMMIT_WAIT,
+        profileDir=None, debugToken=None):
+    if mode not in MODES:
+        raise ValueError("unknown server mode: %r" % mode)
+    if processes > 1 and backend != "sqlite":
+        # every process would have squirrels of its own
+        raise ValueError("the %s backend cannot be shared by several processes" % backend)
     listen = ("127.0.0.1", 8080)
-    server = HTTPServer(listen, SquirrelServerHandler)
-    server.serve_forever()
+    if profileDir is not None and not debugToken:
+        # the _debug endpoints write files and slow requests down, so they
+        # are never left open to anyone who asks
+        debugToken = secrets.token_urlsafe(24)
+        print("squirrel_server /_debug token: %s" % debugToken, flush=True)
+    PROFILER.directory = profileDir
+    PROFILER.token = debugToken
+
+    def serveProcess(sock=None):
+        # opened in each worker process: SQLite connections and logging
+        # threads do not survive a fork
+        configurePool(dbPath, poolSize, poolTimeout, pragmas)
+        store = openBackend(backend, snapshotPath, snapshotInterval, groupCommit, groupCommitWait)
+        listener = startLogging(sample=logSample)
+        try:
+            serve(mode, listen, store, workers, queueSize, sock)
+        finally:
+            store.shutdown()
+            closePool()
+            listener.stop()
+
+    if processes <= 1:
+        print("squirrel_server running at 127.0.0.1:8080 (%s, %s)" % (mode, backend))
+        serveProcess()
+        return
+    # a process only invalidates its own cache, and would go on serving
+    # what a write through another one replaced
+    RESPONSE_CACHE.disable()
+    sock = listenSocket(listen)
+    print("squirrel_server running at 127.0.0.1:8080 (%s, %s, %d processes, pid %d)" % (mode, backend, processes, os.getpid()), flush=True)
+    try:
+        PreforkSupervisor(sock, processes, serveProcess).run()
+    finally:
+        sock.close()
 
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=MODES, default="single")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE)
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the listening socket, each serving --mode with --workers threads")
+    parser.add_argument("--pragma", action="append", default=[], metavar="NAME=VALUE",
+                        help="SQLite pragma for every connection, e.g. synchronous=full")
+    parser.add_argument("--log-sample", type=float, default=LOG_SAMPLE,
+                        help="share of requests in the access log (5xx are always logged)")
+    parser.add_argument("--backend", choices=BACKENDS, default="sqlite",
+                        help="memory serves from RAM, loaded from --snapshot or else the database")
+    parser.add_argument("--snapshot", metavar="PATH", help="file the memory backend is saved to and restored from")
+    parser.add_argument("--snapshot-interval", type=float, default=SNAPSHOT_INTERVAL, metavar="SECONDS")
+    parser.add_argument("--group-commit", type=int, default=0, metavar="N",
+                        help="commit up to N concurrent writes in one transaction (sqlite backend; 0 = one each)")
+    parser.add_argument("--profile-dir", metavar="PATH",
+                        help="enables POST /_debug/profile, writing .pstats and allocation reports here")
+    parser.add_argument("--debug-token", help="required as 'Authorization: Bearer TOKEN' by the /_debug endpoints (generated and printed when not given)")
+    parser.add_argument("--group-commit-wait", type=float, default=GROUP_COMMIT_WAIT * 1000, metavar="MS",
+                        help="how long the first write of a group waits for others")
+    args = parser.parse_args()
+    pragmas = dict(pragma.split("=", 1) for pragma in args.pragma)
+    # the group commit writer keeps a connection of its own
+    poolSize = max(POOL_SIZE, args.workers) + (args.group_commit > 1)
+    run(args.mode, args.workers, args.queue_size, poolSize=poolSize, pragmas=pragmas,
+        logSample=args.log_sample, backend=args.backend, snapshotPath=args.snapshot, snapshotInterval=args.snapshot_interval,
+        processes=args.processes, groupCommit=args.group_commit, groupCommitWait=args.group_commit_wait / 1000,
+        profileDir=args.profile_dir, debugToken=args.debug_token)
 
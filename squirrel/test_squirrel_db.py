@@ -0,0 +1,492 @@
+import sqlite3
+import threading
+import pytest
+import squirrel_db
+from squirrel_metrics import METRICS
+from squirrel_db import ConnectionPool, PoolTimeout, DatabaseBusy, SquirrelDB, SQLiteBackend, GroupCommitWriter, dict_factory, batches, squirrelQuery, materialize
+
+@pytest.fixture
+def mock_connect(mocker):
+    return mocker.patch("sqlite3.connect", side_effect=lambda *args, **kwargs: mocker.Mock(in_transaction=False))
+
+# a real database in a temporary file with squirrels 1..5
+@pytest.fixture
+def squirrel_pool(tmp_path):
+    path = str(tmp_path / "squirrels.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE squirrels (id INTEGER PRIMARY KEY, name TEXT, size TEXT)")
+    conn.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)", [("s%d" % i, "small") for i in range(1, 6)])
+    conn.commit()
+    conn.close()
+    pool = ConnectionPool(path, size=1)
+    yield pool
+    pool.close()
+
+def describe_ConnectionPool():
+
+    def describe_acquire():
+        def it_opens_a_connection_to_the_configured_path(mock_connect):
+            pool = ConnectionPool("test.db", size=1)
+            pool.acquire()
+            mock_connect.assert_called_once_with("test.db", check_same_thread=False)
+
+        def it_reuses_a_released_connection(mock_connect):
+            pool = ConnectionPool("test.db", size=2)
+            conn = pool.acquire()
+            pool.release(conn)
+
+            assert pool.acquire() is conn
+            mock_connect.assert_called_once()
+
+        def it_hands_a_thread_back_the_connection_it_used_last(mock_connect):
+            pool = ConnectionPool("test.db", size=2)
+            mine = pool.acquire()
+            other = []
+            worker = threading.Thread(target=lambda: other.append(pool.acquire()))
+            worker.start()
+            worker.join()
+            pool.release(mine)
+            pool.release(other[0])
+
+            assert pool.acquire() is mine
+
+        def it_raises_pool_timeout_when_every_connection_is_busy(mock_connect):
+            pool = ConnectionPool("test.db", size=1, timeout=0)
+            pool.acquire()
+
+            with pytest.raises(PoolTimeout):
+                pool.acquire()
+
+        def it_replaces_a_stale_connection_that_fails_its_health_check(mocker, mock_connect):
+            pool = ConnectionPool("test.db", size=1)
+            conn = pool.acquire()
+            pool.release(conn)
+            conn.execute.side_effect = sqlite3.OperationalError("disk I/O error")
+            mocker.patch("time.monotonic", return_value=10 ** 6)
+
+            fresh = pool.acquire()
+
+            conn.close.assert_called_once()
+            assert fresh is not conn
+
+        def it_frees_the_slot_when_connecting_fails(mocker):
+            mocker.patch("sqlite3.connect", side_effect=sqlite3.OperationalError("unable to open"))
+            pool = ConnectionPool("test.db", size=1, timeout=0)
+
+            with pytest.raises(sqlite3.OperationalError):
+                pool.acquire()
+            with pytest.raises(sqlite3.OperationalError):
+                pool.acquire()
+
+        def it_creates_the_schema_and_indexes_on_first_connect(tmp_path):
+            pool = ConnectionPool(str(tmp_path / "new.db"), size=1)
+            conn = pool.acquire()
+            names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+            assert {"squirrels", "squirrels_name", "squirrels_size"} <= names
+
+        def it_rebuilds_a_table_without_autoincrement(squirrel_pool):
+            conn = squirrel_pool.acquire()
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'squirrels'").fetchone()[0]
+            names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+            assert "AUTOINCREMENT" in sql
+            assert {"squirrels_name", "squirrels_size"} <= names
+            assert conn.execute("SELECT count(*) FROM squirrels").fetchone()[0] == 5
+
+        def it_switches_the_database_to_wal(tmp_path):
+            conn = ConnectionPool(str(tmp_path / "new.db"), size=1).acquire()
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+        def it_applies_configured_pragmas(tmp_path):
+            conn = ConnectionPool(str(tmp_path / "new.db"), size=1, pragmas={"synchronous": "full"}).acquire()
+            assert conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+            assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+
+        def it_begins_write_transactions_immediately(mock_connect):
+            conn = ConnectionPool("test.db", size=1).acquire()
+            assert conn.isolation_level == "IMMEDIATE"
+
+    def describe_release():
+        def it_rolls_back_an_open_transaction(mock_connect):
+            pool = ConnectionPool("test.db", size=1)
+            conn = pool.acquire()
+            conn.in_transaction = True
+
+            pool.release(conn)
+
+            conn.rollback.assert_called_once()
+
+    def describe_stats():
+        def it_counts_open_and_idle_connections(mock_connect):
+            pool = ConnectionPool("test.db", size=2)
+            first = pool.acquire()
+            pool.acquire()
+            pool.release(first)
+
+            assert pool.stats() == {"size": 2, "open": 2, "idle": 1}
+
+    def describe_close():
+        def it_closes_idle_connections(mock_connect):
+            pool = ConnectionPool("test.db", size=1)
+            conn = pool.acquire()
+            pool.release(conn)
+
+            pool.close()
+
+            conn.close.assert_called_once()
+
+        def it_closes_connections_released_after_shutdown(mock_connect):
+            pool = ConnectionPool("test.db", size=1)
+            conn = pool.acquire()
+            pool.close()
+
+            pool.release(conn)
+
+            conn.close.assert_called_once()
+
+        def it_refuses_to_hand_out_connections_afterwards(mock_connect):
+            pool = ConnectionPool("test.db", size=1)
+            pool.close()
+
+            with pytest.raises(RuntimeError):
+                pool.acquire()
+
+def describe_SquirrelDB():
+
+    def describe_init():
+        def it_draws_a_connection_from_the_pool(mocker):
+            pool = mocker.Mock()
+            db = SquirrelDB(pool)
+            pool.acquire.assert_called_once_with()
+            assert db.connection is pool.acquire.return_value
+
+        def it_uses_dict_rows(mocker):
+            pool = mocker.Mock()
+            db = SquirrelDB(pool)
+            assert db.connection.row_factory is dict_factory
+
+        def it_defaults_to_the_shared_pool(mocker):
+            mock_get_pool = mocker.patch.object(squirrel_db, "getPool")
+            SquirrelDB()
+            mock_get_pool.assert_called_once_with()
+
+    def describe_close():
+        def it_returns_the_connection_to_the_pool(mocker):
+            pool = mocker.Mock()
+            db = SquirrelDB(pool)
+            conn = db.connection
+
+            db.close()
+
+            pool.release.assert_called_once_with(conn)
+
+        def it_is_called_on_leaving_a_with_block(mocker):
+            pool = mocker.Mock()
+            with SquirrelDB(pool):
+                pass
+            pool.release.assert_called_once()
+
+        def it_does_nothing_without_a_connection(mocker):
+            mocker.patch.object(SquirrelDB, "__init__", return_value=None)
+            db = SquirrelDB()
+            db.close()
+            assert db.connection is None
+
+    def describe_write_retries():
+        @pytest.fixture
+        def mock_sleep(mocker):
+            return mocker.patch("time.sleep")
+
+        def it_retries_a_write_while_the_database_is_locked(mocker, mock_sleep):
+            db = SquirrelDB(mocker.Mock())
+            db.connection.in_transaction = False
+            db.cursor.execute.side_effect = [sqlite3.OperationalError("database is locked"), None]
+            db.createSquirrel("a", "small")
+            assert db.cursor.execute.call_count == 2
+            db.connection.commit.assert_called_once()
+
+        def it_raises_database_busy_when_retries_run_out(mocker, mock_sleep):
+            db = SquirrelDB(mocker.Mock())
+            db.connection.in_transaction = False
+            db.cursor.execute.side_effect = sqlite3.OperationalError("database is locked")
+            with pytest.raises(DatabaseBusy):
+                db.deleteSquirrel(1)
+            assert [args[0] for args, kwargs in mock_sleep.call_args_list] == [0.05, 0.1, 0.2]
+
+        def it_does_not_retry_other_errors(mocker, mock_sleep):
+            db = SquirrelDB(mocker.Mock())
+            db.cursor.execute.side_effect = sqlite3.OperationalError("no such table: squirrels")
+            with pytest.raises(sqlite3.OperationalError, match="no such table"):
+                db.updateSquirrel(1, "a", "small")
+            mock_sleep.assert_not_called()
+
+    def describe_getSquirrels():
+        def it_returns_every_squirrel_in_id_order(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert [row["id"] for row in db.getSquirrels()] == [1, 2, 3, 4, 5]
+
+        def it_returns_a_page_after_the_given_id(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert [row["id"] for row in db.getSquirrels(2, 1)] == [2, 3]
+
+        def it_returns_the_rest_without_a_limit(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert [row["id"] for row in db.getSquirrels(afterId=3)] == [4, 5]
+
+    def describe_querySquirrels():
+        def it_filters_by_size(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                db.updateSquirrel(2, "s2", "large")
+                assert [row["id"] for row in db.querySquirrels(size="large")] == [2]
+
+        def it_filters_by_name_prefix(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                db.createSquirrel("Fluffy", "large")
+                db.createSquirrel("Flash", "small")
+                db.createSquirrel("Acorn", "small")
+                assert [row["name"] for row in db.querySquirrels(namePrefix="Fl", sort="name")] == ["Flash", "Fluffy"]
+
+        def it_fetches_only_the_requested_fields(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert db.querySquirrels(fields=("name",), limit=1) == [{"id": 1, "name": "s1"}]
+                assert db.querySquirrels(fields=("name",))[0] == {"name": "s1"}
+
+        def it_sorts_descending(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert [row["id"] for row in db.querySquirrels(sort="-id", limit=2)] == [5, 4]
+
+        def it_uses_the_size_index(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                sql, data = squirrelQuery(size="large")
+                plan = " ".join(row["detail"] for row in db.cursor.execute("EXPLAIN QUERY PLAN " + sql, data))
+                assert "squirrels_size" in plan
+
+    def describe_squirrelQuery():
+        def it_only_ever_binds_values_as_parameters():
+            sql, data = squirrelQuery(size="x' OR 1=1 --", namePrefix="a")
+            assert "x'" not in sql
+            assert data == ["x' OR 1=1 --", "a", "a\U0010ffff"]
+
+        def it_rejects_unknown_fields():
+            with pytest.raises(ValueError):
+                squirrelQuery(fields=("id", "name FROM squirrels; --"))
+
+        def it_rejects_unknown_sorts():
+            with pytest.raises(ValueError):
+                squirrelQuery(sort="random()")
+
+    def describe_querySquirrelsJson():
+        def it_returns_ids_with_json_encoded_by_sqlite(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                rows = db.querySquirrelsJson(limit=2)
+            assert rows == [(1, '{"id":1,"name":"s1","size":"small"}'), (2, '{"id":2,"name":"s2","size":"small"}')]
+
+        def it_projects_and_filters_like_querySquirrels(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                db.updateSquirrel(3, "s3", "large")
+                assert db.querySquirrelsJson(size="large", fields=("name",)) == [(3, '{"name":"s3"}')]
+
+    def describe_streamSquirrelsJson():
+        def it_yields_json_rows_in_batches(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                batches = [[squirrelId for squirrelId, text in rows] for rows in db.streamSquirrelsJson(3)]
+            assert batches == [[1, 2, 3], [4, 5]]
+
+    def describe_streamSquirrels():
+        def it_yields_rows_in_batches(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                batches = [[row["id"] for row in rows] for rows in db.streamSquirrels(2)]
+            assert batches == [[1, 2], [3, 4], [5]]
+
+    def describe_streamSquirrelRows():
+        def it_yields_rows_with_their_versions(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                db.updateSquirrel(2, "Fluff", "large")
+                batches = list(db.streamSquirrelRows(3))
+            assert batches == [[(1, "s1", "small", 1), (2, "Fluff", "large", 2), (3, "s3", "small", 1)],
+                               [(4, "s4", "small", 1), (5, "s5", "small", 1)]]
+
+    def describe_lastSquirrelId():
+        def it_remembers_deleted_squirrels(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                db.deleteSquirrel(5)
+                assert db.lastSquirrelId() == 5
+
+    def describe_bulkCreateSquirrels():
+        def it_inserts_every_row(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert db.bulkCreateSquirrels([("a", "small"), ("b", "large"), ("c", "small")], batchSize=2) == 3
+                assert [row["name"] for row in db.getSquirrels(afterId=5)] == ["a", "b", "c"]
+
+        def it_commits_once_per_call(mocker):
+            db = SquirrelDB(mocker.Mock())
+            db.bulkCreateSquirrels([("a", "small")] * 5, batchSize=2)
+            assert db.cursor.executemany.call_count == 3
+            db.connection.commit.assert_called_once()
+
+        def it_leaves_the_commit_to_the_caller(mocker):
+            db = SquirrelDB(mocker.Mock())
+            db.bulkCreateSquirrels([("a", "small")], commit=False)
+            db.connection.commit.assert_not_called()
+
+    def describe_bulkUpdateSquirrels():
+        def it_updates_existing_rows_and_reports_missing_ones(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert db.bulkUpdateSquirrels([(1, "x", "large"), (9, "y", "large")]) == [True, False]
+                assert db.getSquirrel(1)["name"] == "x"
+
+    def describe_updateSquirrel():
+        def it_bumps_the_version_of_a_table_made_before_versions(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert db.squirrelVersion(1) == 1
+                assert db.updateSquirrel(1, "x", "large") == {"id": 1, "name": "x", "size": "large", "version": 2}
+
+        def it_leaves_a_row_at_another_version_alone(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert db.updateSquirrel(1, "x", "large", [2]) is None
+                assert db.getSquirrel(1) == {"id": 1, "name": "s1", "size": "small", "version": 1}
+
+        def it_does_not_match_a_new_row_under_a_deleted_id(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                db.deleteSquirrel(5)
+                db.createSquirrel("s6", "small")
+                assert db.updateSquirrel(5, "x", "large", [1]) is None
+                assert db.getSquirrel(6)["name"] == "s6"
+
+    def describe_deleteSquirrel():
+        def it_deletes_only_at_a_matching_version(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert db.deleteSquirrel(1, []) is False
+                assert db.deleteSquirrel(1, [1]) is True
+                assert db.squirrelVersion(1) is None
+
+    def describe_bulkDeleteSquirrels():
+        def it_deletes_existing_rows_and_reports_missing_ones(squirrel_pool):
+            with SquirrelDB(squirrel_pool) as db:
+                assert db.bulkDeleteSquirrels([2, 9, 2]) == [True, False, False]
+                assert db.getSquirrel(2) is None
+
+    def describe_metrics():
+        def it_times_each_method(mocker, squirrel_pool):
+            observe = mocker.patch.object(METRICS, 'observe')
+            with SquirrelDB(squirrel_pool) as db:
+                db.getSquirrel(1)
+
+            assert mocker.call("squirrel_db_seconds", (("method", "getSquirrel"),), mocker.ANY) in observe.call_args_list
+
+        def it_counts_write_retries(mocker):
+            mocker.patch("time.sleep")
+            inc = mocker.patch.object(METRICS, 'inc')
+            db = SquirrelDB(mocker.Mock())
+            db.connection.in_transaction = False
+            db.cursor.execute.side_effect = [sqlite3.OperationalError("database is locked"), None]
+            db.createSquirrel("a", "small")
+
+            inc.assert_called_once_with("squirrel_db_write_retries_total")
+
+def write_concurrently(writer, statements):
+    # runs each (sql, data) on a thread of its own; returns what each got
+    results = [None] * len(statements)
+    def write(i, sql, data):
+        try:
+            results[i] = writer.execute(sql, data)
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=write, args=(i, sql, data)) for i, (sql, data) in enumerate(statements)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def describe_GroupCommitWriter():
+
+    @pytest.fixture
+    def pool(squirrel_pool):
+        # one connection for the writer, the rest for the requests
+        pool = ConnectionPool(squirrel_pool.path, size=3)
+        yield pool
+        pool.close()
+
+    def it_commits_concurrent_writes_together(mocker, pool):
+        inc = mocker.patch.object(METRICS, 'inc')
+        writer = GroupCommitWriter(pool, maxBatch=4, maxWait=5)
+        write_concurrently(writer, [("INSERT INTO squirrels (name, size) VALUES (?, ?)", ["w%d" % i, "small"]) for i in range(4)])
+        writer.close()
+
+        assert inc.call_args_list == [mocker.call("squirrel_group_commits_total"), mocker.call("squirrel_group_commit_writes_total", value=4)]
+        with SquirrelDB(pool) as db:
+            assert sorted(row["name"] for row in db.getSquirrels(afterId=5)) == ["w0", "w1", "w2", "w3"]
+
+    def it_fails_only_the_write_that_failed(pool):
+        writer = GroupCommitWriter(pool, maxBatch=2, maxWait=5)
+        results = write_concurrently(writer, [
+            ("INSERT INTO squirrels (id, name, size) VALUES (?, ?, ?)", [1, "dup", "small"]),
+            ("INSERT INTO squirrels (name, size) VALUES (?, ?)", ["ok", "small"]),
+        ])
+        writer.close()
+
+        assert sum(isinstance(result, sqlite3.IntegrityError) for result in results) == 1
+        with SquirrelDB(pool) as db:
+            assert db.getSquirrel(6)["name"] == "ok"
+
+    def it_commits_with_synchronous_full(pool):
+        writer = GroupCommitWriter(pool, maxBatch=1, maxWait=0)
+        writer.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", ["ok", "small"])
+        connection = writer._connection
+        assert connection.execute("PRAGMA synchronous").fetchone()["synchronous"] == 2
+        writer.close()
+        # the pool's setting again
+        assert connection.execute("PRAGMA synchronous").fetchone()["synchronous"] == 1
+
+    def it_keeps_committing_after_a_write_that_cannot_be_bound(pool):
+        writer = GroupCommitWriter(pool, maxBatch=1, maxWait=0)
+        with pytest.raises(OverflowError):
+            writer.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", [10 ** 30, "x"])
+        writer.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", ["ok", "small"])
+        with SquirrelDB(pool) as db:
+            # the writer holds no write lock between batches
+            db.createSquirrel("direct", "small")
+            assert [row["name"] for row in db.getSquirrels(afterId=5)] == ["ok", "direct"]
+        writer.close()
+
+    def it_rolls_back_a_batch_that_fails_outside_a_write(mocker, pool):
+        writer = GroupCommitWriter(pool, maxBatch=1, maxWait=0)
+        mocker.patch.object(writer, '_apply', side_effect=lambda connection, batch: (connection.execute("BEGIN IMMEDIATE"), 1 / 0))
+        with pytest.raises(ZeroDivisionError):
+            writer.execute("DELETE FROM squirrels", [])
+        assert not writer._connection.in_transaction
+        writer.close()
+
+    def it_serves_squirrel_db_writes(pool):
+        backend = SQLiteBackend(pool, GroupCommitWriter(pool))
+        with backend.open() as db:
+            assert db.updateSquirrel(1, "x", "large") == {"id": 1, "name": "x", "size": "large", "version": 2}
+            assert db.deleteSquirrel(2) is True
+        backend.shutdown()
+
+    def it_refuses_writes_once_closed(pool):
+        writer = GroupCommitWriter(pool)
+        writer.close()
+        with pytest.raises(RuntimeError):
+            writer.execute("DELETE FROM squirrels", [])
+
+def describe_batches():
+
+    def it_splits_an_iterable_into_lists_of_size():
+        assert list(batches(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+
+def describe_dict_factory():
+
+    def it_maps_column_names_to_values(mocker):
+        cursor = mocker.Mock(description=(("id",), ("name",)))
+        assert dict_factory(cursor, (1, "Fluffy")) == {"id": 1, "name": "Fluffy"}
+
+    def it_follows_a_new_statement(mocker):
+        dict_factory(mocker.Mock(description=(("id",), ("name",))), (1, "Fluffy"))
+        cursor = mocker.Mock(description=(("size",),))
+        assert dict_factory(cursor, ("large",)) == {"size": "large"}
+
+def describe_materialize():
+
+    def it_turns_tuples_into_dicts():
+        assert materialize((("id",), ("size",)), [(1, "small"), (2, "large")]) == [{"id": 1, "size": "small"}, {"id": 2, "size": "large"}]
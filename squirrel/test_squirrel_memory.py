@@ -0,0 +1,208 @@
+import json
+import sqlite3
+import threading
+import pytest
+from squirrel_db import ConnectionPool, SQLiteBackend
+from squirrel_memory import MemoryBackend
+
+SQUIRRELS = [(1, "Fluffy", "large"), (2, "Chippy", "small"), (3, "Fuzz", "small"), (4, "Nutty", None), (5, "Acorn", "large")]
+
+@pytest.fixture
+def memory():
+    backend = MemoryBackend()
+    backend.load(SQUIRRELS)
+    return backend
+
+# the same squirrels in SQLite, to check that both backends answer alike
+@pytest.fixture
+def sqlite_backend(tmp_path):
+    path = str(tmp_path / "squirrels.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE squirrels (id INTEGER PRIMARY KEY, name TEXT, size TEXT)")
+    conn.executemany("INSERT INTO squirrels VALUES (?, ?, ?)", SQUIRRELS)
+    conn.commit()
+    conn.close()
+    pool = ConnectionPool(path, size=2)
+    yield SQLiteBackend(pool)
+    pool.close()
+
+@pytest.fixture(params=["sqlite", "memory"])
+def backend(request):
+    return request.getfixturevalue("sqlite_backend" if request.param == "sqlite" else "memory")
+
+def describe_MemoryBackend():
+
+    def describe_reads():
+
+        @pytest.mark.parametrize("filters", [
+            {},
+            {"size": "small"},
+            {"namePrefix": "F"},
+            {"fields": ("name",)},
+            {"fields": ("size",), "limit": 2},
+            {"sort": "-id"},
+            {"sort": "name"},
+            {"sort": "-size"},
+            {"limit": 2, "afterId": 2},
+            {"limit": -1},
+            {"size": "large", "sort": "-name", "fields": ("name", "id")},
+        ])
+        def it_lists_what_sqlite_lists(sqlite_backend, memory, filters):
+            with sqlite_backend.open() as db:
+                expected = db.querySquirrelsJson(**filters)
+            assert memory.open().querySquirrelsJson(**filters) == expected
+
+        def it_streams_dicts_in_batches(backend):
+            with backend.open() as db:
+                assert [len(rows) for rows in db.streamSquirrels(2)] == [2, 2, 1]
+
+        def it_streams_json_rows(backend):
+            with backend.open() as db:
+                rows = [row for batch in db.streamSquirrelsJson(2, size="large") for row in batch]
+            assert [json.loads(text) for squirrelId, text in rows] == [
+                {"id": 1, "name": "Fluffy", "size": "large"},
+                {"id": 5, "name": "Acorn", "size": "large"},
+            ]
+
+        def it_projects_query_squirrels(backend):
+            with backend.open() as db:
+                assert db.querySquirrels(fields=("name",), size="small") == [{"name": "Chippy"}, {"name": "Fuzz"}]
+
+        def it_gets_a_squirrel_by_path_id(backend):
+            with backend.open() as db:
+                assert db.getSquirrel("3") == {"id": 3, "name": "Fuzz", "size": "small", "version": 1}
+
+        def it_finds_nothing_for_a_non_numeric_id(backend):
+            with backend.open() as db:
+                assert db.getSquirrel("abc") is None
+
+        def it_rejects_after_id_with_another_sort(backend):
+            with backend.open() as db, pytest.raises(ValueError):
+                db.querySquirrelsJson(sort="name", afterId=1)
+
+    def describe_load():
+
+        def it_starts_new_ids_past_the_last_one_given(memory):
+            memory.load([], lastId=9)
+            with memory.open() as db:
+                db.createSquirrel("Pip", "small")
+                assert db.getSquirrel(10)["name"] == "Pip"
+
+        def it_keeps_the_versions_it_is_given():
+            backend = MemoryBackend()
+            backend.load([(1, "Fluffy", "large", 3)])
+            assert backend.getSquirrel(1)["version"] == 3
+
+    def describe_writes():
+
+        def it_never_reuses_a_deleted_id(backend):
+            with backend.open() as db:
+                db.deleteSquirrel(5)
+                db.createSquirrel("Pip", "small")
+                assert db.getSquirrel(5) is None
+                assert db.getSquirrel(6) == {"id": 6, "name": "Pip", "size": "small", "version": 1}
+
+        def it_frees_the_ids_of_an_undone_bulk(backend):
+            with backend.open() as db:
+                db.bulkCreateSquirrels([("a", "small")], commit=False)
+            with backend.open() as db:
+                db.createSquirrel("Pip", "small")
+                assert db.getSquirrel(6)["name"] == "Pip"
+
+        def it_stores_numbers_as_text(backend):
+            with backend.open() as db:
+                db.updateSquirrel(1, 7, "large")
+                assert db.getSquirrel(1)["name"] == "7"
+
+        def it_bumps_the_version_on_update(backend):
+            with backend.open() as db:
+                assert db.updateSquirrel(1, "Fluff", "small") == {"id": 1, "name": "Fluff", "size": "small", "version": 2}
+                assert db.squirrelVersion(1) == 2
+
+        def it_updates_only_at_a_matching_version(backend):
+            with backend.open() as db:
+                assert db.updateSquirrel(1, "Fluff", "small", [2, 3]) is None
+                assert db.updateSquirrel(1, "Fluff", "small", [1])["version"] == 2
+                assert db.getSquirrel(1)["name"] == "Fluff"
+
+        def it_deletes_only_at_a_matching_version(backend):
+            with backend.open() as db:
+                assert db.deleteSquirrel(1, [2]) is False
+                assert db.deleteSquirrel(1, [1]) is True
+                assert db.squirrelVersion(1) is None
+
+        def it_reports_a_missing_squirrel(backend):
+            with backend.open() as db:
+                assert db.updateSquirrel(9, "a", "small") is None
+                assert db.deleteSquirrel(9) is False
+
+        def it_reports_which_bulk_ids_existed(backend):
+            with backend.open() as db:
+                assert db.bulkUpdateSquirrels([(1, "a", "small"), (9, "b", "small")]) == [True, False]
+                assert db.bulkDeleteSquirrels([2, 2, 9]) == [True, False, False]
+
+        def it_undoes_an_uncommitted_bulk_on_close(backend):
+            with backend.open() as db:
+                db.bulkCreateSquirrels([("a", "small"), ("b", "small")], commit=False)
+                db.bulkDeleteSquirrels([1], commit=False)
+            with backend.open() as db:
+                assert [row["id"] for row in db.getSquirrels()] == [1, 2, 3, 4, 5]
+
+        def it_keeps_a_committed_bulk(backend):
+            with backend.open() as db:
+                db.bulkCreateSquirrels([("a", "small")], commit=False)
+                db.commit()
+            with backend.open() as db:
+                assert db.getSquirrel(6)["name"] == "a"
+
+        def it_hides_an_open_bulk_from_other_threads(memory):
+            seen = []
+            memory.bulkCreateSquirrels([("a", "small")], commit=False)
+            reader = threading.Thread(target=lambda: seen.append(len(memory.getSquirrels())))
+            reader.start()
+            reader.join(0.1)
+            assert seen == []
+            memory.commit()
+            reader.join()
+            assert seen == [6]
+
+    def describe_snapshots():
+
+        def it_restores_what_it_saved(tmp_path):
+            path = str(tmp_path / "squirrels.json")
+            first = MemoryBackend(path, snapshotInterval=60)
+            assert not first.restored
+            first.createSquirrel("Fluffy", "large")
+            first.shutdown()
+
+            second = MemoryBackend(path, snapshotInterval=60)
+            assert second.restored
+            assert second.getSquirrel(1) == {"id": 1, "name": "Fluffy", "size": "large", "version": 1}
+            second.shutdown()
+
+        def it_restores_the_largest_id_handed_out(tmp_path):
+            path = str(tmp_path / "squirrels.json")
+            first = MemoryBackend(path, snapshotInterval=60)
+            first.createSquirrel("Fluffy", "large")
+            first.deleteSquirrel(1)
+            first.shutdown()
+
+            second = MemoryBackend(path, snapshotInterval=60)
+            second.createSquirrel("Chippy", "small")
+            assert second.getSquirrel(2)["name"] == "Chippy"
+            second.shutdown()
+
+        def it_saves_periodically_while_changing(mocker, tmp_path):
+            path = tmp_path / "squirrels.json"
+            backend = MemoryBackend(str(path), snapshotInterval=0.01)
+            saved = threading.Event()
+            mocker.patch.object(backend, 'snapshot', side_effect=lambda: saved.set())
+            backend.createSquirrel("Fluffy", "large")
+            assert saved.wait(1)
+            backend._stop.set()
+
+        def it_skips_the_final_snapshot_when_nothing_changed(mocker, tmp_path):
+            backend = MemoryBackend(str(tmp_path / "squirrels.json"), snapshotInterval=60)
+            snapshot = mocker.patch.object(backend, 'snapshot')
+            backend.shutdown()
+            snapshot.assert_not_called()
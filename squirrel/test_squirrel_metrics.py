@@ -0,0 +1,97 @@
+import threading
+import pytest
+from squirrel_metrics import Metrics, formatSample
+
+@pytest.fixture
+def metrics():
+    return Metrics(buckets=(0.1, 1.0))
+
+def describe_Metrics():
+
+    def describe_inc():
+
+        def it_renders_a_counter_with_help_and_type(metrics):
+            metrics.describe("hits_total", "counter", "Hits.")
+            metrics.inc("hits_total", (("route", "index"),))
+            metrics.inc("hits_total", (("route", "index"),), 2)
+            assert metrics.render() == '# HELP hits_total Hits.\n# TYPE hits_total counter\nhits_total{route="index"} 3\n'
+
+        def it_adds_up_what_each_thread_recorded(metrics):
+            def record():
+                for _ in range(1000):
+                    metrics.inc("hits_total")
+            threads = [threading.Thread(target=record) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert metrics.render() == "hits_total 4000\n"
+
+        def it_keeps_a_gauge_as_a_running_sum(metrics):
+            metrics.inc("open")
+            metrics.inc("open")
+            metrics.inc("open", value=-1)
+            assert metrics.render() == "open 1\n"
+
+    def describe_observe():
+
+        def it_renders_cumulative_buckets_sum_and_count(metrics):
+            metrics.observe("latency_seconds", (("route", "index"),), 0.05)
+            metrics.observe("latency_seconds", (("route", "index"),), 0.1)
+            metrics.observe("latency_seconds", (("route", "index"),), 3.0)
+            assert metrics.render().splitlines() == [
+                'latency_seconds_bucket{route="index",le="0.1"} 2',
+                'latency_seconds_bucket{route="index",le="1.0"} 2',
+                'latency_seconds_bucket{route="index",le="+Inf"} 3',
+                'latency_seconds_sum{route="index"} 3.15',
+                'latency_seconds_count{route="index"} 3',
+            ]
+
+    def describe_timed():
+
+        def it_observes_each_call_under_the_function_name(metrics):
+            @metrics.timed("calls_seconds", "method")
+            def lookup(value):
+                return value * 2
+            assert lookup(21) == 42
+            assert 'calls_seconds_count{method="lookup"} 1' in metrics.render()
+
+        def it_observes_a_call_that_raises(metrics):
+            @metrics.timed("calls_seconds", "method")
+            def broken():
+                raise ValueError("nope")
+            with pytest.raises(ValueError):
+                broken()
+            assert 'calls_seconds_count{method="broken"} 1' in metrics.render()
+
+        def it_observes_a_generator_once_it_is_closed(metrics):
+            @metrics.timed("calls_seconds", "method")
+            def rows():
+                yield 1
+                yield 2
+            items = rows()
+            assert next(items) == 1
+            assert "calls_seconds" not in metrics.render()
+            assert list(items) == [2]
+            assert 'calls_seconds_count{method="rows"} 1' in metrics.render()
+
+    def describe_collector():
+
+        def it_reads_values_at_render_time(metrics):
+            sizes = {"idle": 1}
+            metrics.collector("pool_idle", lambda: {(): sizes["idle"]})
+            sizes["idle"] = 3
+            assert metrics.render() == "pool_idle 3\n"
+
+    def describe_clear():
+
+        def it_forgets_recorded_values(metrics):
+            metrics.inc("hits_total")
+            metrics.observe("latency_seconds", (), 0.2)
+            metrics.clear()
+            assert metrics.render() == ""
+
+def describe_formatSample():
+
+    def it_escapes_label_values():
+        assert formatSample("x", (("path", 'a"b\\c\nd'),), 1) == 'x{path="a\\"b\\\\c\\nd"} 1'
@@ -0,0 +1,90 @@
+import os
+import pstats
+import tracemalloc
+import pytest
+from squirrel_profile import Profiler, ProfileRunning, MAX_PROFILE_SECONDS
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    yield profiler
+    profiler.stop()
+
+def busy():
+    return sum(i * i for i in range(1000))
+
+def describe_Profiler():
+
+    def describe_start():
+
+        @pytest.mark.parametrize("seconds, sample", [(0, 0.5), (MAX_PROFILE_SECONDS + 1, 0.5), (1, 0), (1, 1.5)])
+        def it_rejects_out_of_range_settings(profiler, seconds, sample):
+            with pytest.raises(ValueError):
+                profiler.start(seconds, sample)
+            assert not profiler.active
+
+        def it_allows_one_profile_at_a_time(profiler):
+            profiler.start(5, 1, allocations=False)
+            with pytest.raises(ProfileRunning):
+                profiler.start(5, 1, allocations=False)
+
+        def it_names_the_files_it_will_write(profiler, tmp_path):
+            files = profiler.start(5, 1)["files"]
+            assert sorted(files) == ["allocations", "profile"]
+            assert all(os.path.dirname(path) == str(tmp_path) for path in files.values())
+
+        def it_stops_by_itself(profiler):
+            profiler.start(0.01, 1, allocations=False)
+            profiler._timer.join(1)
+            assert not profiler.active
+
+    def describe_requests():
+
+        def it_samples_nothing_below_the_rate(mocker, profiler):
+            profiler.start(5, 0.5, allocations=False)
+            mocker.patch("squirrel_profile.random.random", return_value=0.7)
+            assert profiler.begin() is None
+
+        def it_merges_sampled_profiles(profiler):
+            files = profiler.start(5, 1, allocations=False)["files"]
+            for _ in range(2):
+                profile = profiler.begin()
+                busy()
+                profiler.end(profile)
+            profiler.stop()
+            calls = [stat[1] for (filename, line, name), stat in pstats.Stats(files["profile"]).stats.items() if name == "busy"]
+            assert calls == [2]
+
+        def it_drops_a_profile_that_ends_after_the_session(profiler):
+            profiler.start(5, 1, allocations=False)
+            profile = profiler.begin()
+            assert profiler.stop() == {}
+            profiler.end(profile)
+
+    def describe_stop():
+
+        def it_returns_none_when_nothing_runs(profiler):
+            assert profiler.stop() is None
+
+        def it_writes_an_allocation_report(profiler):
+            profiler.start(5, 1)
+            held = [bytearray(4096) for _ in range(100)]
+            files = profiler.stop()
+            assert list(files) == ["allocations"]
+            with open(files["allocations"], encoding="utf-8") as f:
+                assert "test_squirrel_profile.py" in f.read()
+            assert len(held) == 100
+
+        def it_stops_the_tracing_it_started(profiler):
+            profiler.start(5, 1)
+            profiler.stop()
+            assert not tracemalloc.is_tracing()
+
+        def it_keeps_tracing_someone_else_started(profiler):
+            tracemalloc.start()
+            try:
+                profiler.start(5, 1)
+                profiler.stop()
+                assert tracemalloc.is_tracing()
+            finally:
+                tracemalloc.stop()
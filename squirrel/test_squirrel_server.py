@@ -1,8 +1,26 @@
+import asyncio
+import gzip
+import http.client
 import io
 import json
+import logging
+import multiprocessing
+import os
+import pstats
+import queue
+import signal
+import sqlite3
+import threading
+import time
+import zlib
+import squirrel_server
 import pytest
-from squirrel_server import SquirrelServerHandler
-from squirrel_db import SquirrelDB
+from squirrel_server import SquirrelServerHandler, PooledHTTPServer, AsyncSquirrelServer, PreforkSupervisor, listenSocket, openBackend, run, BufferedConnection, SERVICE_UNAVAILABLE, PAGE_SIZE, MAX_PAGE_SIZE, ResponseCache, etagFor, parseBulkItem, spoolLines, encodeJson, encodeSquirrel, matchVersions, acceptedCoding, codedEtag, JsonLinesFormatter, startLogging, accessLog
+from squirrel_metrics import Metrics
+from squirrel_memory import MemoryBackend
+from squirrel_profile import Profiler
+from types import SimpleNamespace
+from squirrel_db import SquirrelDB, SQLiteBackend, DatabaseBusy, PoolTimeout, configurePool, closePool
 
 # use @todo to cause pytest to skip that section
 # handy for stubbing things out and then coming back later to finish them.
@@ -20,6 +38,12 @@ class FakeRequest():
     def sendall(self, x):
         return
 
+    def settimeout(self, timeout):
+        return
+
+    def setsockopt(self, *args):
+        return
+
     #this is not a 'makefile' like in c++ instead it 'makes' a response file
     def makefile(self, *args, **kwargs):
         if args[0] == 'rb':
@@ -51,13 +75,22 @@ def mock_db_init(mocker):
     return mocker.patch.object(SquirrelDB, '__init__', return_value=None)
 
 @pytest.fixture
-def mock_db_get_squirrels(mocker, mock_db_init):
-    return mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=['squirrel'])
+def mock_db_query_squirrels(mocker, mock_db_init):
+    return mocker.patch.object(SquirrelDB, 'querySquirrelsJson', return_value=[(1, '"squirrel"')])
 
 
+@pytest.fixture
+def mock_db_stream_squirrels(mocker, mock_db_init):
+    return mocker.patch.object(SquirrelDB, 'streamSquirrelsJson', side_effect=lambda *args, **kwargs: iter([[(1, '"squirrel"')]]))
+
+# a row as getSquirrel returns it, and the body and ETag it is served with
+SQUIRREL = {"id": 1, "name": "Fluffy", "size": "large", "version": 3}
+SQUIRREL_JSON = b'{"id":1,"name":"Fluffy","size":"large"}'
+SQUIRREL_ETAG = '"3-%s"' % etagFor(SQUIRREL_JSON).strip('"')
+
 @pytest.fixture
 def mock_db_get_squirrel(mocker, mock_db_init):
-    return mocker.patch.object(SquirrelDB, 'getSquirrel', return_value='squirrel')
+    return mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=SQUIRREL)
 
 # patch SquirrelServerHandler to make our FakeRequest work correctly
 @pytest.fixture(autouse=True)
@@ -65,8 +98,24 @@ def patch_wbufsize(mocker):
     mocker.patch.object(SquirrelServerHandler, 'wbufsize', 1)
     mocker.patch.object(SquirrelServerHandler, 'end_headers')
 
+# handlers that reach a real SquirrelDB use a fresh database, never the
+# checked-in one
+@pytest.fixture(autouse=True)
+def scratch_db(tmp_path):
+    configurePool(str(tmp_path / "squirrel_db.db"))
+    yield
+    closePool()
+
+# every test starts with an empty response cache
+@pytest.fixture(autouse=True)
+def fresh_cache(mocker):
+    return mocker.patch.object(SquirrelServerHandler, 'cache', ResponseCache())
 
 # Fake Requests
+@pytest.fixture(autouse=True)
+def fresh_metrics(mocker):
+    return mocker.patch.object(SquirrelServerHandler, 'metrics', Metrics())
+
 @pytest.fixture
 def fake_get_squirrels_request(mocker):
     return FakeRequest(mocker.Mock(), 'GET', '/squirrels')
@@ -126,11 +175,11 @@ def mock_db_create_squirrel(mocker, mock_db_init):
 
 @pytest.fixture
 def mock_db_update_squirrel(mocker, mock_db_init):
-    return mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
+    return mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=dict(SQUIRREL, version=4))
 
 @pytest.fixture
 def mock_db_delete_squirrel(mocker, mock_db_init):
-    return mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=None)
+    return mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=True)
 
 # Mock for getRequestData method
 @pytest.fixture
@@ -138,6 +187,16 @@ def mock_get_request_data(mocker):
     return mocker.patch.object(SquirrelServerHandler, 'getRequestData', return_value={"name": "Test", "size": "small"})
 
 
+# responses go through sendall as they do on a real socket
+@pytest.fixture
+def unbuffered(mocker):
+    mocker.patch.object(SquirrelServerHandler, 'wbufsize', 0)
+    mocker.patch.object(SquirrelServerHandler, 'end_headers', SquirrelServerHandler.__bases__[0].end_headers)
+
+# everything the handler wrote to a mocked wfile
+def written(handler):
+    return b"".join(args[0] for args, kwargs in handler.wfile.write.call_args_list)
+
 #send_response, send_header and end_headers are inherited functions
 #from the BaseHTTPRequestHandler. Go look at documentation here:
 # https://docs.python.org/3/library/http.server.html
@@ -152,12 +211,34 @@ def mock_response_methods(mocker):
     return mock_send_response, mock_send_header, mock_end_headers
 
 
+# (status line, headers, body) of a raw response, chunked bodies joined
+def parse_response(raw):
+    head, _, body = raw.partition(b"\r\n\r\n")
+    lines = head.decode().split("\r\n")
+    headers = dict((name, value.strip()) for name, _, value in (line.partition(":") for line in lines[1:]))
+    if headers.get("Transfer-Encoding") == "chunked":
+        data = b""
+        while True:
+            size, _, body = body.partition(b"\r\n")
+            size = int(size, 16)
+            if not size:
+                break
+            data, body = data + body[:size], body[size + 2:]
+        body = data
+    return lines[0], headers, body
+
+def get_with(path, headers, client, server, method="GET"):
+    lines = "".join("%s: %s\r\n" % item for item in headers.items())
+    conn = BufferedConnection(("%s %s HTTP/1.1\r\n%s\r\n" % (method, path, lines)).encode())
+    SquirrelServerHandler(conn, client, server)
+    return parse_response(conn.output.getvalue())
+
 def describe_SquirrelServerHandler():
 
     def describe_handleSquirrelsIndex():
         def it_queries_db_for_squirrels(mocker, dummy_client, dummy_server):
             #setup
-            mock_get_squirrels = mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=['squirrel'])
+            mock_get_squirrels = mocker.patch.object(SquirrelDB, 'streamSquirrelsJson', return_value=iter([[(1, '"squirrel"')]]))
             fake_get_squirrels_request = FakeRequest(mocker.Mock(), 'GET', '/squirrels')
             
             #do the thing
@@ -177,27 +258,82 @@ def describe_SquirrelServerHandler():
             # assert methods calls and arguments
             mock_send_response.assert_called_once_with(200)
 
-        def it_sends_json_content_type_header(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_get_squirrels, mock_response_methods):
+        def it_sends_json_content_type_header(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_stream_squirrels, mock_response_methods):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
-            mock_send_header.assert_called_once_with("Content-Type", "application/json")
+            mock_send_header.assert_any_call("Content-Type", "application/json")
 
-        def it_calls_end_headers(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_get_squirrels, mock_response_methods):
+        def it_calls_end_headers(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_stream_squirrels, mock_response_methods):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
             mock_end_headers.assert_called_once()
 
-        def it_returns_response_body_with_squirrels_json_data(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_get_squirrels):
+        def it_returns_response_body_with_squirrels_json_data(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_stream_squirrels):
             #Do The thing:
             response = SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
-            #assert that the write function was called with a json version of the text 'squirrel'
-            response.wfile.write.assert_called_once_with(bytes(json.dumps(['squirrel']), "utf-8"))
+            #assert that the body written is a json version of the list ['squirrel']
+            assert written(response) == bytes(json.dumps(['squirrel']), "utf-8")
+
+        def it_writes_an_empty_list_when_there_are_no_squirrels(mocker, fake_get_squirrels_request, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelDB, 'streamSquirrelsJson', return_value=iter([]))
+            response = SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
+            assert written(response) == b"[]"
+
+        def it_joins_batches_into_one_json_array(mocker, fake_get_squirrels_request, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelDB, 'streamSquirrelsJson', return_value=iter([[(1, '{"id":1}'), (2, '{"id":2}')], [(3, '{"id":3}')]]))
+            response = SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
+            assert json.loads(written(response)) == [{'id': 1}, {'id': 2}, {'id': 3}]
+
+        def it_streams_http_1_1_responses_in_chunks(unbuffered, mocker, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelServerHandler, 'compressMinBytes', 1)
+            mocker.patch.object(SquirrelDB, 'streamSquirrelsJson', return_value=iter([[(1, '{"id":1}')], [(2, '{"id":2}')]]))
+            conn = BufferedConnection(b"GET /squirrels HTTP/1.1\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            head, _, body = conn.output.getvalue().partition(b"\r\n\r\n")
+            assert b"Transfer-Encoding: chunked" in head
+            assert body == b'9\r\n[{"id":1}\r\n9\r\n,{"id":2}\r\n1\r\n]\r\n0\r\n\r\n'
+
+    def describe_handleSquirrelsPage():
+
+        @pytest.fixture
+        def page_request(mocker):
+            return lambda query: FakeRequest(mocker.Mock(), 'GET', '/squirrels?' + query)
+
+        def it_queries_db_with_limit_and_after_id(page_request, dummy_client, dummy_server, mock_db_query_squirrels):
+            SquirrelServerHandler(page_request('limit=10&after_id=5'), dummy_client, dummy_server)
+            mock_db_query_squirrels.assert_called_once_with(limit=10, afterId=5)
+
+        def it_defaults_the_page_size(page_request, dummy_client, dummy_server, mock_db_query_squirrels):
+            SquirrelServerHandler(page_request('after_id=5'), dummy_client, dummy_server)
+            mock_db_query_squirrels.assert_called_once_with(limit=PAGE_SIZE, afterId=5)
+
+        def it_caps_the_page_size(page_request, dummy_client, dummy_server, mock_db_query_squirrels):
+            SquirrelServerHandler(page_request('limit=1000000'), dummy_client, dummy_server)
+            mock_db_query_squirrels.assert_called_once_with(limit=MAX_PAGE_SIZE, afterId=None)
+
+        def it_links_the_next_page_when_the_page_is_full(mocker, page_request, dummy_client, dummy_server, mock_db_init, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            mocker.patch.object(SquirrelDB, 'querySquirrelsJson', return_value=[(3, '{"id":3}'), (7, '{"id":7}')])
+            SquirrelServerHandler(page_request('limit=2'), dummy_client, dummy_server)
+            mock_send_header.assert_any_call("Link", '</squirrels?limit=2&after_id=7>; rel="next"')
+
+        def it_does_not_link_past_the_last_page(mocker, page_request, dummy_client, dummy_server, mock_db_init, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            mocker.patch.object(SquirrelDB, 'querySquirrelsJson', return_value=[(3, '{"id":3}')])
+            SquirrelServerHandler(page_request('limit=2'), dummy_client, dummy_server)
+            assert "Link" not in [args[0] for args, kwargs in mock_send_header.call_args_list]
+
+        def it_returns_400_for_a_bad_limit(page_request, dummy_client, dummy_server, mock_db_query_squirrels, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            SquirrelServerHandler(page_request('limit=abc'), dummy_client, dummy_server)
+            mock_send_response.assert_called_once_with(400)
+            mock_db_query_squirrels.assert_not_called()
 
     def describe_handleSquirrelsRetrieve():
         """Tests for GET /squirrels/{id} - handleSquirrelsRetrieve method"""
 
         def it_queries_db_with_correct_id(mocker, fake_get_squirrel_request, dummy_client, dummy_server):
-            mock_get_squirrel = mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
+            mock_get_squirrel = mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=SQUIRREL)
             SquirrelServerHandler(fake_get_squirrel_request, dummy_client, dummy_server)
             mock_get_squirrel.assert_called_once_with('1')
 
@@ -209,7 +345,7 @@ def describe_SquirrelServerHandler():
         def it_sends_json_content_type_header_when_found(fake_get_squirrel_request, dummy_client, dummy_server, mock_response_methods, mock_db_get_squirrel):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_get_squirrel_request, dummy_client, dummy_server)
-            mock_send_header.assert_called_once_with("Content-Type", "application/json")
+            mock_send_header.assert_any_call("Content-Type", "application/json")
 
         def it_calls_end_headers_when_found(fake_get_squirrel_request, dummy_client, dummy_server, mock_response_methods, mock_db_get_squirrel):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
@@ -218,7 +354,11 @@ def describe_SquirrelServerHandler():
 
         def it_writes_json_response_when_found(fake_get_squirrel_request, dummy_client, dummy_server, mock_db_get_squirrel):
             response = SquirrelServerHandler(fake_get_squirrel_request, dummy_client, dummy_server)
-            response.wfile.write.assert_called_once_with(bytes(json.dumps('squirrel'), "utf-8"))
+            response.wfile.write.assert_called_once_with(SQUIRREL_JSON)
+
+        def it_leaves_the_version_out_of_the_body(fake_get_squirrel_request, dummy_client, dummy_server, mock_db_get_squirrel):
+            response = SquirrelServerHandler(fake_get_squirrel_request, dummy_client, dummy_server)
+            assert b"version" not in written(response)
 
         def it_calls_handle404_when_squirrel_not_found(mocker, fake_get_squirrel_request, dummy_client, dummy_server):
             mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=None)
@@ -258,84 +398,116 @@ def describe_SquirrelServerHandler():
     def describe_handleSquirrelsUpdate():
         """Tests for PUT /squirrels/{id} - handleSquirrelsUpdate method"""
 
-        def it_queries_db_first_to_check_squirrel_exists(mocker, fake_update_squirrel_request, dummy_client, dummy_server):
-            mock_get_squirrel = mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
-            mock_update_squirrel = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
-            mocker.patch.object(SquirrelServerHandler, 'getRequestData', return_value={"name": "Updated", "size": "medium"})
+        def it_updates_without_reading_the_squirrel_first(mocker, fake_update_squirrel_request, dummy_client, dummy_server, mock_db_update_squirrel):
+            mock_get_squirrel = mocker.patch.object(SquirrelDB, 'getSquirrel')
             SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
-            mock_get_squirrel.assert_called_once_with('1')
+            mock_get_squirrel.assert_not_called()
 
-        def it_calls_getRequestData_when_squirrel_found(mocker, fake_update_squirrel_request, dummy_client, dummy_server):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
-            mock_update_squirrel = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
+        def it_calls_getRequestData(mocker, fake_update_squirrel_request, dummy_client, dummy_server, mock_db_update_squirrel):
             mock_get_request_data = mocker.patch.object(SquirrelServerHandler, 'getRequestData', return_value={"name": "Updated", "size": "medium"})
             SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
             mock_get_request_data.assert_called_once()
 
-        def it_updates_squirrel_with_correct_data_when_found(mocker, fake_update_squirrel_request, dummy_client, dummy_server):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
-            mock_update_squirrel = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
-            mocker.patch.object(SquirrelServerHandler, 'getRequestData', return_value={"name": "Updated", "size": "medium"})
+        def it_updates_squirrel_with_correct_data(fake_update_squirrel_request, dummy_client, dummy_server, mock_db_update_squirrel):
             SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
-            mock_update_squirrel.assert_called_once_with('1', 'Updated', 'medium')
+            mock_db_update_squirrel.assert_called_once_with('1', 'Updated', 'medium', None)
 
-        def it_returns_204_when_squirrel_found(mocker, fake_update_squirrel_request, dummy_client, dummy_server, mock_response_methods):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
-            mock_update_squirrel = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
-            mocker.patch.object(SquirrelServerHandler, 'getRequestData', return_value={"name": "Updated", "size": "medium"})
+        def it_returns_204_when_squirrel_found(fake_update_squirrel_request, dummy_client, dummy_server, mock_response_methods, mock_db_update_squirrel):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
             mock_send_response.assert_called_once_with(204)
 
-        def it_calls_end_headers_when_found(mocker, fake_update_squirrel_request, dummy_client, dummy_server, mock_response_methods):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
-            mock_update_squirrel = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
-            mocker.patch.object(SquirrelServerHandler, 'getRequestData', return_value={"name": "Updated", "size": "medium"})
+        def it_sends_the_etag_of_the_new_version(fake_update_squirrel_request, dummy_client, dummy_server, mock_response_methods, mock_db_update_squirrel):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
+            mock_send_header.assert_any_call("ETag", '"4-%s"' % etagFor(SQUIRREL_JSON).strip('"'))
+
+        def it_calls_end_headers_when_found(fake_update_squirrel_request, dummy_client, dummy_server, mock_response_methods, mock_db_update_squirrel):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
             mock_end_headers.assert_called_once()
 
-        def it_calls_handle404_when_squirrel_not_found(mocker, fake_update_squirrel_request, dummy_client, dummy_server):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=None)
+        def it_calls_handle404_when_squirrel_not_found(mocker, fake_update_squirrel_request, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
             mock_handle404 = mocker.patch.object(SquirrelServerHandler, 'handle404')
             SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
             mock_handle404.assert_called_once()
 
+        def describe_if_match():
+
+            @pytest.fixture
+            def conditional_put():
+                body = b'{"name":"Updated","size":"medium"}'
+                return BufferedConnection(b'PUT /squirrels/1 HTTP/1.1\r\nIf-Match: "3-abc", W/"5-def"\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+
+            def it_updates_only_at_the_versions_named(unbuffered, dummy_client, dummy_server, conditional_put, mock_db_update_squirrel):
+                SquirrelServerHandler(conditional_put, dummy_client, dummy_server)
+                mock_db_update_squirrel.assert_called_once_with('1', 'Updated', 'medium', [3])
+
+            def it_returns_412_when_the_squirrel_changed(mocker, unbuffered, dummy_client, dummy_server, conditional_put, mock_db_init):
+                mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
+                mocker.patch.object(SquirrelDB, 'squirrelVersion', return_value=4)
+                SquirrelServerHandler(conditional_put, dummy_client, dummy_server)
+                assert conditional_put.output.getvalue().startswith(b"HTTP/1.1 412")
+
+            def it_returns_404_when_the_squirrel_is_gone(mocker, unbuffered, dummy_client, dummy_server, conditional_put, mock_db_init):
+                mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
+                mocker.patch.object(SquirrelDB, 'squirrelVersion', return_value=None)
+                SquirrelServerHandler(conditional_put, dummy_client, dummy_server)
+                assert conditional_put.output.getvalue().startswith(b"HTTP/1.1 404")
+
+            def it_keeps_the_cached_squirrel_on_412(mocker, unbuffered, dummy_client, dummy_server, conditional_put, mock_db_init, fresh_cache):
+                fresh_cache.put(("squirrel", 1), b"cached")
+                mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
+                mocker.patch.object(SquirrelDB, 'squirrelVersion', return_value=4)
+                SquirrelServerHandler(conditional_put, dummy_client, dummy_server)
+                assert fresh_cache.get(("squirrel", 1)) is not None
+
     def describe_handleSquirrelsDelete():
         """Tests for DELETE /squirrels/{id} - handleSquirrelsDelete method"""
 
-        def it_queries_db_first_to_check_squirrel_exists(mocker, fake_delete_squirrel_request, dummy_client, dummy_server):
-            mock_get_squirrel = mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
-            mock_delete_squirrel = mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=None)
+        def it_deletes_without_reading_the_squirrel_first(mocker, fake_delete_squirrel_request, dummy_client, dummy_server, mock_db_delete_squirrel):
+            mock_get_squirrel = mocker.patch.object(SquirrelDB, 'getSquirrel')
             SquirrelServerHandler(fake_delete_squirrel_request, dummy_client, dummy_server)
-            mock_get_squirrel.assert_called_once_with('1')
+            mock_get_squirrel.assert_not_called()
 
-        def it_deletes_squirrel_when_found(mocker, fake_delete_squirrel_request, dummy_client, dummy_server):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
-            mock_delete_squirrel = mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=None)
+        def it_deletes_squirrel_by_id(fake_delete_squirrel_request, dummy_client, dummy_server, mock_db_delete_squirrel):
             SquirrelServerHandler(fake_delete_squirrel_request, dummy_client, dummy_server)
-            mock_delete_squirrel.assert_called_once_with('1')
+            mock_db_delete_squirrel.assert_called_once_with('1', None)
 
-        def it_returns_204_when_squirrel_found(mocker, fake_delete_squirrel_request, dummy_client, dummy_server, mock_response_methods):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
-            mock_delete_squirrel = mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=None)
+        def it_returns_204_when_squirrel_found(fake_delete_squirrel_request, dummy_client, dummy_server, mock_response_methods, mock_db_delete_squirrel):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_delete_squirrel_request, dummy_client, dummy_server)
             mock_send_response.assert_called_once_with(204)
 
-        def it_calls_end_headers_when_found(mocker, fake_delete_squirrel_request, dummy_client, dummy_server, mock_response_methods):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Test'})
-            mock_delete_squirrel = mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=None)
+        def it_calls_end_headers_when_found(fake_delete_squirrel_request, dummy_client, dummy_server, mock_response_methods, mock_db_delete_squirrel):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_delete_squirrel_request, dummy_client, dummy_server)
             mock_end_headers.assert_called_once()
 
-        def it_calls_handle404_when_squirrel_not_found(mocker, fake_delete_squirrel_request, dummy_client, dummy_server):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=None)
+        def it_calls_handle404_when_squirrel_not_found(mocker, fake_delete_squirrel_request, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=False)
             mock_handle404 = mocker.patch.object(SquirrelServerHandler, 'handle404')
             SquirrelServerHandler(fake_delete_squirrel_request, dummy_client, dummy_server)
             mock_handle404.assert_called_once()
 
+        def describe_if_match():
+
+            def it_deletes_only_at_the_versions_named(unbuffered, dummy_client, dummy_server, mock_db_delete_squirrel):
+                SquirrelServerHandler(BufferedConnection(b'DELETE /squirrels/1 HTTP/1.1\r\nIf-Match: "3-abc"\r\n\r\n'), dummy_client, dummy_server)
+                mock_db_delete_squirrel.assert_called_once_with('1', [3])
+
+            def it_deletes_any_version_for_a_star(unbuffered, dummy_client, dummy_server, mock_db_delete_squirrel):
+                SquirrelServerHandler(BufferedConnection(b'DELETE /squirrels/1 HTTP/1.1\r\nIf-Match: *\r\n\r\n'), dummy_client, dummy_server)
+                mock_db_delete_squirrel.assert_called_once_with('1', None)
+
+            def it_returns_412_when_the_squirrel_changed(mocker, unbuffered, dummy_client, dummy_server, mock_db_init):
+                mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=False)
+                mocker.patch.object(SquirrelDB, 'squirrelVersion', return_value=4)
+                conn = BufferedConnection(b'DELETE /squirrels/1 HTTP/1.1\r\nIf-Match: "3-abc"\r\n\r\n')
+                SquirrelServerHandler(conn, dummy_client, dummy_server)
+                assert conn.output.getvalue().startswith(b"HTTP/1.1 412")
+
     def describe_handle404():
         """Tests for error handling - handle404 method"""
 
@@ -347,7 +519,7 @@ def describe_SquirrelServerHandler():
         def it_sends_text_plain_content_type_header(fake_invalid_request, dummy_client, dummy_server, mock_response_methods):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_invalid_request, dummy_client, dummy_server)
-            mock_send_header.assert_called_once_with("Content-Type", "text/plain")
+            mock_send_header.assert_any_call("Content-Type", "text/plain")
 
         def it_calls_end_headers(fake_invalid_request, dummy_client, dummy_server, mock_response_methods):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
@@ -358,4 +530,861 @@ def describe_SquirrelServerHandler():
             response = SquirrelServerHandler(fake_invalid_request, dummy_client, dummy_server)
             response.wfile.write.assert_called_once_with(bytes("404 Not Found", "utf-8"))
 
+        def it_sends_content_length_header(fake_invalid_request, dummy_client, dummy_server, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            SquirrelServerHandler(fake_invalid_request, dummy_client, dummy_server)
+            mock_send_header.assert_any_call("Content-Length", "13")
+
+    def describe_database_busy():
+        def it_answers_503_with_retry_after(mocker, unbuffered, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelDB, 'getSquirrel', side_effect=DatabaseBusy("database is locked"))
+            conn = BufferedConnection(b"GET /squirrels/1 HTTP/1.1\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            assert conn.output.getvalue().startswith(b"HTTP/1.1 503")
+            assert b"Retry-After: 1\r\n" in conn.output.getvalue()
+
+        def it_answers_503_when_the_pool_is_exhausted(mocker, unbuffered, dummy_client, dummy_server):
+            mocker.patch.object(SquirrelDB, '__init__', side_effect=PoolTimeout("no database connection"))
+            conn = BufferedConnection(b"GET /squirrels/1 HTTP/1.1\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            assert conn.output.getvalue().startswith(b"HTTP/1.1 503")
+
+        def it_lets_other_database_errors_through(mocker, unbuffered, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelDB, 'getSquirrel', side_effect=sqlite3.OperationalError("no such table: squirrels"))
+            with pytest.raises(sqlite3.OperationalError):
+                SquirrelServerHandler(BufferedConnection(b"GET /squirrels/1 HTTP/1.1\r\n\r\n"), dummy_client, dummy_server)
+
+    def describe_keepAlive():
+
+        def it_serves_pipelined_requests_on_one_connection(unbuffered, mock_db_stream_squirrels, dummy_client, dummy_server):
+            conn = BufferedConnection(b"GET /squirrels HTTP/1.1\r\n\r\nGET /invalid HTTP/1.1\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            output = conn.output.getvalue()
+            assert output.count(b"HTTP/1.1 200") == 1
+            assert output.count(b"HTTP/1.1 404") == 1
+
+        def it_sends_content_length_on_201(unbuffered, mock_db_create_squirrel, dummy_client, dummy_server):
+            body = b'{"name":"Chippy","size":"small"}'
+            conn = BufferedConnection(b"POST /squirrels HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            assert b"Content-Length: 0\r\n" in conn.output.getvalue()
+
+        def it_skips_an_unread_body_before_the_next_request(unbuffered, mock_db_stream_squirrels, dummy_client, dummy_server):
+            conn = BufferedConnection(b"POST /invalid HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}GET /squirrels HTTP/1.1\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            assert b"HTTP/1.1 200" in conn.output.getvalue()
+            assert b"HTTP/1.1 400" not in conn.output.getvalue()
+
+        def it_closes_after_the_maximum_number_of_requests(mocker, unbuffered, mock_db_stream_squirrels, dummy_client, dummy_server):
+            mocker.patch.object(SquirrelServerHandler, 'maxRequests', 1)
+            conn = BufferedConnection(b"GET /squirrels HTTP/1.1\r\n\r\nGET /squirrels HTTP/1.1\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            assert conn.output.getvalue().count(b"HTTP/1.1 200") == 1
+            assert b"Connection: close\r\n" in conn.output.getvalue()
+
+
+    def describe_caching():
+
+        def it_answers_a_repeated_retrieve_from_the_cache(mocker, dummy_client, dummy_server, mock_db_get_squirrel):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1'), dummy_client, dummy_server)
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/01'), dummy_client, dummy_server)
+            mock_db_get_squirrel.assert_called_once()
+            response.wfile.write.assert_called_once_with(SQUIRREL_JSON)
+
+        def it_sends_an_etag_led_by_the_version(mocker, dummy_client, dummy_server, mock_db_get_squirrel, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1'), dummy_client, dummy_server)
+            mock_send_header.assert_any_call("ETag", SQUIRREL_ETAG)
+
+        def it_answers_a_matching_if_none_match_with_304(mocker, unbuffered, dummy_client, dummy_server, mock_db_get_squirrel):
+            etag = SQUIRREL_ETAG
+            conn = BufferedConnection(b"GET /squirrels/1 HTTP/1.1\r\nIf-None-Match: W/%s\r\n\r\n" % etag.encode())
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            assert conn.output.getvalue().startswith(b"HTTP/1.1 304")
+            assert conn.output.getvalue().endswith(b"\r\n\r\n")
+
+        def it_caches_the_streamed_index(mocker, dummy_client, dummy_server, mock_db_stream_squirrels):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+            mock_db_stream_squirrels.assert_called_once()
+            assert written(response) == bytes(json.dumps(['squirrel']), "utf-8")
+
+        def it_empties_the_index_on_create(mocker, dummy_client, dummy_server, mock_db_stream_squirrels, mock_db_create_squirrel, mock_get_request_data):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels', body='{}'), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+            assert mock_db_stream_squirrels.call_count == 2
+
+        def it_keeps_other_squirrels_on_update(mocker, dummy_client, dummy_server, mock_db_get_squirrel, mock_db_update_squirrel, mock_get_request_data):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1'), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/2'), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'PUT', '/squirrels/1', body='{}'), dummy_client, dummy_server)
+            mock_db_get_squirrel.reset_mock()
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1'), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/2'), dummy_client, dummy_server)
+            mock_db_get_squirrel.assert_called_once_with('1')
+
+        def it_drops_the_squirrel_on_delete(mocker, dummy_client, dummy_server, mock_db_get_squirrel, mock_db_delete_squirrel):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1'), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'DELETE', '/squirrels/1'), dummy_client, dummy_server)
+            mock_db_get_squirrel.reset_mock()
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1'), dummy_client, dummy_server)
+            mock_db_get_squirrel.assert_called_once_with('1')
+
+    def describe_compression():
+
+        @pytest.fixture
+        def compress_everything(mocker):
+            mocker.patch.object(SquirrelServerHandler, 'compressMinBytes', 1)
+
+        def it_gzips_for_a_client_that_accepts_it(unbuffered, compress_everything, dummy_client, dummy_server, mock_db_get_squirrel):
+            status, headers, body = get_with("/squirrels/1", {"Accept-Encoding": "gzip, deflate"}, dummy_client, dummy_server)
+            assert headers["Content-Encoding"] == "gzip"
+            assert headers["Vary"] == "Accept-Encoding"
+            assert headers["ETag"] == codedEtag(SQUIRREL_ETAG, "gzip")
+            assert gzip.decompress(body) == SQUIRREL_JSON
+
+        def it_sends_bodies_under_the_threshold_as_they_are(unbuffered, dummy_client, dummy_server, mock_db_get_squirrel):
+            status, headers, body = get_with("/squirrels/1", {"Accept-Encoding": "gzip"}, dummy_client, dummy_server)
+            assert "Content-Encoding" not in headers
+            assert body == SQUIRREL_JSON
+
+        def it_compresses_a_cached_body_once(mocker, unbuffered, compress_everything, dummy_client, dummy_server, mock_db_get_squirrel):
+            compress = mocker.spy(squirrel_server, 'compressBody')
+            first = get_with("/squirrels/1", {"Accept-Encoding": "deflate"}, dummy_client, dummy_server)
+            second = get_with("/squirrels/1", {"Accept-Encoding": "deflate"}, dummy_client, dummy_server)
+            assert compress.call_count == 1
+            assert zlib.decompress(second[2]) == SQUIRREL_JSON
+            assert first[2] == second[2]
+
+        def it_answers_the_etag_of_the_compressed_body_with_304(unbuffered, compress_everything, dummy_client, dummy_server, mock_db_get_squirrel):
+            etag = get_with("/squirrels/1", {"Accept-Encoding": "gzip"}, dummy_client, dummy_server)[1]["ETag"]
+            status, headers, body = get_with("/squirrels/1", {"Accept-Encoding": "gzip", "If-None-Match": etag}, dummy_client, dummy_server)
+            assert status.startswith("HTTP/1.1 304")
+
+        def it_streams_the_index_compressed(unbuffered, compress_everything, dummy_client, dummy_server, mock_db_stream_squirrels):
+            status, headers, body = get_with("/squirrels", {"Accept-Encoding": "gzip"}, dummy_client, dummy_server)
+            assert headers["Content-Encoding"] == "gzip"
+            assert gzip.decompress(body) == b'["squirrel"]'
+
+        def it_sends_an_index_under_the_threshold_as_it_is(mocker, unbuffered, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelDB, 'streamSquirrelsJson', return_value=iter([]))
+            status, headers, body = get_with("/squirrels", {"Accept-Encoding": "gzip"}, dummy_client, dummy_server)
+            assert "Content-Encoding" not in headers
+            assert (headers["Content-Length"], body) == ("2", b"[]")
+            assert headers["ETag"] == etagFor(b"[]")
+
+        def it_serves_the_cached_index_as_it_was_streamed(mocker, unbuffered, compress_everything, dummy_client, dummy_server, mock_db_stream_squirrels):
+            streamed = get_with("/squirrels", {"Accept-Encoding": "gzip"}, dummy_client, dummy_server)
+            compress = mocker.spy(squirrel_server, 'compressBody')
+            cached = get_with("/squirrels", {"Accept-Encoding": "gzip"}, dummy_client, dummy_server)
+            compress.assert_not_called()
+            assert cached[1]["Content-Length"] == str(len(streamed[2]))
+            assert gzip.decompress(cached[2]) == b'["squirrel"]'
+
+        def it_compresses_untagged_responses(unbuffered, compress_everything, dummy_client, dummy_server, fresh_metrics):
+            fresh_metrics.inc("squirrel_connections_open")
+            status, headers, body = get_with("/metrics", {"Accept-Encoding": "deflate"}, dummy_client, dummy_server)
+            assert headers["Content-Encoding"] == "deflate"
+            assert zlib.decompress(body) == b"squirrel_connections_open 1\n"
+
+    def describe_debugProfile():
+
+        @pytest.fixture
+        def profiler(mocker, tmp_path):
+            profiler = Profiler(str(tmp_path), token="secret")
+            mocker.patch.object(SquirrelServerHandler, 'profiler', profiler)
+            yield profiler
+            profiler.stop()
+
+        def it_is_not_found_without_a_profile_directory(mocker, unbuffered, dummy_client, dummy_server):
+            mocker.patch.object(SquirrelServerHandler, 'profiler', Profiler())
+            status, headers, body = get_with("/_debug/profile", {}, dummy_client, dummy_server, "POST")
+            assert status.startswith("HTTP/1.1 404")
+
+        def it_refuses_a_wrong_token(unbuffered, profiler, dummy_client, dummy_server):
+            status, headers, body = get_with("/_debug/profile", {"Authorization": "Bearer guess"}, dummy_client, dummy_server, "POST")
+            assert status.startswith("HTTP/1.1 403")
+            assert not profiler.active
+
+        def it_starts_a_profile(unbuffered, profiler, tmp_path, dummy_client, dummy_server):
+            status, headers, body = get_with("/_debug/profile?seconds=5&sample=1&allocations=0", {"Authorization": "Bearer secret"}, dummy_client, dummy_server, "POST")
+            assert status.startswith("HTTP/1.1 202")
+            session = json.loads(body)
+            assert (session["seconds"], session["sample"]) == (5, 1)
+            assert list(session["files"]) == ["profile"]
+            assert profiler.active
+
+        def it_rejects_a_bad_duration(unbuffered, profiler, dummy_client, dummy_server):
+            status, headers, body = get_with("/_debug/profile?seconds=0", {"Authorization": "Bearer secret"}, dummy_client, dummy_server, "POST")
+            assert status.startswith("HTTP/1.1 400")
+
+        def it_conflicts_with_a_running_profile(unbuffered, profiler, dummy_client, dummy_server):
+            profiler.start(5, 1, allocations=False)
+            status, headers, body = get_with("/_debug/profile", {"Authorization": "Bearer secret"}, dummy_client, dummy_server, "POST")
+            assert status.startswith("HTTP/1.1 409")
+
+        def it_profiles_requests_and_writes_the_stats(unbuffered, profiler, dummy_client, dummy_server, mock_db_get_squirrel):
+            profiler.start(5, 1, allocations=False)
+            get_with("/squirrels/1", {}, dummy_client, dummy_server)
+            status, headers, body = get_with("/_debug/profile", {"Authorization": "Bearer secret"}, dummy_client, dummy_server, "DELETE")
+            assert status.startswith("HTTP/1.1 200")
+            path = json.loads(body)["files"]["profile"]
+            assert any(name == "handleSquirrelsRetrieve" for filename, line, name in pstats.Stats(path).stats)
+
+        def it_conflicts_when_stopping_nothing(unbuffered, profiler, dummy_client, dummy_server):
+            status, headers, body = get_with("/_debug/profile", {"Authorization": "Bearer secret"}, dummy_client, dummy_server, "DELETE")
+            assert status.startswith("HTTP/1.1 409")
+
+        def it_leaves_requests_alone_while_inactive(mocker, unbuffered, profiler, dummy_client, dummy_server, mock_db_get_squirrel):
+            begin = mocker.spy(profiler, 'begin')
+            get_with("/squirrels/1", {}, dummy_client, dummy_server)
+            begin.assert_not_called()
+
+    def describe_filters():
+
+        def it_passes_filters_to_the_stream(mocker, dummy_client, dummy_server, mock_db_stream_squirrels):
+            request = FakeRequest(mocker.Mock(), 'GET', '/squirrels?size=large&name_prefix=Fl&fields=id,name&sort=-name')
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+            mock_db_stream_squirrels.assert_called_once_with(size="large", namePrefix="Fl", fields=("id", "name"), sort="-name")
+
+        def it_passes_filters_to_a_page(mocker, dummy_client, dummy_server, mock_db_query_squirrels):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?size=small&limit=5'), dummy_client, dummy_server)
+            mock_db_query_squirrels.assert_called_once_with(limit=5, afterId=None, size="small")
+
+        def it_keeps_filters_in_the_next_link(mocker, dummy_client, dummy_server, mock_db_init, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            mocker.patch.object(SquirrelDB, 'querySquirrelsJson', return_value=[(4, '{"id":4}')])
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?size=small&fields=id,name&limit=1'), dummy_client, dummy_server)
+            mock_send_header.assert_any_call("Link", '</squirrels?size=small&fields=id,name&limit=1&after_id=4>; rel="next"')
 
+        def it_caches_each_filter_separately(mocker, dummy_client, dummy_server, mock_db_stream_squirrels):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?size=small'), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?size=large'), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?size=small'), dummy_client, dummy_server)
+            assert mock_db_stream_squirrels.call_count == 2
+
+        def it_returns_400_for_an_unknown_field(mocker, dummy_client, dummy_server, mock_db_stream_squirrels, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?fields=id,password'), dummy_client, dummy_server)
+            mock_send_response.assert_called_once_with(400)
+            mock_db_stream_squirrels.assert_not_called()
+
+        def it_returns_400_for_after_id_with_another_sort(mocker, dummy_client, dummy_server, mock_db_query_squirrels, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?sort=name&after_id=3'), dummy_client, dummy_server)
+            mock_send_response.assert_called_once_with(400)
+
+    def describe_handleSquirrelsBulk():
+
+        @pytest.fixture
+        def mock_db_bulk(mocker, mock_db_init):
+            mocker.patch.object(SquirrelDB, 'commit')
+            mocker.patch.object(SquirrelDB, 'bulkCreateSquirrels', side_effect=lambda rows, *args, **kwargs: len(rows))
+            mocker.patch.object(SquirrelDB, 'bulkUpdateSquirrels', side_effect=lambda rows, *args, **kwargs: [row[0] == 1 for row in rows])
+            mocker.patch.object(SquirrelDB, 'bulkDeleteSquirrels', side_effect=lambda ids, *args, **kwargs: [i == 1 for i in ids])
+            return SquirrelDB
+
+        def it_reports_a_status_per_item(mocker, dummy_client, dummy_server, mock_db_bulk):
+            items = [{"name": "a", "size": "small"}, {"op": "update", "id": 1, "name": "b", "size": "large"},
+                     {"op": "delete", "id": 7}, {"op": "explode"}]
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body=json.dumps(items)), dummy_client, dummy_server)
+            results = json.loads(written(response))
+            assert [result["status"] for result in results] == [201, 204, 404, 400]
+
+        def it_groups_consecutive_items_with_the_same_op(mocker, dummy_client, dummy_server, mock_db_bulk):
+            items = [{"name": "a", "size": "small"}, {"name": "b", "size": "small"}, {"op": "delete", "id": 1}, {"name": "c", "size": "small"}]
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body=json.dumps(items)), dummy_client, dummy_server)
+            rows = [args[0] for args, kwargs in mock_db_bulk.bulkCreateSquirrels.call_args_list]
+            assert rows == [[("a", "small"), ("b", "small")], [("c", "small")]]
+
+        def it_commits_once(mocker, dummy_client, dummy_server, mock_db_bulk):
+            items = [{"name": "a", "size": "small"}, {"op": "delete", "id": 1}]
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body=json.dumps(items)), dummy_client, dummy_server)
+            mock_db_bulk.commit.assert_called_once()
+            mock_db_bulk.bulkCreateSquirrels.assert_called_once_with([("a", "small")], SquirrelServerHandler.bulkBatchSize, commit=False)
+
+        def it_reads_ndjson_line_by_line(mocker, unbuffered, dummy_client, dummy_server, mock_db_bulk):
+            body = b'{"name": "a", "size": "small"}\nnot json\n\n{"op": "delete", "id": 1}\n'
+            conn = BufferedConnection(b"POST /squirrels/_bulk HTTP/1.1\r\nContent-Type: application/x-ndjson\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            results = json.loads(conn.output.getvalue().partition(b"\r\n\r\n")[2])
+            assert [result["status"] for result in results] == [201, 400, 204]
+
+        def it_reads_ndjson_before_opening_a_sqlite_transaction(mocker, unbuffered, dummy_client, mock_db_bulk):
+            events = []
+            lines = [b'{"name":"a","size":"small"}\n', b'{"name":"b","size":"small"}\n']
+            mocker.patch.object(SquirrelServerHandler, 'readLines', lambda self: (events.append("read") or line for line in lines))
+            server = SimpleNamespace(backend=SQLiteBackend(pool=mocker.Mock()))
+            mocker.patch.object(server.backend, 'open', side_effect=lambda: events.append("open") or SquirrelDB())
+            conn = BufferedConnection(b"POST /squirrels/_bulk HTTP/1.1\r\nContent-Type: application/x-ndjson\r\nContent-Length: 0\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, server)
+            assert events == ["read", "read", "open"]
+            mock_db_bulk.bulkCreateSquirrels.assert_called_once_with([("a", "small"), ("b", "small")], SquirrelServerHandler.bulkBatchSize, commit=False)
+
+        def it_serves_the_next_request_after_a_malformed_array(unbuffered, dummy_client, dummy_server, mock_db_bulk, mock_db_stream_squirrels):
+            conn = BufferedConnection(b"POST /squirrels/_bulk HTTP/1.1\r\nContent-Length: 6\r\n\r\n[{,}]]GET /squirrels HTTP/1.1\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            output = conn.output.getvalue()
+            assert output.startswith(b"HTTP/1.1 400")
+            assert output.count(b"HTTP/1.1 200") == 1
+
+        def it_returns_400_for_a_body_that_is_not_an_array(mocker, dummy_client, dummy_server, mock_db_bulk, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body='{"name": "a"}'), dummy_client, dummy_server)
+            mock_send_response.assert_called_once_with(400)
+
+        def it_empties_the_response_cache(mocker, dummy_client, dummy_server, mock_db_bulk, fresh_cache):
+            fresh_cache.put(("squirrel", 1), b"cached")
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body='[]'), dummy_client, dummy_server)
+            assert fresh_cache.get(("squirrel", 1)) is None
+
+    def describe_accessLog():
+
+        def it_does_not_print_request_bodies(mocker, capsys, dummy_client, dummy_server, mock_db_create_squirrel, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels', body='{"name": "Chippy", "size": "small"}'), dummy_client, dummy_server)
+            assert capsys.readouterr().out == ""
+
+        def it_logs_sampled_requests_with_phase_timings(mocker, caplog, unbuffered, mock_db_get_squirrel, dummy_client, dummy_server):
+            mocker.patch.object(SquirrelServerHandler, 'logSample', 1.0)
+            with caplog.at_level(logging.INFO, logger="squirrel.access"):
+                SquirrelServerHandler(BufferedConnection(b"GET /squirrels/1 HTTP/1.1\r\n\r\n"), dummy_client, dummy_server)
+            [record] = caplog.records
+            assert record.access["method"] == "GET"
+            assert record.access["path"] == "/squirrels/1"
+            assert record.access["status"] == 200
+            assert record.access["bytes"] > 0
+            assert set(record.access["phases"]) >= {"parse", "db", "serialize", "write"}
+
+        def it_skips_unsampled_requests(mocker, caplog, unbuffered, mock_db_get_squirrel, dummy_client, dummy_server):
+            mocker.patch.object(SquirrelServerHandler, 'logSample', 0.0)
+            with caplog.at_level(logging.INFO, logger="squirrel.access"):
+                SquirrelServerHandler(BufferedConnection(b"GET /squirrels/1 HTTP/1.1\r\n\r\n"), dummy_client, dummy_server)
+            assert caplog.records == []
+
+        def it_always_logs_server_errors(mocker, caplog, unbuffered, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelServerHandler, 'logSample', 0.0)
+            mocker.patch.object(SquirrelDB, 'getSquirrel', side_effect=DatabaseBusy("database is locked"))
+            with caplog.at_level(logging.INFO, logger="squirrel.access"):
+                SquirrelServerHandler(BufferedConnection(b"GET /squirrels/1 HTTP/1.1\r\n\r\n"), dummy_client, dummy_server)
+            [record] = caplog.records
+            assert record.access["status"] == 503
+            assert "phases" not in record.access
+
+    def describe_metrics():
+
+        def it_counts_requests_by_handler_and_status(unbuffered, mock_db_get_squirrel, dummy_client, dummy_server, fresh_metrics):
+            SquirrelServerHandler(BufferedConnection(b"GET /squirrels/1 HTTP/1.1\r\n\r\nGET /nope HTTP/1.1\r\n\r\n"), dummy_client, dummy_server)
+            text = fresh_metrics.render()
+            assert 'squirrel_requests_total{route="handleSquirrelsRetrieve",method="GET",status="200"} 1' in text
+            assert 'squirrel_requests_total{route="handle404",method="GET",status="404"} 1' in text
+            assert 'squirrel_request_seconds_count{route="handleSquirrelsRetrieve"} 1' in text
+
+        def it_labels_a_page_with_the_page_handler(unbuffered, mock_db_query_squirrels, dummy_client, dummy_server, fresh_metrics):
+            SquirrelServerHandler(BufferedConnection(b"GET /squirrels?limit=1 HTTP/1.1\r\n\r\n"), dummy_client, dummy_server)
+            assert 'route="handleSquirrelsPage",method="GET",status="200"' in fresh_metrics.render()
+
+        def it_serves_the_registry_at_metrics(unbuffered, dummy_client, dummy_server, fresh_metrics):
+            fresh_metrics.describe("squirrel_test_total", "counter", "Test.")
+            fresh_metrics.inc("squirrel_test_total")
+            conn = BufferedConnection(b"GET /metrics HTTP/1.1\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, dummy_server)
+            output = conn.output.getvalue()
+            assert output.startswith(b"HTTP/1.1 200")
+            assert b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n" in output
+            assert output.endswith(b"# HELP squirrel_test_total Test.\n# TYPE squirrel_test_total counter\nsquirrel_test_total 1\n")
+
+    def describe_backend():
+
+        @pytest.fixture
+        def memory_server():
+            backend = MemoryBackend()
+            backend.load([(1, "Fluffy", "large")])
+            return SimpleNamespace(backend=backend)
+
+        def it_serves_from_the_server_backend(mocker, unbuffered, dummy_client, memory_server):
+            init = mocker.patch.object(SquirrelDB, '__init__')
+            conn = BufferedConnection(b"GET /squirrels/1 HTTP/1.1\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, memory_server)
+            assert conn.output.getvalue().endswith(b'{"id":1,"name":"Fluffy","size":"large"}')
+            init.assert_not_called()
+
+        def it_writes_to_the_server_backend(unbuffered, dummy_client, memory_server):
+            body = b'{"name":"Chippy","size":"small"}'
+            conn = BufferedConnection(b"POST /squirrels HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            SquirrelServerHandler(conn, dummy_client, memory_server)
+            assert memory_server.backend.getSquirrel(2) == {"id": 2, "name": "Chippy", "size": "small", "version": 1}
+
+        def it_refuses_a_stale_if_match_after_a_delete_and_create(unbuffered, dummy_client, memory_server):
+            etag = get_with("/squirrels/1", {}, dummy_client, memory_server)[1]["ETag"]
+            get_with("/squirrels/1", {}, dummy_client, memory_server, "DELETE")
+            body = b'{"name":"Chippy","size":"small"}'
+            SquirrelServerHandler(BufferedConnection(b"POST /squirrels HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)), dummy_client, memory_server)
+            conn = BufferedConnection(b"PUT /squirrels/1 HTTP/1.1\r\nIf-Match: %s\r\nContent-Length: %d\r\n\r\n%s" % (etag.encode(), len(body), body))
+            SquirrelServerHandler(conn, dummy_client, memory_server)
+            assert conn.output.getvalue().startswith(b"HTTP/1.1 404")
+            assert memory_server.backend.getSquirrel(2)["version"] == 1
+
+        def it_reads_a_bulk_body_before_locking_the_memory_backend(mocker, unbuffered, dummy_client, memory_server):
+            events = []
+            lines = [b'{"name":"a","size":"small"}\n', b'{"name":"b","size":"small"}\n']
+            mocker.patch.object(SquirrelServerHandler, 'readLines', lambda self: (events.append("read") or line for line in lines))
+            mocker.patch.object(memory_server.backend, 'open', side_effect=lambda: events.append("open") or memory_server.backend)
+            conn = BufferedConnection(b"POST /squirrels/_bulk HTTP/1.1\r\nContent-Type: application/x-ndjson\r\nContent-Length: 0\r\n\r\n")
+            SquirrelServerHandler(conn, dummy_client, memory_server)
+            assert events == ["read", "read", "open"]
+            assert memory_server.backend.getSquirrel(3)["name"] == "b"
+
+        def it_falls_back_to_squirrel_db_without_a_server(mocker, dummy_client, dummy_server, mock_db_get_squirrel, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1'), dummy_client, dummy_server)
+            mock_db_get_squirrel.assert_called_once_with('1')
+
+def describe_JsonLinesFormatter():
+
+    def it_formats_access_records_as_one_json_line():
+        record = logging.makeLogRecord({"access": {"status": 200, "ms": 1.5}})
+        line = JsonLinesFormatter().format(record)
+        assert "\n" not in line
+        entry = json.loads(line)
+        assert list(entry)[0] == "ts"
+        assert entry["status"] == 200
+
+    def it_formats_other_records_with_level_and_message():
+        record = logging.makeLogRecord({"msg": "code %d", "args": (400,), "levelname": "WARNING"})
+        entry = json.loads(JsonLinesFormatter().format(record))
+        assert entry["level"] == "warning"
+        assert entry["message"] == "code 400"
+
+def describe_startLogging():
+
+    @pytest.fixture
+    def restore_access_log(mocker):
+        mocker.patch.object(accessLog, 'handlers', [])
+        mocker.patch.object(accessLog, 'propagate', True)
+        mocker.patch.object(accessLog, 'level', accessLog.level)
+        mocker.patch.object(SquirrelServerHandler, 'logSample', SquirrelServerHandler.logSample)
+
+    def it_writes_through_a_queue_listener(restore_access_log):
+        stream = io.StringIO()
+        listener = startLogging(stream, sample=0.25)
+        accessLog.info("request", extra={"access": {"status": 204}})
+        listener.stop()
+        assert json.loads(stream.getvalue())["status"] == 204
+        assert SquirrelServerHandler.logSample == 0.25
+
+def describe_encodeJson():
+
+    def it_encodes_compact_json_bytes():
+        assert encodeJson([{"id": 1, "name": "Fluffy"}]) == b'[{"id":1,"name":"Fluffy"}]'
+
+    def it_works_without_orjson(mocker):
+        mocker.patch("squirrel_server.orjson", None)
+        assert encodeJson([{"id": 1, "name": "Fluffy"}]) == b'[{"id":1,"name":"Fluffy"}]'
+
+    def it_falls_back_for_what_orjson_refuses():
+        assert json.loads(encodeJson({"name": "\ud800"})) == {"name": "\ud800"}
+
+def describe_encodeSquirrel():
+
+    def it_leads_the_etag_with_the_version():
+        assert encodeSquirrel(SQUIRREL) == (SQUIRREL_JSON, SQUIRREL_ETAG)
+
+def describe_matchVersions():
+
+    def it_reads_the_version_of_each_tag():
+        assert matchVersions('"3-abc", "7-def"') == [3, 7]
+
+    def it_matches_any_version_for_a_star():
+        assert matchVersions(" * ") is None
+
+    def it_ignores_weak_and_foreign_tags():
+        assert matchVersions('W/"3-abc", "abc", "x-1"') == []
+
+def describe_parseBulkItem():
+
+    def it_defaults_to_create():
+        assert parseBulkItem({"name": "a", "size": "small"}) == ("create", ("a", "small"))
+
+    def it_decodes_a_raw_line():
+        assert parseBulkItem(b'{"op": "delete", "id": "3"}') == ("delete", 3)
+
+    def it_rejects_missing_fields():
+        with pytest.raises(ValueError, match="update needs id"):
+            parseBulkItem({"op": "update", "name": "a", "size": "small"})
+
+    def it_rejects_a_non_integer_id():
+        with pytest.raises(ValueError):
+            parseBulkItem({"op": "delete", "id": "1; DROP TABLE squirrels"})
+
+def describe_spoolLines():
+
+    def it_replays_lines_spilled_to_a_file():
+        lines = [b'{"op": "delete", "id": 1}\n', b'{"op": "delete", "id": 2}']
+        assert list(spoolLines(iter(lines), maxBytes=10)) == [lines[0], lines[1] + b"\n"]
+
+    def it_reads_everything_before_returning():
+        lines = iter([b"one\n", b"two\n"])
+        spoolLines(lines)
+        assert list(lines) == []
+
+    def it_passes_a_decoded_array_through():
+        items = [{"op": "delete", "id": 1}]
+        assert spoolLines(items) is items
+
+def describe_acceptedCoding():
+
+    @pytest.mark.parametrize("header, coding", [
+        (None, None),
+        ("gzip, deflate, br", "gzip"),
+        ("deflate", "deflate"),
+        ("gzip;q=0.5, deflate", "deflate"),
+        ("gzip;q=0, deflate;q=0", None),
+        ("*", "gzip"),
+        ("*;q=0.5, gzip;q=0", "deflate"),
+        ("identity, gzip;q=0.5", None),
+        ("br", None),
+    ])
+    def it_picks_the_coding_the_client_prefers(header, coding):
+        assert acceptedCoding(header) == coding
+
+def describe_ResponseCache():
+
+    def it_drops_everything_once_disabled():
+        cache = ResponseCache()
+        cache.put(("squirrel", 1), b"body")
+        cache.disable()
+        cache.put(("squirrel", 2), b"body")
+        assert cache.get(("squirrel", 1)) is None
+        assert cache.get(("squirrel", 2)) is None
+        assert cache.stats()["entries"] == 0
+
+    def it_keeps_compressed_bodies_with_the_entry():
+        cache = ResponseCache()
+        etag = cache.put(("squirrel", 1), b"body")
+        cache.putEncoded(("squirrel", 1), "gzip", etag, b"gz")
+        assert cache.getEncoded(("squirrel", 1), "gzip", etag) == b"gz"
+        assert cache.getEncoded(("squirrel", 1), "deflate", etag) is None
+        assert cache.stats()["bytes"] == 6
+
+    def it_drops_compressed_bodies_with_the_entry():
+        cache = ResponseCache()
+        etag = cache.put(("squirrel", 1), b"body")
+        cache.putEncoded(("squirrel", 1), "gzip", etag, b"gz")
+        cache.invalidate(("squirrel", 1))
+        assert cache.getEncoded(("squirrel", 1), "gzip", etag) is None
+        assert cache.stats()["bytes"] == 0
+
+    def it_ignores_a_compressed_body_of_another_version():
+        cache = ResponseCache()
+        cache.put(("squirrel", 1), b"body")
+        cache.putEncoded(("squirrel", 1), "gzip", '"old"', b"gz")
+        assert cache.stats()["bytes"] == 4
+
+    def it_returns_what_was_put():
+        cache = ResponseCache()
+        etag = cache.put(("squirrel", 1), b"body", {"Link": "x"})
+        assert cache.get(("squirrel", 1)) == (b"body", etag, {"Link": "x"})
+
+    def it_expires_entries_after_the_ttl(mocker):
+        cache = ResponseCache(ttl=5)
+        mock_time = mocker.patch("time.monotonic", return_value=100)
+        cache.put(("squirrel", 1), b"body")
+        mock_time.return_value = 105
+        assert cache.get(("squirrel", 1)) is None
+
+    def it_evicts_the_least_recently_used_beyond_max_bytes():
+        cache = ResponseCache(maxBytes=8)
+        cache.put(("squirrel", 1), b"1111")
+        cache.put(("squirrel", 2), b"2222")
+        cache.get(("squirrel", 1))
+        cache.put(("squirrel", 3), b"3333")
+        assert cache.get(("squirrel", 2)) is None
+        assert cache.get(("squirrel", 1)) is not None
+        assert cache.stats()["evictions"] == 1
+
+    def it_skips_bodies_over_the_entry_limit():
+        cache = ResponseCache(maxEntryBytes=2)
+        cache.put(("squirrel", 1), b"body")
+        assert cache.get(("squirrel", 1)) is None
+
+    def it_refuses_a_response_computed_before_an_invalidation():
+        cache = ResponseCache()
+        generation = cache.generation
+        cache.invalidate(("squirrel", 1))
+        cache.put(("squirrel", 1), b"stale", generation=generation)
+        assert cache.get(("squirrel", 1)) is None
+
+    def it_invalidates_a_whole_group():
+        cache = ResponseCache()
+        cache.put(("squirrels",), b"all")
+        cache.put(("squirrels", 10, 0), b"page")
+        cache.put(("squirrel", 1), b"one")
+        cache.invalidateGroup("squirrels")
+        assert cache.stats()["entries"] == 1
+        assert cache.get(("squirrel", 1)) is not None
+
+def describe_PooledHTTPServer():
+
+    def describe_init():
+        def it_defaults_to_the_sqlite_backend():
+            server = PooledHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=1)
+            try:
+                assert isinstance(server.backend, SQLiteBackend)
+            finally:
+                server.server_close()
+
+        def it_keeps_the_backend_it_is_given():
+            backend = MemoryBackend()
+            server = PooledHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=1, backend=backend)
+            try:
+                assert server.backend is backend
+            finally:
+                server.server_close()
+
+    def describe_process_request():
+        def it_queues_the_connection_for_a_worker(mocker):
+            server = mocker.Mock(requests=queue.Queue(1))
+            request = mocker.Mock()
+            PooledHTTPServer.process_request(server, request, ('127.0.0.1', 80))
+            assert server.requests.get_nowait() == (request, ('127.0.0.1', 80))
+
+        def it_answers_503_when_the_queue_is_full(mocker):
+            server = mocker.Mock(requests=queue.Queue(1))
+            server.requests.put_nowait("busy")
+            request = mocker.Mock()
+            PooledHTTPServer.process_request(server, request, ('127.0.0.1', 80))
+            request.sendall.assert_called_once_with(SERVICE_UNAVAILABLE)
+
+        def it_closes_a_rejected_connection(mocker):
+            server = mocker.Mock(requests=queue.Queue(1))
+            server.requests.put_nowait("busy")
+            request = mocker.Mock()
+            PooledHTTPServer.process_request(server, request, ('127.0.0.1', 80))
+            server.shutdown_request.assert_called_once_with(request)
+
+    def describe_idle_connections():
+        def it_gives_idle_workers_to_waiting_connections(mocker, unbuffered):
+            mocker.patch("squirrel_server.BUSY_IDLE_TIMEOUT", 0.1)
+            backend = MemoryBackend()
+            backend.load([(1, "Fluffy", "large")])
+            server = PooledHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=2, backend=backend)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            idle = [http.client.HTTPConnection(*server.server_address) for _ in server.workers]
+            try:
+                for conn in idle:
+                    conn.request("GET", "/squirrels/1")
+                    assert conn.getresponse().read() == SQUIRREL_JSON
+                started = time.monotonic()
+                conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+                conn.request("GET", "/squirrels/1")
+                assert conn.getresponse().read() == SQUIRREL_JSON
+                assert time.monotonic() - started < 2
+                conn.close()
+            finally:
+                for conn in idle:
+                    conn.close()
+                server.shutdown()
+                server.server_close()
+
+        def it_keeps_idle_connections_while_nothing_waits(mocker, unbuffered):
+            mocker.patch("squirrel_server.BUSY_IDLE_TIMEOUT", 0.1)
+            backend = MemoryBackend()
+            backend.load([(1, "Fluffy", "large")])
+            server = PooledHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=1, backend=backend)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+            try:
+                conn.request("GET", "/squirrels/1")
+                conn.getresponse().read()
+                sock = conn.sock
+                time.sleep(0.3)
+                conn.request("GET", "/squirrels/1")
+                assert conn.getresponse().read() == SQUIRREL_JSON
+                assert conn.sock is sock
+            finally:
+                conn.close()
+                server.shutdown()
+                server.server_close()
+
+def describe_listenSocket():
+
+    def it_serves_a_pooled_server_on_the_given_socket(unbuffered):
+        sock = listenSocket(("127.0.0.1", 0))
+        backend = MemoryBackend()
+        backend.load([(1, "Fluffy", "large")])
+        server = PooledHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=1, backend=backend, sock=sock)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection(*sock.getsockname())
+            conn.request("GET", "/squirrels/1")
+            assert conn.getresponse().read() == SQUIRREL_JSON
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+# prefork workers record their pid in a file and then wait to be signalled;
+# the first restarts - 1 of them exit at once instead
+def record_pid(path, restarts=1):
+    with open(path, "a") as f:
+        f.write("%d\n" % os.getpid())
+    with open(path) as f:
+        if len(f.readlines()) < restarts:
+            raise RuntimeError("worker failed")
+    signal.pause()
+
+def recorded_pids(path, count):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if os.path.exists(path):
+            with open(path) as f:
+                pids = f.read().split()
+            if len(pids) >= count:
+                return pids
+        time.sleep(0.01)
+    raise AssertionError("only %d workers started" % len(pids))
+
+def supervise(path, processes, restarts=1):
+    # the supervisor blocks signals and forks, so it runs in a process of its own
+    supervisor = PreforkSupervisor(None, processes, lambda sock: record_pid(path, restarts), restartDelay=0)
+    process = multiprocessing.get_context("fork").Process(target=supervisor.run)
+    process.start()
+    return process
+
+def describe_PreforkSupervisor():
+
+    def it_starts_the_workers_and_stops_them_on_sigterm(tmp_path):
+        path = str(tmp_path / "pids")
+        process = supervise(path, 2)
+        pids = recorded_pids(path, 2)
+        process.terminate()
+        process.join(5)
+        assert process.exitcode == 0
+        assert not any(os.path.exists("/proc/%s" % pid) for pid in pids)
+
+    def it_restarts_a_worker_that_exits(tmp_path):
+        path = str(tmp_path / "pids")
+        process = supervise(path, 1, restarts=3)
+        assert len(set(recorded_pids(path, 3))) == 3
+        process.terminate()
+        process.join(5)
+        assert process.exitcode == 0
+
+    def it_replaces_every_worker_on_sighup(tmp_path):
+        path = str(tmp_path / "pids")
+        process = supervise(path, 2)
+        old = recorded_pids(path, 2)
+        os.kill(process.pid, signal.SIGHUP)
+        new = recorded_pids(path, 4)[2:]
+        process.terminate()
+        process.join(5)
+        assert process.exitcode == 0
+        assert not set(old) & set(new)
+
+def describe_openBackend():
+
+    def it_seeds_memory_with_versions_and_retired_ids():
+        with SquirrelDB() as db:
+            db.createSquirrel("Fluffy", "large")
+            db.createSquirrel("Chippy", "small")
+            db.updateSquirrel(1, "Fluff", "large")
+            db.deleteSquirrel(2)
+        backend = openBackend("memory")
+        try:
+            assert backend.getSquirrel(1)["version"] == 2
+            with backend.open() as db:
+                db.createSquirrel("Pip", "small")
+                assert db.getSquirrel(3)["name"] == "Pip"
+        finally:
+            backend.shutdown()
+
+def describe_run():
+
+    def it_refuses_to_share_the_memory_backend_between_processes():
+        with pytest.raises(ValueError):
+            run("threaded", backend="memory", processes=2)
+
+    def it_generates_a_debug_token_for_a_profile_dir(mocker, capsys, tmp_path):
+        profiler = mocker.patch.object(squirrel_server, "PROFILER", Profiler())
+        mocker.patch.object(squirrel_server, "RESPONSE_CACHE", ResponseCache())
+        mocker.patch("squirrel_server.listenSocket")
+        mocker.patch("squirrel_server.PreforkSupervisor")
+        run("threaded", processes=2, profileDir=str(tmp_path))
+        assert profiler.token
+        assert profiler.token in capsys.readouterr().out
+
+    def it_keeps_the_debug_token_it_is_given(mocker, tmp_path):
+        profiler = mocker.patch.object(squirrel_server, "PROFILER", Profiler())
+        mocker.patch.object(squirrel_server, "RESPONSE_CACHE", ResponseCache())
+        mocker.patch("squirrel_server.listenSocket")
+        mocker.patch("squirrel_server.PreforkSupervisor")
+        run("threaded", processes=2, profileDir=str(tmp_path), debugToken="secret")
+        assert profiler.token == "secret"
+
+    def it_turns_the_response_cache_off_for_several_processes(mocker):
+        cache = mocker.patch.object(squirrel_server, "RESPONSE_CACHE", ResponseCache())
+        mocker.patch("squirrel_server.listenSocket")
+        supervisor = mocker.patch("squirrel_server.PreforkSupervisor")
+        run("threaded", processes=2)
+        supervisor.return_value.run.assert_called_once_with()
+        cache.put(("squirrel", 1), b"body")
+        assert cache.get(("squirrel", 1)) is None
+
+def read_request(server, data):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await server._readRequest(reader)
+    return asyncio.run(read())
+
+def describe_AsyncSquirrelServer():
+
+    @pytest.fixture
+    def async_server(mocker):
+        # responses go through sendall as they do on a real socket
+        mocker.patch.object(SquirrelServerHandler, 'wbufsize', 0)
+        server = AsyncSquirrelServer(('127.0.0.1', 8080), SquirrelServerHandler, workers=1, queueSize=0)
+        yield server
+        server.executor.shutdown()
+
+    def describe_dispatch():
+        def it_runs_the_handler_routing_over_the_buffered_request(async_server, mock_db_stream_squirrels):
+            response, close = async_server.dispatch(b"GET /squirrels HTTP/1.0\r\n\r\n", ('127.0.0.1', 80))
+            mock_db_stream_squirrels.assert_called_once()
+            assert response.endswith(bytes(json.dumps(['squirrel']), "utf-8"))
+
+        def it_reports_when_the_connection_should_close(async_server, mock_db_stream_squirrels):
+            response, close = async_server.dispatch(b"GET /squirrels HTTP/1.0\r\n\r\n", ('127.0.0.1', 80))
+            assert close is True
+
+        def it_keeps_http_1_1_connections_open(async_server, mock_db_stream_squirrels):
+            response, close = async_server.dispatch(b"GET /squirrels HTTP/1.1\r\n\r\n", ('127.0.0.1', 80))
+            assert close is False
+
+        def it_answers_unknown_paths_with_404(async_server):
+            response, close = async_server.dispatch(b"GET /invalid HTTP/1.0\r\n\r\n", ('127.0.0.1', 80))
+            assert response.endswith(b"404 Not Found")
+
+    def describe_readRequest():
+        def it_reads_the_head_and_the_declared_body(async_server):
+            data = b"POST /squirrels HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}GET /next"
+            assert read_request(async_server, data) == b"POST /squirrels HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}"
+
+        def it_returns_none_at_end_of_stream(async_server):
+            assert read_request(async_server, b"") is None
+
+def describe_BufferedConnection():
+
+    def it_serves_the_buffered_request_for_reading():
+        conn = BufferedConnection(b"GET / HTTP/1.0\r\n\r\n")
+        assert conn.makefile('rb').read() == b"GET / HTTP/1.0\r\n\r\n"
+
+    def it_collects_what_is_sent():
+        conn = BufferedConnection(b"")
+        conn.sendall(b"one")
+        conn.sendall(b"two")
+        assert conn.output.getvalue() == b"onetwo"